@@ -8,7 +8,7 @@ from backend.routes import chat_router, admin_router, knowledge_router, public_a
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from database import AsyncSessionLocal
-from backend.services import MemoryService, BlacklistService
+from backend.services import MemoryService, BlacklistService, EmbeddingWorker, LexicalIndex, LLMPoolService
 import os
 
 scheduler = AsyncIOScheduler()
@@ -54,9 +54,27 @@ async def lifespan(app: FastAPI):
     )
     scheduler.start()
     
+    # 为旧数据分段，并继续上次未完成的向量重建任务
+    worker = await EmbeddingWorker.get_instance()
+    await worker.ensure_chunks()
+    
+    # 预加载分词词典并构建各分区的关键词索引（知识库标题和关键词作为用户词典），避免首个提问承担加载耗时
+    async with AsyncSessionLocal() as db:
+        await (await LexicalIndex.get_instance()).warmup(db)
+    
+    await worker.resume_if_needed()
+    
     yield
     
+    await worker.shutdown()
     scheduler.shutdown()
+    
+    # 写回节流期间未保存的调用统计
+    pool = await LLMPoolService.get_instance()
+    if pool.needs_save(force=True):
+        async with AsyncSessionLocal() as db:
+            await pool.save_to_db(db)
+    await LLMPoolService.clients.close()
 
 
 app = FastAPI(
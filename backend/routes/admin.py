@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import delete
 from database import get_db
@@ -12,10 +12,14 @@ from backend.schemas import (
 )
 from backend.services import (
     BlacklistService, ChannelService, ContentFilter,
-    UserService, MemoryService, ConfigService, KnowledgeService, LLMPoolService
+    UserService, MemoryService, ConfigService, KnowledgeService, LLMPoolService,
+    EmbeddingService, EmbeddingWorker, KnowledgeIndex, LexicalIndex, EmbeddingPoolService
 )
+from backend.services.knowledge_import import import_document, iter_lines
+from backend.services.knowledge_index import SHARED_PARTITION, knowledge_partitions
+from backend.services.embedding_providers import LocalEmbeddingProvider, PROVIDERS as EMBEDDING_PROVIDERS
 from config import get_settings
-from typing import List
+from typing import List, Optional
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 settings = get_settings()
@@ -465,11 +469,14 @@ async def get_embedding_config(
     base_url = await service.get_system_config("embedding_base_url")
     api_key = await service.get_system_config("embedding_api_key")
     model = await service.get_system_config("embedding_model")
+    provider = await service.get_system_config("embedding_provider")
     
     return {
+        "provider": provider or settings.embedding_provider,
         "base_url": base_url or "",
         "api_key": api_key or "",
-        "model": model or "BAAI/bge-m3"
+        "model": model or "BAAI/bge-m3",
+        "local_model": LocalEmbeddingProvider().model
     }
 
 
@@ -479,19 +486,56 @@ async def update_embedding_config(
     db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_admin)
 ):
-    """更新向量化服务配置"""
+    """更新向量化服务配置（provider: openai / local）"""
     service = ConfigService(db)
     
+    if "provider" in request:
+        if request["provider"] not in EMBEDDING_PROVIDERS:
+            raise HTTPException(status_code=400, detail=f"provider必须是 {' / '.join(EMBEDDING_PROVIDERS)} 之一")
+        old_provider = await service.get_system_config("embedding_provider") or settings.embedding_provider
+        await service.set_system_config("embedding_provider", request["provider"], "向量化后端")
+        if request["provider"] != old_provider:
+            EmbeddingService.query_cache.clear()
     if "base_url" in request:
         await service.set_system_config("embedding_base_url", request["base_url"], "向量化API地址")
     if "api_key" in request:
         await service.set_system_config("embedding_api_key", request["api_key"], "向量化API密钥")
     if "model" in request:
+        old_model = await service.get_system_config("embedding_model")
         await service.set_system_config("embedding_model", request["model"], "向量化模型名称")
+        if request["model"] != old_model:
+            EmbeddingService.query_cache.clear()
     
     return {"success": True}
 
 
+@router.get("/embedding-cache")
+async def get_embedding_cache_stats(_: bool = Depends(verify_admin)):
+    """获取查询向量缓存统计"""
+    return EmbeddingService.query_cache.get_stats()
+
+
+@router.delete("/embedding-cache")
+async def clear_embedding_cache(_: bool = Depends(verify_admin)):
+    """清空查询向量缓存并重置统计"""
+    EmbeddingService.query_cache.clear()
+    EmbeddingService.query_cache.reset_stats()
+    return {"success": True}
+
+
+@router.get("/embedding-batcher")
+async def get_embedding_batcher_stats(_: bool = Depends(verify_admin)):
+    """获取查询向量合批统计（批大小直方图）"""
+    return EmbeddingService.batcher.get_stats()
+
+
+@router.delete("/embedding-batcher")
+async def reset_embedding_batcher_stats(_: bool = Depends(verify_admin)):
+    """重置查询向量合批统计"""
+    EmbeddingService.batcher.reset_stats()
+    return {"success": True}
+
+
 @router.post("/embedding-config/test")
 async def test_embedding_connection(
     request: dict,
@@ -500,6 +544,11 @@ async def test_embedding_connection(
     """测试向量化服务连接"""
     import httpx
     
+    if request.get("provider") == "local":
+        provider = LocalEmbeddingProvider()
+        vector = (await provider.embed_batch(["测试连接"]))[0]
+        return {"success": True, "message": f"本地向量化可用（{provider.model}），向量维度: {len(vector)}"}
+    
     base_url = request.get("base_url", "").rstrip("/")
     api_key = request.get("api_key", "")
     model = request.get("model", "")
@@ -529,6 +578,170 @@ async def test_embedding_connection(
         return {"success": False, "message": f"连接失败: {str(e)}"}
 
 
+# Embedding Pool Routes (向量化服务池，多端点失败切换)
+async def _get_embedding_pool(db: AsyncSession) -> EmbeddingPoolService:
+    pool = await EmbeddingPoolService.get_instance()
+    if not pool.loaded:
+        await pool.load_from_db(db)
+    return pool
+
+
+async def _embedding_model(db: AsyncSession) -> str:
+    return await ConfigService(db).get_system_config("embedding_model") or "BAAI/bge-m3"
+
+
+@router.get("/embedding-pool")
+async def get_embedding_pool(
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """获取向量化服务池的端点及健康统计"""
+    pool = await _get_embedding_pool(db)
+    model = await _embedding_model(db)
+    
+    members = []
+    for i, m in enumerate(pool.get_pool()):
+        key = m.get("api_key", "")
+        masked_key = key[:8] + "****" + key[-4:] if len(key) > 12 else "****"
+        members.append({
+            "index": i,
+            "name": m.get("name", ""),
+            "base_url": m.get("base_url", ""),
+            "api_key": masked_key,
+            "enabled": m.get("enabled", True),
+            "weight": m.get("weight", 1),
+            "available": pool.is_available(m),
+            **pool.get_member_stats(m)
+        })
+    return {
+        "model": model,
+        "dimension": pool.get_dimension(model),
+        "members": members,
+        "enabled_count": len(pool.get_enabled_members())
+    }
+
+
+@router.post("/embedding-pool/test")
+async def test_embedding_pool_endpoint(
+    request: dict,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """测试端点（使用当前向量模型，并校验向量维度与池一致）"""
+    if not request.get("base_url") or not request.get("api_key"):
+        raise HTTPException(status_code=400, detail="缺少API地址或密钥")
+    pool = await _get_embedding_pool(db)
+    return await pool.test_member(request, await _embedding_model(db))
+
+
+@router.post("/embedding-pool")
+async def add_embedding_pool_endpoint(
+    request: dict,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """添加端点到向量化服务池；测试不通过（含维度不一致）时不添加，返回测试结果"""
+    base_url = request.get("base_url", "")
+    api_key = request.get("api_key", "")
+    if not base_url or not api_key:
+        raise HTTPException(status_code=400, detail="缺少API地址或密钥")
+    pool = await _get_embedding_pool(db)
+    result = await pool.test_member(request, await _embedding_model(db))
+    if not result["success"]:
+        return result
+    
+    pool.add_member(base_url, api_key, name=request.get("name"), weight=request.get("weight", 1))
+    await pool.save_to_db(db)
+    return {"success": True, "count": len(pool.get_pool()), "dimension": result["dimension"]}
+
+
+@router.post("/embedding-pool/reset-stats")
+async def reset_embedding_pool_stats(
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """重置向量化服务池的统计（同时结束所有端点的冷却）"""
+    pool = await _get_embedding_pool(db)
+    pool.reset_stats()
+    return {"success": True}
+
+
+@router.put("/embedding-pool/{index}")
+async def update_embedding_pool_endpoint(
+    index: int,
+    request: dict,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """更新端点；修改地址或密钥时重新测试"""
+    pool = await _get_embedding_pool(db)
+    member = pool.get_member(index)
+    if member is None:
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    
+    if request.get("base_url") or request.get("api_key"):
+        candidate = {
+            "base_url": request.get("base_url") or member["base_url"],
+            "api_key": request.get("api_key") or member["api_key"]
+        }
+        result = await pool.test_member(candidate, await _embedding_model(db))
+        if not result["success"]:
+            return result
+    
+    pool.update_member(
+        index,
+        base_url=request.get("base_url") or None,
+        api_key=request.get("api_key") or None,
+        name=request.get("name"),
+        weight=request.get("weight")
+    )
+    await pool.save_to_db(db)
+    return {"success": True}
+
+
+@router.put("/embedding-pool/{index}/toggle")
+async def toggle_embedding_pool_endpoint(
+    index: int,
+    request: dict,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """启用/禁用端点"""
+    pool = await _get_embedding_pool(db)
+    if not pool.toggle_member(index, request.get("enabled", True)):
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    await pool.save_to_db(db)
+    return {"success": True}
+
+
+@router.post("/embedding-pool/{index}/test")
+async def test_existing_embedding_endpoint(
+    index: int,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """测试已添加的端点"""
+    pool = await _get_embedding_pool(db)
+    member = pool.get_member(index)
+    if member is None:
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    return await pool.test_member(member, await _embedding_model(db))
+
+
+@router.delete("/embedding-pool/{index}")
+async def remove_embedding_pool_endpoint(
+    index: int,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """从向量化服务池移除端点"""
+    pool = await _get_embedding_pool(db)
+    if not pool.remove_member(index):
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    await pool.save_to_db(db)
+    return {"success": True}
+
+
 @router.get("/llm-models")
 async def get_llm_models(
     base_url: str = None,
@@ -570,25 +783,157 @@ async def get_llm_models(
 # Knowledge Base Routes
 @router.get("/knowledge/rebuild-progress")
 async def get_rebuild_progress(_: bool = Depends(verify_admin)):
-    """获取向量重建进度"""
-    from backend.services.knowledge_service import rebuild_progress
-    return rebuild_progress
+    """获取向量重建进度（含批次吞吐量和预计剩余时间）"""
+    worker = await EmbeddingWorker.get_instance()
+    return worker.get_progress()
 
 @router.post("/knowledge/rebuild-embeddings")
 async def rebuild_knowledge_embeddings(
+    request: dict = None,
     db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_admin)
 ):
-    """重建所有知识库条目的向量"""
-    try:
-        service = KnowledgeService(db)
-        count = await service.rebuild_embeddings()
-        return {"success": True, "rebuilt": count}
-    except Exception as e:
-        import traceback
-        print(f"[Admin] Rebuild embeddings error: {e}")
-        print(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=str(e))
+    """在后台重建知识库条目的向量，force=true时忽略哈希全部重建"""
+    force = bool((request or {}).get("force", False))
+    service = KnowledgeService(db)
+    started = await service.rebuild_embeddings(force=force)
+    if not started:
+        raise HTTPException(status_code=409, detail="重建任务正在运行")
+    return {"success": True, "started": True}
+
+
+@router.post("/knowledge/rebuild-cancel")
+async def cancel_rebuild_embeddings(_: bool = Depends(verify_admin)):
+    """取消正在运行的向量重建任务"""
+    worker = await EmbeddingWorker.get_instance()
+    if not worker.cancel():
+        raise HTTPException(status_code=400, detail="没有正在运行的重建任务")
+    return {"success": True}
+
+
+@router.post("/knowledge/import")
+async def import_knowledge_document(
+    request: Request,
+    source: str = "ALL.txt",
+    category: str = None,
+    bot_id: str = None,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """流式导入ALL.txt格式的文档（请求体为原始文本）
+    
+    按 ===/--- 切分章节，以"来源::标题路径"为章节键新增或更新，每批一个事务；向量在后台按批生成。
+    指定bot_id时导入为该bot的专属知识。
+    """
+    if not source.strip():
+        raise HTTPException(status_code=400, detail="source不能为空")
+    report = await import_document(
+        db, iter_lines(request.stream()), source.strip(), category=category or None, bot_id=bot_id or None
+    )
+    return {"success": True, **report}
+
+
+@router.get("/knowledge/search-config")
+async def get_knowledge_search_config(
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """获取知识库检索配置"""
+    service = ConfigService(db)
+    return await service.get_knowledge_search_config()
+
+
+@router.put("/knowledge/search-config")
+async def update_knowledge_search_config(
+    request: dict,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """更新知识库检索配置（mode: hybrid/vector/keyword，deadline_ms: 混合检索等待向量结果的时限，nprobe: IVF检索簇数，
+    mmr_lambda: 去冗余时相关度的权重(0~1，1为关闭)，token_budget: 知识片段token预算(0为不限制)）"""
+    mode = request.get("mode")
+    if mode is not None and mode not in ("hybrid", "vector", "keyword"):
+        raise HTTPException(status_code=400, detail="检索模式必须是 hybrid、vector 或 keyword")
+    deadline_ms = request.get("deadline_ms")
+    if deadline_ms is not None and (not isinstance(deadline_ms, (int, float)) or deadline_ms <= 0):
+        raise HTTPException(status_code=400, detail="deadline_ms 必须大于0")
+    rrf_k = request.get("rrf_k")
+    if rrf_k is not None and (not isinstance(rrf_k, int) or rrf_k < 1):
+        raise HTTPException(status_code=400, detail="rrf_k 必须是正整数")
+    nprobe = request.get("nprobe")
+    if nprobe is not None and (not isinstance(nprobe, int) or nprobe < 1):
+        raise HTTPException(status_code=400, detail="nprobe 必须是正整数")
+    mmr_lambda = request.get("mmr_lambda")
+    if mmr_lambda is not None and (not isinstance(mmr_lambda, (int, float)) or not 0 <= mmr_lambda <= 1):
+        raise HTTPException(status_code=400, detail="mmr_lambda 必须在0到1之间")
+    token_budget = request.get("token_budget")
+    if token_budget is not None and (not isinstance(token_budget, int) or token_budget < 0):
+        raise HTTPException(status_code=400, detail="token_budget 必须是非负整数")
+    
+    service = ConfigService(db)
+    config = await service.set_knowledge_search_config(
+        mode=mode, deadline_ms=deadline_ms, rrf_k=rrf_k, nprobe=nprobe,
+        mmr_lambda=mmr_lambda, token_budget=token_budget
+    )
+    return {"success": True, "config": config}
+
+
+@router.get("/knowledge/search-stats")
+async def get_knowledge_search_stats(_: bool = Depends(verify_admin)):
+    """获取最近检索的分阶段耗时（p50/p95）、向量超时次数和结果缓存命中率"""
+    stats = KnowledgeService.search_stats.get_stats()
+    stats["cache"] = KnowledgeService.result_cache.get_stats()
+    return stats
+
+
+@router.delete("/knowledge/search-stats")
+async def clear_knowledge_search_stats(_: bool = Depends(verify_admin)):
+    """重置检索耗时统计和缓存命中计数"""
+    KnowledgeService.search_stats.clear()
+    KnowledgeService.result_cache.reset_stats()
+    return {"success": True}
+
+
+@router.get("/knowledge/index-stats")
+async def get_knowledge_index_stats(
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """获取向量索引状态（规模、是否启用IVF近似检索、簇数）和关键词索引状态（含启动预热耗时）
+    
+    顶层为共享知识分区，partitions 列出各bot专属知识分区。
+    """
+    stats = None
+    partitions = []
+    for partition in await knowledge_partitions(db):
+        index = await KnowledgeIndex.get_instance(partition)
+        await index.ensure_built(db)
+        lexical = await LexicalIndex.get_instance(partition)
+        await lexical.ensure_built(db)
+        partition_stats = dict(index.get_stats(), lexical=lexical.get_stats())
+        if partition == SHARED_PARTITION:
+            stats = partition_stats
+        else:
+            partitions.append(partition_stats)
+    stats["partitions"] = partitions
+    return stats
+
+
+@router.post("/knowledge/index-retrain")
+async def retrain_knowledge_index(
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """重新训练各分区的IVF簇中心（大批量导入后使用），返回开始训练的分区"""
+    started = []
+    for partition in await knowledge_partitions(db):
+        index = await KnowledgeIndex.get_instance(partition)
+        await index.ensure_built(db)
+        if index.retrain():
+            started.append(partition)
+    if not started:
+        raise HTTPException(status_code=409, detail="索引为空或正在训练")
+    return {"success": True, "partitions": started}
 
 
 @router.get("/knowledge/{kb_id}")
@@ -608,6 +953,7 @@ async def get_knowledge_detail(
         "content": kb.content,
         "keywords": kb.keywords,
         "category": kb.category,
+        "bot_id": kb.bot_id,
         "has_embedding": kb.embedding is not None,
         "is_active": kb.is_active
     }
@@ -616,13 +962,14 @@ async def get_knowledge_detail(
 async def get_knowledge_list(
     skip: int = 0,
     limit: int = 20,
+    bot_id: str = None,
     db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_admin)
 ):
-    """获取知识库列表（带分页）"""
+    """获取知识库列表（带分页）；bot_id为空字符串时只列出共享知识，不传时列出全部"""
     service = KnowledgeService(db)
-    items = await service.get_all(skip, limit)
-    total = await service.get_total_count()
+    items = await service.get_all(skip, limit, bot_id=bot_id)
+    total = await service.get_total_count(bot_id=bot_id)
     return {
         "items": [
             {
@@ -631,6 +978,7 @@ async def get_knowledge_list(
                 "content": kb.content[:200] + "..." if len(kb.content) > 200 else kb.content,
                 "keywords": kb.keywords,
                 "category": kb.category,
+                "bot_id": kb.bot_id,
                 "has_embedding": kb.embedding is not None,
                 "is_active": kb.is_active,
                 "created_at": kb.created_at.isoformat() if kb.created_at else None
@@ -656,7 +1004,8 @@ async def create_knowledge(
         content=request.get("content", ""),
         keywords=request.get("keywords"),
         category=request.get("category"),
-        auto_embed=request.get("auto_embed", True)
+        auto_embed=request.get("auto_embed", True),
+        bot_id=request.get("bot_id")
     )
     return {"success": True, "id": kb.id}
 
@@ -694,6 +1043,22 @@ async def batch_update_knowledge_category(
     return {"success": True, "updated": count}
 
 
+@router.put("/knowledge/batch-bot")
+async def batch_update_knowledge_bot(
+    request: dict,
+    db: AsyncSession = Depends(get_db),
+    _: bool = Depends(verify_admin)
+):
+    """批量设置知识所属的bot（bot_id为空时改为所有bot共享）"""
+    kb_ids = request.get("ids", [])
+    if not kb_ids:
+        raise HTTPException(status_code=400, detail="请选择知识条目")
+    
+    service = KnowledgeService(db)
+    count = await service.batch_update_bot(kb_ids, request.get("bot_id") or None)
+    return {"success": True, "updated": count}
+
+
 @router.post("/knowledge/batch-delete")
 async def batch_delete_knowledge(
     request: dict,
@@ -743,10 +1108,9 @@ async def get_llm_pool(
     for i, m in enumerate(pool.get_pool()):
         key = m.get("api_key", "")
         masked_key = key[:8] + "****" + key[-4:] if len(key) > 12 else "****"
-        total = m.get("success_count", 0) + m.get("fail_count", 0)
-        success_rate = round(m.get("success_count", 0) / total * 100, 1) if total > 0 else 0
         models.append({
             "index": i,
+            "id": m.get("id"),
             "name": m.get("name", ""),
             "base_url": m.get("base_url", ""),
             "api_key": masked_key,
@@ -754,11 +1118,7 @@ async def get_llm_pool(
             "enabled": m.get("enabled", True),
             "weight": m.get("weight", 1),
             "group": m.get("group", ""),
-            "request_count": m.get("request_count", 0),
-            "success_count": m.get("success_count", 0),
-            "fail_count": m.get("fail_count", 0),
-            "success_rate": success_rate,
-            "avg_response_time": m.get("avg_response_time", 0)
+            **pool.get_model_stats(i)
         })
     settings = pool.get_settings()
     return {
@@ -766,6 +1126,9 @@ async def get_llm_pool(
         "enabled_count": len(pool.get_enabled_models()),
         "retry_count": settings["retry_count"],
         "retry_on_error": settings["retry_on_error"],
+        "strategy": settings["strategy"],
+        "group_strategies": settings["group_strategies"],
+        "hedge": pool.hedge.get_stats(),
         "groups": pool.get_groups()
     }
 
@@ -835,15 +1198,23 @@ async def add_llm_to_pool(
 @router.get("/llm-pool/logs")
 async def get_llm_call_logs(
     limit: int = 50,
+    cursor: Optional[int] = None,
+    since: Optional[int] = None,
     db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_admin)
 ):
-    """获取调用日志"""
+    """获取调用日志（从新到旧）：cursor传上次的next_cursor向前翻页，since传上次的latest只取新日志"""
     pool = await LLMPoolService.get_instance()
     if not pool.loaded:
         await pool.load_from_db(db)
     
-    return {"logs": pool.get_call_logs(limit)}
+    return pool.get_call_logs(max(1, min(limit, 500)), cursor=cursor, since=since)
+
+
+@router.get("/llm-pool/clients")
+async def get_llm_client_stats(_: bool = Depends(verify_admin)):
+    """获取共享端点客户端的连接统计（新建连接、TLS握手、连接复用）"""
+    return LLMPoolService.clients.get_stats()
 
 
 @router.get("/llm-pool/groups")
@@ -865,7 +1236,7 @@ async def update_llm_pool_settings(
     db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_admin)
 ):
-    """更新模型池的重试设置"""
+    """更新模型池的重试设置、路由策略（strategy为默认策略，group_strategies为各分组的策略）和对冲设置"""
     pool = await LLMPoolService.get_instance()
     if not pool.loaded:
         await pool.load_from_db(db)
@@ -873,13 +1244,28 @@ async def update_llm_pool_settings(
     retry_count = request.get("retry_count")
     retry_on_error = request.get("retry_on_error")
     
-    pool.update_settings(retry_count=retry_count, retry_on_error=retry_on_error)
+    try:
+        pool.update_settings(
+            retry_count=retry_count,
+            retry_on_error=retry_on_error,
+            strategy=request.get("strategy"),
+            group_strategies=request.get("group_strategies"),
+            hedge_enabled=request.get("hedge_enabled"),
+            hedge_quantile=request.get("hedge_quantile"),
+            hedge_max_rate=request.get("hedge_max_rate")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     await pool.save_to_db(db)
     
+    settings = pool.get_settings()
     return {
         "success": True,
         "retry_count": pool.retry_count,
-        "retry_on_error": pool.retry_on_error
+        "retry_on_error": pool.retry_on_error,
+        "strategy": settings["strategy"],
+        "group_strategies": settings["group_strategies"],
+        "hedge": pool.hedge.get_stats()
     }
 
 
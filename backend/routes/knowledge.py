@@ -2,11 +2,12 @@ from fastapi import APIRouter, Depends, HTTPException, Header
 from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
 from backend.schemas import (
-    KnowledgeBaseCreate, KnowledgeBaseUpdate, KnowledgeBaseResponse
+    KnowledgeBaseCreate, KnowledgeBaseUpdate, KnowledgeBaseResponse, KnowledgeSearchResult
 )
 from backend.services import KnowledgeService
+from database.embedding_codec import unpack_embedding
 from config import get_settings
-from typing import List
+from typing import List, Optional
 
 router = APIRouter(prefix="/api/knowledge", tags=["knowledge"])
 settings = get_settings()
@@ -18,6 +19,25 @@ async def verify_admin(x_admin_secret: str = Header(None)):
     return True
 
 
+def to_response(kb, include_embedding: bool = False) -> KnowledgeBaseResponse:
+    """构造响应，默认不返回向量"""
+    embedding = None
+    if include_embedding:
+        vector = unpack_embedding(kb.embedding)
+        embedding = vector.tolist() if vector is not None else None
+    return KnowledgeBaseResponse(
+        id=kb.id,
+        title=kb.title,
+        content=kb.content,
+        keywords=kb.keywords,
+        category=kb.category,
+        bot_id=kb.bot_id,
+        embedding=embedding,
+        is_active=kb.is_active,
+        created_at=kb.created_at
+    )
+
+
 @router.post("/", response_model=KnowledgeBaseResponse)
 async def create_knowledge(
     request: KnowledgeBaseCreate,
@@ -25,12 +45,14 @@ async def create_knowledge(
     _: bool = Depends(verify_admin)
 ):
     service = KnowledgeService(db)
-    return await service.create(
+    kb = await service.create(
         title=request.title,
         content=request.content,
         keywords=request.keywords,
-        category=request.category
+        category=request.category,
+        bot_id=request.bot_id
     )
+    return to_response(kb)
 
 
 @router.get("/", response_model=List[KnowledgeBaseResponse])
@@ -38,32 +60,39 @@ async def get_all_knowledge(
     skip: int = 0,
     limit: int = 100,
     active_only: bool = False,
+    include_embedding: bool = False,
+    bot_id: Optional[str] = None,
     db: AsyncSession = Depends(get_db)
 ):
     service = KnowledgeService(db)
-    return await service.get_all(skip, limit, active_only)
+    items = await service.get_all(skip, limit, active_only, load_embedding=include_embedding, bot_id=bot_id)
+    return [to_response(kb, include_embedding) for kb in items]
 
 
-@router.get("/search", response_model=List[KnowledgeBaseResponse])
+@router.get("/search", response_model=List[KnowledgeSearchResult])
 async def search_knowledge(
     query: str,
     limit: int = 5,
+    bot_id: Optional[str] = None,
     db: AsyncSession = Depends(get_db)
 ):
+    """检索共享知识；指定bot_id时同时检索该bot的专属知识"""
     service = KnowledgeService(db)
-    return await service.search(query, limit)
+    results = await service.search(query, limit, bot_id=bot_id)
+    return [KnowledgeSearchResult(**hit._asdict()) for hit in results]
 
 
 @router.get("/{kb_id}", response_model=KnowledgeBaseResponse)
 async def get_knowledge(
     kb_id: int,
+    include_embedding: bool = False,
     db: AsyncSession = Depends(get_db)
 ):
     service = KnowledgeService(db)
     kb = await service.get_by_id(kb_id)
     if not kb:
         raise HTTPException(status_code=404, detail="Knowledge not found")
-    return kb
+    return to_response(kb, include_embedding)
 
 
 @router.put("/{kb_id}", response_model=KnowledgeBaseResponse)
@@ -80,11 +109,12 @@ async def update_knowledge(
         content=request.content,
         keywords=request.keywords,
         category=request.category,
+        bot_id=request.bot_id,
         is_active=request.is_active
     )
     if not kb:
         raise HTTPException(status_code=404, detail="Knowledge not found")
-    return kb
+    return to_response(kb)
 
 
 @router.delete("/{kb_id}")
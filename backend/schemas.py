@@ -67,6 +67,7 @@ class KnowledgeBaseCreate(BaseModel):
     content: str
     keywords: Optional[str] = None
     category: Optional[str] = None
+    bot_id: Optional[str] = None  # 为空时所有bot共享
 
 
 class KnowledgeBaseUpdate(BaseModel):
@@ -74,6 +75,7 @@ class KnowledgeBaseUpdate(BaseModel):
     content: Optional[str] = None
     keywords: Optional[str] = None
     category: Optional[str] = None
+    bot_id: Optional[str] = None  # 空字符串表示改为共享知识
     is_active: Optional[bool] = None
 
 
@@ -83,7 +85,8 @@ class KnowledgeBaseResponse(BaseModel):
     content: str
     keywords: Optional[str]
     category: Optional[str]
-    embedding: Optional[str] = None
+    bot_id: Optional[str] = None
+    embedding: Optional[List[float]] = None  # 仅在 include_embedding=true 时返回
     is_active: bool
     created_at: datetime
     
@@ -91,6 +94,15 @@ class KnowledgeBaseResponse(BaseModel):
         from_attributes = True
 
 
+class KnowledgeSearchResult(BaseModel):
+    id: int
+    title: str
+    snippet: str
+    score: float
+    source: str  # vector / keyword / hybrid
+    passage_id: int
+
+
 # Blacklist Schemas
 class BlacklistCreate(BaseModel):
     discord_id: str
@@ -7,10 +7,16 @@ from .chat_service import ChatService
 from .content_filter import ContentFilter
 from .config_service import ConfigService
 from .embedding_service import EmbeddingService
+from .knowledge_index import KnowledgeIndex
+from .lexical_index import LexicalIndex
+from .embedding_worker import EmbeddingWorker
 from .llm_pool_service import LLMPoolService
+from .embedding_pool_service import EmbeddingPoolService
 
 __all__ = [
     "UserService", "MemoryService", "KnowledgeService",
     "BlacklistService", "ChannelService", "ChatService", "ContentFilter",
-    "ConfigService", "EmbeddingService", "LLMPoolService"
+    "ConfigService", "EmbeddingService", "KnowledgeIndex", "LexicalIndex",
+    "EmbeddingWorker",
+    "LLMPoolService", "EmbeddingPoolService"
 ]
@@ -0,0 +1,103 @@
+from typing import Optional
+import os
+import numpy as np
+
+SAMPLE_PER_LIST = 64  # k-means训练时每个簇的采样向量数
+ASSIGN_BLOCK = 4096  # 分配簇时每批处理的向量数，限制临时矩阵的内存
+
+
+def default_nlist(n: int) -> int:
+    """按集合大小选择簇数（约为√n）"""
+    return max(1, int(round(np.sqrt(n))))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+class IVFFlatIndex:
+    """纯NumPy实现的IVF-Flat近似最近邻索引
+    
+    用球面k-means把归一化向量划分为nlist个簇（倒排列表），检索时只对与查询最接近的nprobe个簇内的向量精确打分。
+    nprobe越大召回越高、耗时越长；nprobe=nlist时等价于精确检索。
+    索引本身只保存簇中心，向量和簇分配由调用方（KnowledgeIndex）维护。
+    """
+    
+    def __init__(self, centroids: np.ndarray, trained_size: int = 0, model: str = ""):
+        self.centroids = centroids.astype(np.float32, copy=False)  # (nlist, dim)，已归一化
+        self.trained_size = trained_size  # 训练时的向量数，用于判断是否需要重新训练
+        self.model = model  # 训练所用向量的模型，模型变化后簇中心失效
+    
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+    
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+    
+    @classmethod
+    def train(cls, vectors: np.ndarray, nlist: int = None, n_iter: int = 15, seed: int = 0, trained_size: int = None) -> "IVFFlatIndex":
+        """在（采样的）归一化向量上训练簇中心；trained_size为完整集合的大小（传入采样时）"""
+        n = len(vectors)
+        nlist = min(nlist or default_nlist(n), n)
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, nlist * SAMPLE_PER_LIST)
+        sample = vectors[rng.choice(n, sample_size, replace=False)] if sample_size < n else vectors
+        
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assign, kind="stable")
+            counts = np.bincount(assign, minlength=nlist)
+            present = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts[present])[:-1]])
+            sums = np.zeros_like(centroids)
+            sums[present] = np.add.reduceat(sample[order], starts, axis=0)
+            empty = counts == 0
+            if empty.any():
+                # 空簇重新随机取点
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            centroids = _normalize(sums)
+        return cls(centroids, trained_size=trained_size or n)
+    
+    def assign(self, vectors: np.ndarray) -> np.ndarray:
+        """返回每个向量所属的簇编号"""
+        if len(vectors) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.concatenate([
+            np.argmax(vectors[i:i + ASSIGN_BLOCK] @ self.centroids.T, axis=1).astype(np.int32)
+            for i in range(0, len(vectors), ASSIGN_BLOCK)
+        ])
+    
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """返回与查询最接近的nprobe个簇编号"""
+        nprobe = max(1, min(nprobe, self.nlist))
+        scores = self.centroids @ query
+        if nprobe >= self.nlist:
+            return np.arange(self.nlist)
+        return np.argpartition(-scores, nprobe - 1)[:nprobe]
+    
+    def save(self, path: str):
+        """保存簇中心（及模型名），重启后无需重新训练；簇分配由加载方按向量重新计算"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, trained_size=np.int64(self.trained_size), model=np.str_(self.model))
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path: str) -> Optional["IVFFlatIndex"]:
+        """读取索引文件；文件不存在或损坏时返回None（旧版本文件没有模型名，model为空）"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                model = str(data["model"]) if "model" in data.files else ""
+                return cls(data["centroids"], trained_size=int(data["trained_size"]), model=model)
+        except Exception as e:
+            print(f"[IVFFlatIndex] Failed to load {path}: {e}")
+            return None
@@ -1,10 +1,11 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from openai import AsyncOpenAI
 from config import get_settings
+import asyncio
 import time
 from .user_service import UserService
 from .memory_service import MemoryService
-from .knowledge_service import KnowledgeService
+from .knowledge_service import KnowledgeService, estimate_tokens
 from .blacklist_service import BlacklistService
 from .content_filter import ContentFilter
 from .config_service import ConfigService
@@ -14,6 +15,7 @@ from typing import List, Dict, AsyncGenerator, Optional
 settings = get_settings()
 
 DEFAULT_SYSTEM_PROMPT = """你是一个友好的AI助手。请根据后台配置的人设来回复用户。"""
+EMPTY_RESPONSE_ERROR = "模型返回了空响应"  # 对冲中流正常结束但没有任何文本片段时记录的错误
 
 
 class ChatService:
@@ -29,10 +31,16 @@ class ChatService:
         self._client = None
         self._llm_config = None
     
-    async def get_client_and_model(self) -> tuple[AsyncOpenAI, str, str]:
-        """获取LLM客户端和模型（支持模型池轮流，主API也参与）
+    async def get_client_and_model(self, exclude: Dict = None, fallback: bool = True) -> tuple[AsyncOpenAI, str, str]:
+        """获取LLM客户端和模型（支持模型池轮流，主API也参与），exclude为需要排除的模型（base_url+模型名）
+        fallback为False时不选择熔断中的模型
         返回: (client, model_name, source_name)
         """
+        client, model_info = await self._select_model(exclude, fallback)
+        return client, model_info["model"], model_info["name"]
+    
+    async def _select_model(self, exclude: Dict = None, fallback: bool = True) -> tuple[AsyncOpenAI, Dict]:
+        """选择模型，返回客户端和所选模型的配置（池中条目带id，name为来源描述），用于按条目记录调用结果"""
         pool = await LLMPoolService.get_instance()
         if not pool.loaded:
             await pool.load_from_db(self.db)
@@ -46,10 +54,12 @@ class ChatService:
         # 添加模型池中启用的模型
         for m in pool.get_enabled_models():
             all_models.append({
+                "id": m["id"],
                 "base_url": m["base_url"],
                 "api_key": m["api_key"],
                 "model": m["model"],
-                "name": m.get("name", "pool")
+                "name": m.get("name", "pool"),
+                "group": m.get("group", "")  # 决定该模型使用的路由策略
             })
         
         # 添加主API（如果配置了的话）
@@ -61,23 +71,178 @@ class ChatService:
                 "name": "主API"
             })
         
+        if exclude:
+            excluded = (str(exclude.get("base_url", "")).rstrip("/"), exclude.get("model", ""))
+            all_models = [m for m in all_models if (m["base_url"].rstrip("/"), m["model"]) != excluded]
+        
         if not all_models:
             raise ValueError("没有可用的模型配置")
         
         # 轮流选择
-        config = pool.get_next_from_list(all_models)
-        client = AsyncOpenAI(
-            base_url=config["base_url"],
-            api_key=config["api_key"]
-        )
-        source = f"{config.get('name', 'unknown')}({config['base_url']})"
+        config = pool.get_next_from_list(all_models, fallback=fallback)
+        client = pool.get_client(config["base_url"], config["api_key"])
+        model_info = dict(config, name=f"{config.get('name', 'unknown')}({config['base_url']})")
         
         # 保存请求计数到数据库
         if pool.needs_save():
             await pool.save_to_db(self.db)
             pool.mark_saved()
         
-        return client, config["model"], source
+        return client, model_info
+    
+    @staticmethod
+    def _request_params(model: str, messages: List[Dict], stream: bool) -> Dict:
+        """构建对话请求参数"""
+        request_params = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": 16000,
+            "stream": stream
+        }
+        
+        # thinking模型通过extra_body传递特殊参数
+        if "thinking" in model.lower():
+            request_params["extra_body"] = {
+                "thinking": {
+                    "type": "enabled",
+                    "budget_tokens": 10000
+                }
+            }
+        return request_params
+    
+    @staticmethod
+    def _chunk_content(chunk) -> Optional[str]:
+        """提取流式片段的文本（兼容delta.content / delta.text / text / message.content）"""
+        if not chunk.choices or len(chunk.choices) == 0:
+            return None
+        choice = chunk.choices[0]
+        delta = getattr(choice, 'delta', None)
+        content = None
+        
+        if delta:
+            content = getattr(delta, 'content', None)
+            if not content:
+                content = getattr(delta, 'text', None)
+        
+        if not content:
+            content = getattr(choice, 'text', None)
+        
+        if not content and hasattr(choice, 'message'):
+            msg = choice.message
+            content = getattr(msg, 'content', None)
+        return content
+    
+    async def _stream_events(self, client: AsyncOpenAI, request_params: Dict) -> AsyncGenerator[tuple, None]:
+        """发起流式请求，逐个产出 (文本片段, usage)"""
+        response = await client.chat.completions.create(**request_params)
+        try:
+            async for chunk in response:
+                usage = getattr(chunk, 'usage', None) or None
+                content = self._chunk_content(chunk)
+                if content or usage:
+                    yield content, usage
+        finally:
+            await response.close()
+    
+    @staticmethod
+    async def _first_content(events: AsyncGenerator) -> List[tuple]:
+        """读取流直到收到第一个文本片段，返回已读取的事件"""
+        buffered = []
+        async for content, usage in events:
+            buffered.append((content, usage))
+            if content:
+                break
+        return buffered
+    
+    @staticmethod
+    def _has_content(task: asyncio.Future) -> bool:
+        """对冲中的一方是否成功收到了文本片段（流正常结束但没有内容视为失败）"""
+        return task.exception() is None and any(content for content, _ in task.result())
+    
+    @staticmethod
+    async def _replay(buffered: List[tuple], events: AsyncGenerator) -> AsyncGenerator[tuple, None]:
+        for item in buffered:
+            yield item
+        async for item in events:
+            yield item
+    
+    @staticmethod
+    def _estimate_prompt_tokens(messages: List[Dict]) -> int:
+        total = 0
+        for msg in messages:
+            content = msg.get("content")
+            if isinstance(content, str):
+                total += estimate_tokens(content)
+            elif isinstance(content, list):
+                total += sum(estimate_tokens(part.get("text", "")) for part in content if isinstance(part, dict))
+        return total
+    
+    async def _hedged_stream(self, events: AsyncGenerator, model_info: Dict, start_time: float,
+                             messages: List[Dict], delay_ms: float):
+        """等待首个文本片段，超过delay_ms仍未收到时向另一个模型发起对冲请求，先产出内容的一方胜出，另一方取消
+        返回: (事件流, 胜出的模型, 胜出请求的开始时间, 对冲结果或None)
+        """
+        pool = await LLMPoolService.get_instance()
+        primary = asyncio.ensure_future(self._first_content(events))
+        racers = {primary: (events, model_info, start_time)}
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay_ms / 1000)
+            backup_client = None
+            if not done and pool.hedge.allow():
+                try:
+                    backup_client, backup_info = await self._select_model(exclude=model_info, fallback=False)
+                except ValueError:
+                    pass  # 没有其他可用（未熔断）的模型
+            pool.hedge.record_request(backup_client is not None)
+            if backup_client is None:
+                return self._replay(await primary, events), model_info, start_time, None
+            
+            print(f"[ChatService] No first token after {delay_ms:.0f}ms, hedging with {backup_info['model']} from {backup_info['name']}")
+            backup_events = self._stream_events(backup_client, self._request_params(backup_info["model"], messages, True))
+            racers[asyncio.ensure_future(self._first_content(backup_events))] = (backup_events, backup_info, time.time())
+            
+            pending = set(racers)
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if winner is None and self._has_content(task):
+                        winner = task
+        except BaseException:
+            for task in racers:
+                task.cancel()
+            await asyncio.gather(*racers, return_exceptions=True)
+            for task, (task_events, info, _) in racers.items():
+                await task_events.aclose()
+                if task is not primary:
+                    pool.breaker(info).release(info.get("acquired_at"))
+            raise
+        
+        cancelled = 0
+        loser_tokens = 0
+        for task, (task_events, info, started) in racers.items():
+            if task is winner:
+                continue
+            elapsed = (time.time() - started) * 1000
+            if task.done() and not self._has_content(task):
+                # 两个都失败时由调用方记录主请求的失败并重试
+                if winner is not None or task is not primary:
+                    pool.record_call_result(info, False, elapsed, str(task.exception() or EMPTY_RESPONSE_ERROR))
+                await task_events.aclose()
+                continue
+            task.cancel()
+            buffered = (await asyncio.gather(task, return_exceptions=True))[0]
+            if isinstance(buffered, list):  # 与胜出方同时收到了内容
+                loser_tokens += sum(estimate_tokens(content) for content, _ in buffered if content)
+            await task_events.aclose()
+            pool.record_hedge_loss(info, elapsed)
+            cancelled += 1
+        
+        if winner is None:
+            raise primary.exception() or RuntimeError(EMPTY_RESPONSE_ERROR)
+        winner_events, winner_info, winner_start = racers[winner]
+        hedge = {"backup_won": winner is not primary, "cancelled": cancelled, "loser_tokens": loser_tokens}
+        return self._replay(winner.result(), winner_events), winner_info, winner_start, hedge
     
     async def get_client(self) -> AsyncOpenAI:
         """获取LLM客户端（兼容旧代码）"""
@@ -252,8 +417,8 @@ class ChatService:
         memory = await self.memory_service.get_user_memory(user.id)
         user_memory = memory.summary if memory else None
         
-        kb_results = await self.knowledge_service.search(message)
-        knowledge_texts = [f"【{kb.title}】\n{kb.content}" for kb in kb_results]
+        kb_results = await self.knowledge_service.search(message, bot_id=self.bot_id)
+        knowledge_texts = [f"【{hit.title}】\n{hit.snippet}" for hit in kb_results]
         
         chat_mode = await self.get_chat_mode()
         
@@ -271,13 +436,26 @@ class ChatService:
         )
         
         try:
-            client = await self.get_client()
-            model = await self.get_model()
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=4096
-            )
+            pool = await LLMPoolService.get_instance()
+            client, model_info = await self._select_model()
+            start_time = time.time()
+            try:
+                response = await client.chat.completions.create(
+                    model=model_info["model"],
+                    messages=messages,
+                    max_tokens=4096
+                )
+            except asyncio.CancelledError:
+                # 被取消的请求没有结果，归还半开状态的探测名额
+                pool.breaker(model_info).release(model_info.get("acquired_at"))
+                raise
+            except Exception as e:
+                pool.record_call_result(model_info, False, (time.time() - start_time) * 1000, str(e))
+                raise
+            pool.record_call_result(model_info, True, (time.time() - start_time) * 1000)
+            if pool.needs_save():
+                await pool.save_to_db(self.db)
+                pool.mark_saved()
             
             assistant_message = response.choices[0].message.content
             
@@ -322,8 +500,8 @@ class ChatService:
         memory = await self.memory_service.get_user_memory(user.id)
         user_memory = memory.summary if memory else None
         
-        kb_results = await self.knowledge_service.search(message)
-        knowledge_texts = [f"【{kb.title}】\n{kb.content}" for kb in kb_results]
+        kb_results = await self.knowledge_service.search(message, bot_id=self.bot_id)
+        knowledge_texts = [f"【{hit.title}】\n{hit.snippet}" for hit in kb_results]
         
         chat_mode = await self.get_chat_mode()
         
@@ -347,10 +525,11 @@ class ChatService:
         
         for retry in range(max_retries):
             start_time = time.time()
+            first_token_time = None
             current_model = None
             try:
-                client, model, source = await self.get_client_and_model()
-                current_model = {"base_url": str(client.base_url), "model": model, "name": source}
+                client, current_model = await self._select_model()
+                model, source = current_model["model"], current_model["name"]
                 full_response = ""
                 
                 # 获取流式开关（跟随主API设置）
@@ -359,58 +538,41 @@ class ChatService:
                 print(f"[ChatService] Attempt {retry+1}: Using model: {model} from {source}, mode: {chat_mode}, stream: {stream_enabled}")
                 print(f"[ChatService] Messages count: {len(messages)}")
                 
-                # 构建请求参数
-                request_params = {
-                    "model": model,
-                    "messages": messages,
-                    "max_tokens": 16000,
-                    "stream": stream_enabled
-                }
-                
-                # thinking模型通过extra_body传递特殊参数
-                if "thinking" in model.lower():
-                    request_params["extra_body"] = {
-                        "thinking": {
-                            "type": "enabled",
-                            "budget_tokens": 10000
-                        }
-                    }
-                
-                response = await client.chat.completions.create(**request_params)
+                request_params = self._request_params(model, messages, stream_enabled)
                 
                 input_tokens = 0
                 output_tokens = 0
                 
                 if stream_enabled:
-                    # 流式响应
-                    async for chunk in response:
-                        if hasattr(chunk, 'usage') and chunk.usage:
-                            if hasattr(chunk.usage, 'prompt_tokens'):
-                                input_tokens = chunk.usage.prompt_tokens
-                            if hasattr(chunk.usage, 'completion_tokens'):
-                                output_tokens = chunk.usage.completion_tokens
+                    # 流式响应（启用对冲时，首字过慢会向另一个模型发起同样的请求）
+                    events = self._stream_events(client, request_params)
+                    hedge = None
+                    hedge_delay = pool.hedge.delay_ms()
+                    if hedge_delay is not None:
+                        events, current_model, start_time, hedge = await self._hedged_stream(
+                            events, current_model, start_time, messages, hedge_delay
+                        )
+                    
+                    async for content, usage in events:
+                        if usage:
+                            if hasattr(usage, 'prompt_tokens'):
+                                input_tokens = usage.prompt_tokens
+                            if hasattr(usage, 'completion_tokens'):
+                                output_tokens = usage.completion_tokens
                         
-                        if chunk.choices and len(chunk.choices) > 0:
-                            choice = chunk.choices[0]
-                            delta = getattr(choice, 'delta', None)
-                            content = None
-                            
-                            if delta:
-                                content = getattr(delta, 'content', None)
-                                if not content:
-                                    content = getattr(delta, 'text', None)
-                            
-                            if not content:
-                                content = getattr(choice, 'text', None)
-                            
-                            if not content and hasattr(choice, 'message'):
-                                msg = choice.message
-                                content = getattr(msg, 'content', None)
-                            
-                            if content:
-                                full_response += content
-                                yield content
+                        if content:
+                            if first_token_time is None:
+                                first_token_time = time.time()
+                            full_response += content
+                            yield content
+                    
+                    if hedge:
+                        # 被取消的请求同样发送了完整的提示词（失败的请求不计）
+                        prompt_tokens = input_tokens or self._estimate_prompt_tokens(messages)
+                        wasted = prompt_tokens * hedge["cancelled"] + hedge["loser_tokens"]
+                        pool.hedge.record_outcome(hedge["backup_won"], wasted)
                 else:
+                    response = await client.chat.completions.create(**request_params)
                     # 非流式响应
                     if hasattr(response, 'usage') and response.usage:
                         input_tokens = getattr(response.usage, 'prompt_tokens', 0)
@@ -419,6 +581,7 @@ class ChatService:
                     if response.choices and len(response.choices) > 0:
                         content = response.choices[0].message.content
                         if content:
+                            first_token_time = time.time()
                             full_response = content
                             yield content
                 
@@ -432,7 +595,8 @@ class ChatService:
                 
                 # 记录成功调用
                 response_time = (time.time() - start_time) * 1000
-                pool.record_call_result(current_model, True, response_time)
+                ttft = (first_token_time - start_time) * 1000 if first_token_time else None
+                pool.record_call_result(current_model, True, response_time, ttft_ms=ttft)
                 if pool.needs_save():
                     await pool.save_to_db(self.db)
                     pool.mark_saved()
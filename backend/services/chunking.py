@@ -0,0 +1,155 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, insert
+from database.models import KnowledgeBase, KnowledgeChunk
+from config import get_settings
+from typing import List, Dict, Optional, Iterable, Set
+from collections import defaultdict
+import hashlib
+import re
+
+settings = get_settings()
+
+# 按段落和句末标点切分，标点保留在句子末尾
+_SENTENCE_RE = re.compile(r"[^\n。！？!?；;]*(?:[。！？!?；;]+|\n+|$)")
+
+
+def build_embed_text(title: str, passage: str) -> str:
+    """合并条目标题和段落作为向量化文本"""
+    return f"{title} {passage or ''}"
+
+
+def content_hash(text: str) -> str:
+    """向量化文本的哈希，用于跳过未变化的段落"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _sentences(text: str, size: int) -> List[str]:
+    """切分为句子，超长句子按size硬切"""
+    units = []
+    for match in _SENTENCE_RE.finditer(text):
+        piece = match.group()
+        while len(piece) > size:
+            units.append(piece[:size])
+            piece = piece[size:]
+        if piece:
+            units.append(piece)
+    return units
+
+
+def split_passages(content: str, size: int = None, overlap: int = None) -> List[str]:
+    """将正文切分为带重叠的段落
+    
+    尽量在句子边界处断开，每段不超过size字符，相邻段落共享末尾不超过overlap字符的完整句子。
+    不超过size的短条目整体作为一段（与原先的整条向量化文本一致）。
+    """
+    size = size or settings.knowledge_chunk_size
+    overlap = settings.knowledge_chunk_overlap if overlap is None else overlap
+    overlap = max(0, min(overlap, size // 2))
+    content = content or ""
+    if len(content) <= size:
+        return [content]
+    
+    passages = []
+    current: List[str] = []
+    length = 0
+    for sentence in _sentences(content, size):
+        if current and length + len(sentence) > size:
+            passages.append("".join(current))
+            # 上一段末尾的几句作为下一段的开头
+            tail: List[str] = []
+            tail_length = 0
+            for prev in reversed(current):
+                if tail_length + len(prev) > overlap:
+                    break
+                tail.insert(0, prev)
+                tail_length += len(prev)
+            if tail_length + len(sentence) > size:
+                tail, tail_length = [], 0
+            current, length = tail, tail_length
+        current.append(sentence)
+        length += len(sentence)
+    if current:
+        passages.append("".join(current))
+    
+    passages = [p.strip() for p in passages]
+    return [p for p in passages if p] or [content]
+
+
+async def sync_chunks(db: AsyncSession, kb_ids: Optional[Iterable[int]] = None, missing_only: bool = False) -> Set[int]:
+    """按当前分段参数同步条目的段落表，返回段落发生变化的条目ID
+    
+    内容未变的条目不改动；变化的条目重写段落，向量化文本未变的段落沿用原向量。
+    首次分段时把条目原有向量作为首段的临时向量，哈希不一致的由后台重新生成。
+    """
+    query = select(
+        KnowledgeBase.id,
+        KnowledgeBase.title,
+        KnowledgeBase.content,
+        KnowledgeBase.embedding,
+        KnowledgeBase.embedding_hash,
+        KnowledgeBase.embedding_model
+    )
+    if kb_ids is not None:
+        kb_ids = list(kb_ids)
+        if not kb_ids:
+            return set()
+        query = query.where(KnowledgeBase.id.in_(kb_ids))
+    if missing_only:
+        query = query.where(~select(KnowledgeChunk.id).where(KnowledgeChunk.kb_id == KnowledgeBase.id).exists())
+    entries = (await db.execute(query)).all()
+    if not entries:
+        return set()
+    
+    chunk_query = select(
+        KnowledgeChunk.kb_id,
+        KnowledgeChunk.chunk_index,
+        KnowledgeChunk.content,
+        KnowledgeChunk.embedding,
+        KnowledgeChunk.embedding_hash,
+        KnowledgeChunk.embedding_model
+    ).order_by(KnowledgeChunk.kb_id, KnowledgeChunk.chunk_index)
+    if kb_ids is not None or missing_only:
+        chunk_query = chunk_query.where(KnowledgeChunk.kb_id.in_([entry.id for entry in entries]))
+    existing: Dict[int, list] = defaultdict(list)
+    for row in (await db.execute(chunk_query)).all():
+        existing[row.kb_id].append(row)
+    
+    changed: Set[int] = set()
+    rows: List[Dict] = []
+    for entry in entries:
+        passages = split_passages(entry.content)
+        old = existing.get(entry.id, [])
+        if [chunk.content for chunk in old] == passages:
+            continue
+        
+        # 向量化文本哈希 -> (向量, 模型)，可沿用的旧向量
+        reuse = {
+            chunk.embedding_hash: (chunk.embedding, chunk.embedding_model)
+            for chunk in old
+            if chunk.embedding is not None and chunk.embedding_hash
+        }
+        if entry.embedding is not None and entry.embedding_hash:
+            reuse.setdefault(entry.embedding_hash, (entry.embedding, entry.embedding_model))
+        
+        for i, passage in enumerate(passages):
+            text_hash = content_hash(build_embed_text(entry.title, passage))
+            embedding, model = reuse.get(text_hash, (None, None))
+            stored_hash = text_hash if embedding is not None else None
+            if embedding is None and not old and i == 0 and entry.embedding is not None:
+                embedding, model, stored_hash = entry.embedding, entry.embedding_model, entry.embedding_hash
+            rows.append({
+                "kb_id": entry.id,
+                "chunk_index": i,
+                "content": passage,
+                "embedding": embedding,
+                "embedding_hash": stored_hash,
+                "embedding_model": model
+            })
+        changed.add(entry.id)
+    
+    if changed:
+        await db.execute(delete(KnowledgeChunk).where(KnowledgeChunk.kb_id.in_(changed)))
+        if rows:
+            await db.execute(insert(KnowledgeChunk), rows)
+        await db.commit()
+    return changed
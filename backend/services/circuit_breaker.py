@@ -0,0 +1,136 @@
+from collections import deque
+from typing import Dict, Optional
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """单个模型的熔断器：closed(正常) -> open(熔断，不参与选择) -> half_open(放行一个探测请求)
+    
+    连续失败达到 failure_threshold 次，或滑动窗口内调用数不少于 min_calls 且错误率达到 error_rate 时熔断；
+    熔断时间从 cooldown 开始，每次探测失败翻倍（不超过 max_cooldown）。冷却结束后只放行一个探测请求，
+    成功则恢复为closed并清空窗口，失败则重新熔断。探测请求超过 probe_timeout 未返回结果时允许再次探测。
+    
+    acquire() 返回请求的开始时间，record() 据此识别结果属于哪个请求：状态变化前开始的请求（迟到的结果）
+    以及half_open时探测之外的请求结果都会被忽略，不会提前恢复，也不会重复熔断而延长冷却时间。
+    """
+    
+    def __init__(self, failure_threshold: int = 5, error_rate: float = 0.5, window: float = 60.0,
+                 min_calls: int = 10, cooldown: float = 10.0, max_cooldown: float = 300.0,
+                 probe_timeout: float = 120.0):
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_timeout = probe_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_count = 0  # 连续熔断次数（决定冷却时间），恢复后清零
+        self.open_until = 0.0
+        self.probe_started = None  # half_open时探测请求的开始时间
+        self.changed_at = float("-inf")  # 上次熔断或恢复的时间，早于此时开始的请求结果不再计入
+        self.trips = 0  # 累计熔断次数
+        self._calls = deque()  # 滑动窗口 [(时间, 是否成功)]
+        self._window_failures = 0
+    
+    def _prune(self, now: float):
+        while self._calls and now - self._calls[0][0] > self.window:
+            if not self._calls.popleft()[1]:
+                self._window_failures -= 1
+    
+    def _window_error_rate(self) -> Optional[float]:
+        if not self._calls:
+            return None
+        return self._window_failures / len(self._calls)
+    
+    def available(self, now: float = None) -> bool:
+        """是否可以被选中（closed，或冷却结束且没有进行中的探测）"""
+        now = time.monotonic() if now is None else now
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now >= self.open_until
+        return self.probe_started is None or now - self.probe_started > self.probe_timeout
+    
+    def acquire(self, now: float = None, force: bool = False) -> float:
+        """选中后调用：冷却结束的熔断器进入half_open，本次请求作为探测；force为True时提前探测（所有模型都已熔断）
+        返回本次请求的开始时间，记录结果时传给 record()
+        """
+        now = time.monotonic() if now is None else now
+        if self.state == OPEN and (force or now >= self.open_until):
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            self.probe_started = now
+        return now
+    
+    def release(self, started: Optional[float]):
+        """请求被取消、没有结果时调用：若它是探测请求，允许立即放行新的探测"""
+        if self.state == HALF_OPEN and started is not None and started == self.probe_started:
+            self.probe_started = None
+    
+    def record(self, success: bool, started: float = None, now: float = None) -> Optional[str]:
+        """记录调用结果，状态变化时返回新状态；started为acquire()返回的请求开始时间（未知时为None）"""
+        now = time.monotonic() if now is None else now
+        if started is not None and started < self.changed_at:
+            return None  # 上次状态变化之前开始的请求
+        if self.state == OPEN:
+            return None  # 熔断期间没有放行的请求
+        if self.state == HALF_OPEN and (started is None or started != self.probe_started):
+            return None  # 只有探测请求的结果决定是否恢复
+        self._calls.append((now, success))
+        if not success:
+            self._window_failures += 1
+        self._prune(now)
+        if success:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self._close(now)
+                return CLOSED
+            return None
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self._trip(now)
+            return OPEN
+        if self.state == CLOSED:
+            rate = self._window_error_rate()
+            if self.consecutive_failures >= self.failure_threshold or (
+                len(self._calls) >= self.min_calls and rate is not None and rate >= self.error_rate
+            ):
+                self._trip(now)
+                return OPEN
+        return None
+    
+    def _trip(self, now: float):
+        self.state = OPEN
+        self.open_count += 1
+        self.trips += 1
+        self.probe_started = None
+        self.changed_at = now
+        self.open_until = now + min(self.cooldown * 2 ** (self.open_count - 1), self.max_cooldown)
+    
+    def _close(self, now: float):
+        self.state = CLOSED
+        self.changed_at = now
+        self.open_count = 0
+        self.open_until = 0.0
+        self.probe_started = None
+        self._calls.clear()
+        self._window_failures = 0
+    
+    def get_stats(self, now: float = None) -> Dict:
+        now = time.monotonic() if now is None else now
+        self._prune(now)
+        rate = self._window_error_rate()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "window_calls": len(self._calls),
+            "window_error_rate": round(rate, 4) if rate is not None else None,
+            "retry_in": max(0, round(self.open_until - now, 1)) if self.state == OPEN else 0,
+            "trips": self.trips
+        }
@@ -2,6 +2,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from database.models import BotConfig, SystemConfig
 from typing import Optional, Dict, Any
+import json
 
 DEFAULT_SYSTEM_PROMPT = """你是 CatieBot，一个友好、有趣的AI助手。
 
@@ -75,6 +76,54 @@ class ConfigService:
         if stream is not None:
             await self.set_system_config("llm_stream", str(stream).lower(), "是否启用流式传输")
     
+    async def get_knowledge_search_config(self) -> Dict[str, Any]:
+        """获取知识库检索配置（检索模式、混合检索时限、RRF常数、IVF检索簇数、MMR权重、知识token预算）"""
+        from config import get_settings
+        settings = get_settings()
+        
+        config = {
+            "mode": settings.knowledge_search_mode,
+            "deadline_ms": settings.knowledge_hybrid_deadline_ms,
+            "rrf_k": settings.knowledge_rrf_k,
+            "nprobe": settings.knowledge_ann_nprobe,
+            "mmr_lambda": settings.knowledge_mmr_lambda,
+            "token_budget": settings.knowledge_token_budget
+        }
+        raw = await self.get_system_config("knowledge_search_config")
+        if raw:
+            try:
+                stored = json.loads(raw)
+                config.update({key: stored[key] for key in config if key in stored})
+            except json.JSONDecodeError:
+                pass
+        return config
+    
+    async def set_knowledge_search_config(
+        self,
+        mode: str = None,
+        deadline_ms: int = None,
+        rrf_k: int = None,
+        nprobe: int = None,
+        mmr_lambda: float = None,
+        token_budget: int = None
+    ):
+        """设置知识库检索配置"""
+        config = await self.get_knowledge_search_config()
+        if mode is not None:
+            config["mode"] = mode
+        if deadline_ms is not None:
+            config["deadline_ms"] = deadline_ms
+        if rrf_k is not None:
+            config["rrf_k"] = rrf_k
+        if nprobe is not None:
+            config["nprobe"] = nprobe
+        if mmr_lambda is not None:
+            config["mmr_lambda"] = mmr_lambda
+        if token_budget is not None:
+            config["token_budget"] = token_budget
+        await self.set_system_config("knowledge_search_config", json.dumps(config), "知识库检索配置")
+        return config
+    
     # ============ Bot独立配置 (BotConfig) ============
     
     async def get_bot_config(self, bot_id: str) -> Optional[BotConfig]:
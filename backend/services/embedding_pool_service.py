@@ -0,0 +1,272 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database.models import SystemConfig
+from config import get_settings
+from typing import List, Dict, Optional, Tuple
+from .embedding_providers import EmbeddingProvider, OpenAIEmbeddingProvider
+import json
+import asyncio
+import random
+import time
+
+settings = get_settings()
+
+MAX_COOLDOWN_FACTOR = 8  # 连续失败时冷却时间按2倍递增的上限倍数
+
+
+class EmbeddingPoolService:
+    """向量化服务池：多个API地址/密钥按权重分担请求，失败自动切换，记录各端点延迟和错误
+    
+    所有成员使用同一个向量模型（embedding_model配置），并校验返回的向量维度一致，
+    保证新旧向量可比；主向量化配置作为"主API"一同参与。
+    """
+    
+    _instance = None
+    _lock = asyncio.Lock()
+    
+    def __init__(self):
+        self._pool: List[Dict] = []  # [{name, base_url, api_key, enabled, weight}]
+        self._dimensions: Dict[str, int] = {}  # 模型名 -> 向量维度（首次成功调用时记录）
+        self._stats: Dict[Tuple[str, str], Dict] = {}  # (base_url, api_key) -> 运行统计
+        self._loaded = False
+        self._version = 0
+    
+    @classmethod
+    async def get_instance(cls) -> "EmbeddingPoolService":
+        """获取单例实例"""
+        if cls._instance is None:
+            async with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+    
+    async def load_from_db(self, db: AsyncSession):
+        """从数据库加载向量化服务池配置"""
+        result = await db.execute(
+            select(SystemConfig).where(SystemConfig.key == "embedding_pool")
+        )
+        config = result.scalar_one_or_none()
+        
+        if config and config.value:
+            try:
+                data = json.loads(config.value)
+                self._pool = data.get("members", [])
+                self._dimensions = data.get("dimensions", {})
+                self._version = data.get("version", 0)
+                print(f"[EmbeddingPool] Loaded {len(self._pool)} endpoints")
+            except json.JSONDecodeError:
+                self._pool = []
+        self._loaded = True
+        return self._pool
+    
+    async def save_to_db(self, db: AsyncSession):
+        """保存向量化服务池配置到数据库"""
+        result = await db.execute(
+            select(SystemConfig).where(SystemConfig.key == "embedding_pool")
+        )
+        config = result.scalar_one_or_none()
+        value = json.dumps({
+            "members": self._pool,
+            "dimensions": self._dimensions,
+            "version": self._version
+        }, ensure_ascii=False)
+        
+        if config:
+            config.value = value
+        else:
+            db.add(SystemConfig(key="embedding_pool", value=value, description="向量化服务池配置"))
+        await db.commit()
+    
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+    
+    @property
+    def version(self) -> int:
+        return self._version
+    
+    def add_member(self, base_url: str, api_key: str, name: str = None, weight: int = 1):
+        """添加端点到池"""
+        self._pool.append({
+            "name": name or base_url,
+            "base_url": base_url.rstrip("/"),
+            "api_key": api_key,
+            "enabled": True,
+            "weight": max(1, weight)
+        })
+        self._version += 1
+    
+    def update_member(self, index: int, base_url: str = None, api_key: str = None,
+                      name: str = None, weight: int = None) -> bool:
+        """更新端点配置"""
+        if 0 <= index < len(self._pool):
+            member = self._pool[index]
+            if base_url is not None:
+                member["base_url"] = base_url.rstrip("/")
+            if api_key is not None:
+                member["api_key"] = api_key
+            if name is not None:
+                member["name"] = name
+            if weight is not None:
+                member["weight"] = max(1, weight)
+            self._version += 1
+            return True
+        return False
+    
+    def remove_member(self, index: int) -> bool:
+        """移除端点"""
+        if 0 <= index < len(self._pool):
+            self._stats.pop(self.endpoint_key(self._pool.pop(index)), None)
+            self._version += 1
+            return True
+        return False
+    
+    def toggle_member(self, index: int, enabled: bool) -> bool:
+        """启用/禁用端点"""
+        if 0 <= index < len(self._pool):
+            self._pool[index]["enabled"] = enabled
+            self._version += 1
+            return True
+        return False
+    
+    def get_member(self, index: int) -> Optional[Dict]:
+        if 0 <= index < len(self._pool):
+            return self._pool[index]
+        return None
+    
+    def get_pool(self) -> List[Dict]:
+        return self._pool
+    
+    def get_enabled_members(self) -> List[Dict]:
+        return [m for m in self._pool if m.get("enabled", True)]
+    
+    @staticmethod
+    def endpoint_key(member: Dict) -> Tuple[str, str]:
+        return (str(member.get("base_url", "")).rstrip("/"), member.get("api_key", ""))
+    
+    def _member_stats(self, member: Dict) -> Dict:
+        key = self.endpoint_key(member)
+        if key not in self._stats:
+            self._stats[key] = {
+                "request_count": 0,
+                "success_count": 0,
+                "fail_count": 0,
+                "total_response_time": 0,
+                "consecutive_failures": 0,
+                "cooldown_until": 0,
+                "last_error": None
+            }
+        return self._stats[key]
+    
+    def is_available(self, member: Dict) -> bool:
+        """不在失败冷却期内"""
+        return self._member_stats(member)["cooldown_until"] <= time.time()
+    
+    def failover_order(self, members: List[Dict]) -> List[Dict]:
+        """失败切换顺序：可用端点按权重随机排列（加权无放回抽样），冷却中的端点按冷却结束时间排在最后"""
+        available = [m for m in members if self.is_available(m)]
+        # 权重为w的端点取 random()^(1/w) 为排序键，等价于按权重逐个抽取
+        available.sort(key=lambda m: random.random() ** (1 / m.get("weight", 1)), reverse=True)
+        cooling = sorted(
+            (m for m in members if not self.is_available(m)),
+            key=lambda m: self._member_stats(m)["cooldown_until"]
+        )
+        return available + cooling
+    
+    def record_result(self, member: Dict, success: bool, response_time_ms: float, error: str = None):
+        """记录调用结果；连续失败的端点进入冷却，冷却时间按2倍递增"""
+        stats = self._member_stats(member)
+        stats["request_count"] += 1
+        stats["total_response_time"] += response_time_ms
+        if success:
+            stats["success_count"] += 1
+            stats["consecutive_failures"] = 0
+            stats["cooldown_until"] = 0
+        else:
+            stats["fail_count"] += 1
+            stats["consecutive_failures"] += 1
+            stats["last_error"] = (error or "")[:200]
+            factor = min(2 ** (stats["consecutive_failures"] - 1), MAX_COOLDOWN_FACTOR)
+            stats["cooldown_until"] = time.time() + settings.embedding_pool_cooldown * factor
+    
+    def get_member_stats(self, member: Dict) -> Dict:
+        stats = self._member_stats(member)
+        total = stats["success_count"] + stats["fail_count"]
+        return {
+            "request_count": stats["request_count"],
+            "success_count": stats["success_count"],
+            "fail_count": stats["fail_count"],
+            "success_rate": round(stats["success_count"] / total * 100, 1) if total > 0 else 0,
+            "avg_response_time": round(stats["total_response_time"] / total, 2) if total > 0 else 0,
+            "consecutive_failures": stats["consecutive_failures"],
+            "cooldown_seconds": max(0, round(stats["cooldown_until"] - time.time(), 1)),
+            "last_error": stats["last_error"]
+        }
+    
+    def reset_stats(self):
+        self._stats.clear()
+    
+    def get_dimension(self, model: str) -> Optional[int]:
+        return self._dimensions.get(model)
+    
+    def check_dimension(self, model: str, dimension: int):
+        """校验向量维度与该模型已记录的维度一致，首次调用时记录"""
+        expected = self._dimensions.setdefault(model, dimension)
+        if dimension != expected:
+            raise ValueError(f"向量维度不一致: {model} 应为 {expected}，实际为 {dimension}")
+    
+    async def test_member(self, member: Dict, model: str) -> Dict:
+        """用池的模型测试端点：连接、延迟，以及向量维度是否与池一致（结果计入端点统计）"""
+        provider = OpenAIEmbeddingProvider(member.get("base_url"), member.get("api_key"), model, max_retries=0)
+        start = time.time()
+        try:
+            vectors = await provider.embed_batch(["测试连接"])
+            self.check_dimension(model, len(vectors[0]))
+        except Exception as e:
+            elapsed = (time.time() - start) * 1000
+            self.record_result(member, False, elapsed, str(e))
+            return {"success": False, "message": f"测试失败: {str(e)[:200]}", "response_time": round(elapsed, 2)}
+        elapsed = (time.time() - start) * 1000
+        self.record_result(member, True, elapsed)
+        return {
+            "success": True,
+            "message": f"连接成功，{model} 向量维度: {len(vectors[0])}",
+            "dimension": len(vectors[0]),
+            "response_time": round(elapsed, 2)
+        }
+
+
+class PooledEmbeddingProvider(EmbeddingProvider):
+    """按向量化服务池的顺序逐个尝试端点，直到成功"""
+    
+    name = "pool"
+    
+    def __init__(self, pool: EmbeddingPoolService, members: List[Dict], model: str):
+        self.pool = pool
+        self.members = members
+        self.model = model
+        # 不使用客户端内置重试，失败立即切换到下一个端点
+        self._providers = {
+            pool.endpoint_key(m): OpenAIEmbeddingProvider(m["base_url"], m["api_key"], model, max_retries=0)
+            for m in members
+        }
+    
+    @property
+    def batch_key(self):
+        return (self.name, self.model) + tuple(sorted(self._providers))
+    
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        last_error = None
+        for member in self.pool.failover_order(self.members):
+            start = time.time()
+            try:
+                vectors = await self._providers[self.pool.endpoint_key(member)].embed_batch(texts)
+                self.pool.check_dimension(self.model, len(vectors[0]))
+            except Exception as e:
+                last_error = e
+                self.pool.record_result(member, False, (time.time() - start) * 1000, str(e))
+                print(f"[EmbeddingPool] {member.get('name')} failed, trying next: {e}")
+                continue
+            self.pool.record_result(member, True, (time.time() - start) * 1000)
+            return vectors
+        raise last_error or ValueError("向量化服务池没有可用端点")
@@ -0,0 +1,154 @@
+from openai import AsyncOpenAI
+from config import get_settings
+from collections import Counter
+from functools import lru_cache
+from typing import List
+import asyncio
+import math
+import re
+import zlib
+import jieba
+import numpy as np
+from .lexical_index import tokenize, init_jieba
+from .llm_pool_service import LLMPoolService
+
+settings = get_settings()
+
+LOCAL_THREAD_THRESHOLD = 8  # 本地向量化超过该条数时放到线程中计算，避免阻塞事件循环
+NGRAM_WEIGHT = 0.5  # 汉字n-gram特征相对词特征的权重
+_HAN_RE = re.compile(r"[一-鿿]+")
+
+
+class EmbeddingProvider:
+    """向量化后端接口
+    
+    model 为写入向量头部的模型名（变化后后台任务会重新生成向量）；
+    embed_batch 返回与输入等长、顺序一致的向量列表。
+    batch_key 相同的实例可以合并请求（见 EmbeddingBatcher），None 表示不合批。
+    """
+    
+    name = ""
+    model = ""
+    
+    @property
+    def batch_key(self):
+        return None
+    
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAI兼容的 /embeddings 接口（硅基流动等）"""
+    
+    name = "openai"
+    
+    def __init__(self, base_url: str = None, api_key: str = None, model: str = None, max_retries: int = None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model or "BAAI/bge-m3"
+        self.max_retries = max_retries  # None为客户端默认重试次数
+    
+    @property
+    def batch_key(self):
+        return (self.name, self.base_url, self.api_key, self.model)
+    
+    @property
+    def client(self) -> AsyncOpenAI:
+        """共享的端点客户端（与LLM调用共用连接池，不在实例上缓存，以便空闲客户端被回收）"""
+        if not self.base_url or not self.api_key:
+            raise ValueError("Embedding API未配置，请在API设置中配置向量化服务")
+        return LLMPoolService.get_client(self.base_url, self.api_key, self.max_retries)
+    
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = await self.client.embeddings.create(
+            model=self.model,
+            input=texts
+        )
+        return [item.embedding for item in response.data]
+
+
+@lru_cache(maxsize=200000)
+def _feature_hash(feature: str) -> int:
+    """稳定的特征哈希（不受PYTHONHASHSEED影响）"""
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+@lru_cache(maxsize=None)
+def _local_tokenizer() -> jieba.Tokenizer:
+    """本地向量化专用的分词器：只用jieba默认词典，不受 load_user_terms 加入的领域词影响，
+    同一文本在知识库编辑或重启后仍得到相同的向量（已存储的向量按内容哈希不会重新生成）"""
+    return jieba.Tokenizer()
+
+
+@lru_cache(maxsize=None)
+def _dictionary_tag() -> str:
+    """jieba版本和默认词典的校验值，写入模型名：分词结果可能变化时旧向量会被重新生成"""
+    with _local_tokenizer().get_dict_file() as f:
+        return f"jieba{jieba.__version__}-{zlib.crc32(f.read()):08x}"
+
+
+@lru_cache(maxsize=200000)
+def _idf(term: str) -> float:
+    """以默认词典词频近似的逆文档频率；词典外的词视为罕见词。专用分词器的词典不会被修改，IDF固定不变"""
+    tokenizer = _local_tokenizer()
+    tokenizer.check_initialized()
+    return math.log((tokenizer.total + 1) / (tokenizer.FREQ.get(term, 0) + 1))
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """离线哈希向量化：jieba词 + 汉字2/3-gram，按IDF加权后哈希到固定维度（NumPy计算，无网络调用）
+    
+    词频取 1+log(tf)，IDF取自jieba默认词典词频；特征哈希带符号以抵消碰撞偏差，结果L2归一化。
+    分词使用独立于检索的分词器和固定的词典，模型名带有词典标识，词典变化时向量会重新生成。
+    语义能力弱于神经网络模型，但与BM25互补（n-gram可匹配分词不一致的写法），适合离线评测和无API部署。
+    """
+    
+    name = "local"
+    
+    def __init__(self, dim: int = None):
+        self.dim = dim or settings.local_embedding_dim
+        self.model = f"local-hash-{self.dim}-{_dictionary_tag()}"
+    
+    def _features(self, text: str) -> Counter:
+        features = Counter()
+        for term, tf in Counter(tokenize(text, _local_tokenizer())).items():
+            features[term] += (1 + math.log(tf)) * _idf(term)
+        grams = Counter()
+        for run in _HAN_RE.findall(text.lower()):
+            for n in (2, 3):
+                for i in range(len(run) - n + 1):
+                    grams[run[i:i + n]] += 1
+        for gram, tf in grams.items():
+            # n-gram使用独立的哈希空间，避免与同形的词特征叠加
+            features["\x01" + gram] += NGRAM_WEIGHT * (1 + math.log(tf)) * _idf(gram)
+        return features
+    
+    def vectorize(self, texts: List[str]) -> np.ndarray:
+        """同步计算 (len(texts), dim) 的归一化向量矩阵"""
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self._features(text or "")
+            if not features:
+                continue
+            hashes = np.fromiter((_feature_hash(f) for f in features), dtype=np.uint32, count=len(features))
+            weights = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+            signs = np.where((hashes >> 31) & 1, -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix[row], (hashes % self.dim).astype(np.int64), weights * signs)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+    
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        tokenizer = _local_tokenizer()
+        if not tokenizer.initialized:
+            # 首次调用时加载词典（约1秒），放到线程中执行
+            await asyncio.to_thread(init_jieba, settings.jieba_cache_file, tokenizer)
+        if len(texts) > LOCAL_THREAD_THRESHOLD:
+            matrix = await asyncio.to_thread(self.vectorize, texts)
+        else:
+            matrix = self.vectorize(texts)
+        return [row.tolist() for row in matrix]
+
+
+PROVIDERS = ("openai", "local")
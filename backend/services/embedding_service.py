@@ -1,19 +1,200 @@
-from openai import AsyncOpenAI
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from database.models import SystemConfig
-from typing import List, Optional
+from config import get_settings
+from collections import Counter, OrderedDict
+from typing import Hashable, List, Optional, Dict, Set, Tuple
+import asyncio
 import numpy as np
+import time
+import unicodedata
+from .embedding_providers import EmbeddingProvider, OpenAIEmbeddingProvider, LocalEmbeddingProvider
+from .embedding_pool_service import EmbeddingPoolService, PooledEmbeddingProvider
+
+settings = get_settings()
+
+
+class EmbeddingCache:
+    """查询向量的LRU+TTL缓存，键为 (model, 规范化文本)，进程内共享"""
+    
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # 超出容量被淘汰
+        self.expirations = 0  # 超过TTL被淘汰
+    
+    def get(self, key: Tuple[str, str]) -> Optional[np.ndarray]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, vector = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return vector
+    
+    def set(self, key: Tuple[str, str], vector: np.ndarray):
+        self._data[key] = (time.monotonic() + self.ttl, vector)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        self._data.clear()
+    
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get_stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / total * 100, 1) if total > 0 else 0
+        }
+
+
+def _size_bucket(size: int) -> str:
+    """批大小直方图的分桶：1, 2, 3-4, 5-8, 9-16 ..."""
+    if size <= 2:
+        return str(size)
+    upper = 1 << (size - 1).bit_length()
+    return f"{upper // 2 + 1}-{upper}"
+
+
+class EmbeddingBatcher:
+    """查询向量合批器，进程内共享
+    
+    并发的 embed 请求按后端配置（provider.batch_key）分组，在 window_ms 内或凑满 max_batch 条后
+    合并为一次 embed_batch 调用，再把向量分发给各个等待者；同一批内的相同文本只请求一次。
+    batch_key 为 None 的后端（本地向量化）不合批。
+    """
+    
+    def __init__(self, window_ms: float = 5.0, max_batch: int = 32):
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self._pending: Dict[Hashable, List[Tuple[str, asyncio.Future]]] = {}
+        self._providers: Dict[Hashable, EmbeddingProvider] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.reset_stats()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.window_ms > 0 and self.max_batch > 1
+    
+    async def embed(self, provider: EmbeddingProvider, text: str) -> List[float]:
+        key = provider.batch_key
+        if not self.enabled or key is None:
+            return (await provider.embed_batch([text]))[0]
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        if not pending:
+            self._providers[key] = provider
+            self._timers[key] = loop.call_later(self.window_ms / 1000, self._flush, key)
+        pending.append((text, future))
+        self.requests += 1
+        if len(pending) >= self.max_batch:
+            self._flush(key)
+        return await future
+    
+    def _flush(self, key: Hashable):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        items = self._pending.pop(key, None)
+        provider = self._providers.pop(key, None)
+        if not items:
+            return
+        # 持有任务引用，避免发送中的批次被垃圾回收
+        task = asyncio.ensure_future(self._send(provider, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _send(self, provider: EmbeddingProvider, items: List[Tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in items))
+        self.batches += 1
+        self.deduplicated += len(items) - len(texts)
+        self.histogram[_size_bucket(len(texts))] += 1
+        self.max_seen = max(self.max_seen, len(texts))
+        try:
+            vectors = await provider.embed_batch(texts)
+        except Exception as e:
+            self.failures += 1
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        by_text = dict(zip(texts, vectors))
+        for text, future in items:
+            # 调用方可能已超时取消
+            if not future.done():
+                future.set_result(by_text[text])
+    
+    def reset_stats(self):
+        self.requests = 0
+        self.batches = 0
+        self.deduplicated = 0
+        self.failures = 0
+        self.max_seen = 0
+        self.histogram: Counter = Counter()
+    
+    def get_stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "window_ms": self.window_ms,
+            "max_batch": self.max_batch,
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0,
+            "max_batch_size": self.max_seen,
+            "deduplicated": self.deduplicated,
+            "failures": self.failures,
+            "pending": sum(len(items) for items in self._pending.values()),
+            "histogram": dict(sorted(self.histogram.items(), key=lambda item: int(item[0].split("-")[0])))
+        }
 
 
 class EmbeddingService:
-    """向量化服务，使用硅基流动或其他OpenAI兼容的embedding API"""
+    """向量化服务：远程OpenAI兼容的embedding API（硅基流动等），或本地离线哈希向量化（见 embedding_providers）"""
+    
+    # 查询向量缓存，所有实例共享
+    query_cache = EmbeddingCache(
+        max_size=settings.embedding_cache_size,
+        ttl=settings.embedding_cache_ttl
+    )
     
-    def __init__(self, base_url: str = None, api_key: str = None, model: str = None):
-        self.base_url = base_url
-        self.api_key = api_key
-        self.model = model or "BAAI/bge-m3"
-        self._client = None
+    # 并发查询向量请求的合批器，所有实例共享
+    batcher = EmbeddingBatcher(
+        window_ms=settings.embedding_coalesce_window_ms,
+        max_batch=settings.embedding_coalesce_max_batch
+    )
+    
+    def __init__(self, base_url: str = None, api_key: str = None, model: str = None, provider: EmbeddingProvider = None):
+        self.provider = provider or OpenAIEmbeddingProvider(base_url=base_url, api_key=api_key, model=model)
+    
+    @property
+    def model(self) -> str:
+        return self.provider.model
     
     @classmethod
     async def from_db(cls, db: AsyncSession) -> "EmbeddingService":
@@ -25,6 +206,10 @@ class EmbeddingService:
             config = result.scalar_one_or_none()
             return config.value if config else None
         
+        provider = await get_config("embedding_provider") or settings.embedding_provider
+        if provider == "local":
+            return cls(provider=LocalEmbeddingProvider())
+        
         base_url = await get_config("embedding_base_url")
         api_key = await get_config("embedding_api_key")
         model = await get_config("embedding_model")
@@ -35,37 +220,44 @@ class EmbeddingService:
         if not api_key:
             api_key = await get_config("llm_api_key")
         
+        # 向量化服务池中有启用的端点时，与主API一起按权重分担并失败切换
+        pool = await EmbeddingPoolService.get_instance()
+        if not pool.loaded:
+            await pool.load_from_db(db)
+        members = pool.get_enabled_members()
+        if members:
+            if base_url and api_key:
+                members = members + [{"name": "主API", "base_url": base_url, "api_key": api_key, "weight": 1}]
+            return cls(provider=PooledEmbeddingProvider(pool, members, model or "BAAI/bge-m3"))
+        
         return cls(base_url=base_url, api_key=api_key, model=model)
     
-    @property
-    def client(self) -> AsyncOpenAI:
-        if self._client is None:
-            if not self.base_url or not self.api_key:
-                raise ValueError("Embedding API未配置，请在API设置中配置向量化服务")
-            self._client = AsyncOpenAI(
-                base_url=self.base_url,
-                api_key=self.api_key
-            )
-        return self._client
-    
     async def embed(self, text: str) -> List[float]:
-        """将单个文本转换为向量"""
-        response = await self.client.embeddings.create(
-            model=self.model,
-            input=text
-        )
-        return response.data[0].embedding
+        """将单个文本转换为向量（与其他并发请求合批发送）"""
+        return await self.batcher.embed(self.provider, text)
+    
+    @staticmethod
+    def normalize_query(text: str) -> str:
+        """规范化查询文本（全半角、大小写、空白）作为缓存键"""
+        return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+    
+    async def embed_query(self, text: str) -> np.ndarray:
+        """将检索查询转换为向量，优先使用共享缓存"""
+        key = (self.model, self.normalize_query(text))
+        vector = self.query_cache.get(key)
+        if vector is not None:
+            return vector
+        
+        vector = np.asarray(await self.embed(text), dtype=np.float32)
+        vector.flags.writeable = False
+        self.query_cache.set(key, vector)
+        return vector
     
     async def embed_batch(self, texts: List[str]) -> List[List[float]]:
         """批量将文本转换为向量"""
         if not texts:
             return []
-        
-        response = await self.client.embeddings.create(
-            model=self.model,
-            input=texts
-        )
-        return [item.embedding for item in response.data]
+        return await self.provider.embed_batch(texts)
     
     @staticmethod
     def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
@@ -0,0 +1,394 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update, bindparam
+from database import AsyncSessionLocal
+from database.models import KnowledgeBase, KnowledgeChunk, SystemConfig
+from database.embedding_codec import pack_embedding
+from config import get_settings
+from typing import List, Dict, Optional, Iterable, Set
+import asyncio
+import json
+import time
+from .embedding_service import EmbeddingService
+from .knowledge_index import KnowledgeIndex, partition_of
+from .lexical_index import LexicalIndex
+from .chunking import build_embed_text, content_hash, sync_chunks
+
+settings = get_settings()
+
+JOB_STATE_KEY = "knowledge_rebuild_job"
+
+# 按主键批量写入向量；段落可能在批次进行中被重新分段删除，不存在的行直接跳过
+_UPDATE_CHUNK = (
+    update(KnowledgeChunk.__table__)
+    .where(KnowledgeChunk.__table__.c.id == bindparam("_id"))
+    .values(embedding=bindparam("embedding"), embedding_hash=bindparam("embedding_hash"), embedding_model=bindparam("embedding_model"))
+)
+_UPDATE_ENTRY = (
+    update(KnowledgeBase.__table__)
+    .where(KnowledgeBase.__table__.c.id == bindparam("_id"))
+    .values(embedding=bindparam("embedding"), embedding_hash=bindparam("embedding_hash"), embedding_model=bindparam("embedding_model"))
+)
+
+
+class EmbeddingWorker:
+    """知识库向量后台任务：分批、并发调用embed_batch，每批提交，可取消、可断点续跑
+    
+    向量化的单位是段落。全量重建和单条编辑共用同一套流程：只对哈希或模型发生变化的段落重新生成向量；
+    首段向量同时写回条目的embedding列。
+    """
+    
+    _instance = None
+    _lock = asyncio.Lock()
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_requested = False
+        self._full = False  # 当前任务是否为全量重建
+        self._rebuild_pending = False  # 增量任务运行中收到的全量重建请求，增量任务结束后开始
+        self.batch_size = settings.embedding_batch_size
+        self.concurrency = settings.embedding_concurrency
+        self.queue_delay = 0.5  # 增量队列的合并等待时间(秒)
+        self.retry_delay = 30.0  # 增量更新失败后首次重试的等待时间(秒)，之后每次翻倍
+        self.max_retry_delay = 600.0  # 重试等待时间上限(秒)
+        self.max_attempts = 5  # 条目连续失败的次数上限，达到后不再重试（之后的全量重建会按哈希补齐）
+        self._attempts: Dict[int, int] = {}  # 条目ID -> 连续失败次数
+        self._queue: Set[int] = set()  # 待增量更新的条目ID
+        self.progress: Dict = self._new_progress()
+    
+    @classmethod
+    async def get_instance(cls) -> "EmbeddingWorker":
+        """获取单例实例"""
+        if cls._instance is None:
+            async with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+    
+    @staticmethod
+    def _new_progress() -> Dict:
+        return {
+            "running": False,
+            "current": 0,
+            "total": 0,
+            "embedded": 0,
+            "skipped": 0,
+            "failed": 0,
+            "batches_done": 0,
+            "batches_total": 0,
+            "last_batch_ms": 0,
+            "throughput": 0,  # 条/秒
+            "eta_seconds": None,
+            "started_at": None,
+            "message": ""
+        }
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def get_progress(self) -> Dict:
+        progress = dict(self.progress)
+        progress["queued"] = len(self._queue)
+        progress["rebuild_pending"] = self._rebuild_pending
+        return progress
+    
+    def _start(self, full: bool):
+        self._cancel_requested = False
+        self._full = full
+        self.progress = self._new_progress()
+        self.progress["running"] = True
+        self.progress["started_at"] = time.time()
+        self.progress["message"] = "正在初始化..." if full else "增量更新中..."
+        self._task = asyncio.create_task(self._run(full))
+    
+    async def start_rebuild(self, force: bool = False) -> bool:
+        """启动后台重建；已有全量重建运行或等待时返回False，增量任务运行时在其结束后开始"""
+        if self.running and (self._full or self._rebuild_pending):
+            return False
+        async with AsyncSessionLocal() as db:
+            # 分段参数可能已修改，先按当前参数重新分段（未变化的段落保留向量）
+            await self._rechunk(db)
+            if force:
+                # 清空哈希即可强制重建，同时保证中途重启后能从断点继续
+                await db.execute(update(KnowledgeChunk).values(embedding_hash=None))
+            await self._save_state(db, {"running": True, "force": force, "started_at": time.time()})
+        
+        if self.running:
+            # 增量任务只处理少量条目，结束后由全量重建接管剩余队列
+            self._rebuild_pending = True
+            self.progress["message"] = "增量更新结束后开始重建..."
+        else:
+            self._start(full=True)
+        return True
+    
+    def enqueue(self, kb_ids: Iterable[int]):
+        """将条目加入增量队列，后台只为哈希或模型变化的条目重新生成向量"""
+        kb_ids = set(kb_ids)
+        for kb_id in kb_ids:
+            self._attempts.pop(kb_id, None)  # 重新编辑过的条目重新计算失败次数
+        self._queue.update(kb_ids)
+        if self._queue and not self.running:
+            self._start(full=False)
+    
+    async def join(self):
+        """等待后台任务（包括其间加入的增量队列）全部完成，供命令行导入等一次性脚本使用"""
+        while self.running:
+            await asyncio.wait({self._task})
+    
+    def cancel(self) -> bool:
+        """请求取消，正在进行的批次完成后停止"""
+        if not self.running:
+            return False
+        self._cancel_requested = True
+        self.progress["message"] = "正在取消..."
+        return True
+    
+    async def ensure_chunks(self):
+        """启动时为还没有段落的条目分段（升级前的旧数据），并在后台补齐向量"""
+        async with AsyncSessionLocal() as db:
+            changed = await sync_chunks(db, missing_only=True)
+        if changed:
+            print(f"[EmbeddingWorker] Split {len(changed)} knowledge entries into passages")
+            await self._invalidate_indexes()
+            self.enqueue(changed)
+    
+    async def _rechunk(self, db: AsyncSession):
+        changed = await sync_chunks(db)
+        if changed:
+            print(f"[EmbeddingWorker] Re-chunked {len(changed)} knowledge entries")
+            await self._invalidate_indexes()
+    
+    @staticmethod
+    async def _invalidate_indexes():
+        for index in KnowledgeIndex.all_instances() + LexicalIndex.all_instances():
+            index.invalidate()
+    
+    async def resume_if_needed(self):
+        """启动时检查上次未完成的重建任务并继续"""
+        async with AsyncSessionLocal() as db:
+            state = await self._load_state(db)
+        if state.get("running"):
+            print("[EmbeddingWorker] Resuming unfinished rebuild job")
+            await self.start_rebuild(force=False)
+    
+    async def shutdown(self):
+        """进程退出时停止任务，保留断点状态以便下次启动继续"""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def _load_state(self, db: AsyncSession) -> Dict:
+        result = await db.execute(
+            select(SystemConfig).where(SystemConfig.key == JOB_STATE_KEY)
+        )
+        config = result.scalar_one_or_none()
+        if config and config.value:
+            try:
+                return json.loads(config.value)
+            except json.JSONDecodeError:
+                pass
+        return {}
+    
+    async def _save_state(self, db: AsyncSession, state: Dict):
+        result = await db.execute(
+            select(SystemConfig).where(SystemConfig.key == JOB_STATE_KEY)
+        )
+        config = result.scalar_one_or_none()
+        if config:
+            config.value = json.dumps(state)
+        else:
+            db.add(SystemConfig(key=JOB_STATE_KEY, value=json.dumps(state), description="知识库向量重建任务状态"))
+        await db.commit()
+    
+    async def _collect_pending(self, db: AsyncSession, model: str, kb_ids: Optional[Set[int]] = None) -> List[Dict]:
+        """找出需要（重新）生成向量的段落，哈希和模型都未变化的跳过"""
+        query = select(
+            KnowledgeChunk.id,
+            KnowledgeChunk.kb_id,
+            KnowledgeChunk.chunk_index,
+            KnowledgeBase.title,
+            KnowledgeChunk.content,
+            KnowledgeChunk.embedding_hash,
+            KnowledgeChunk.embedding_model,
+            KnowledgeChunk.embedding.isnot(None)
+        ).join(KnowledgeBase, KnowledgeBase.id == KnowledgeChunk.kb_id).where(KnowledgeBase.is_active == True)
+        if kb_ids is not None:
+            query = query.where(KnowledgeChunk.kb_id.in_(kb_ids))
+        result = await db.execute(query)
+        pending = []
+        total = 0
+        for chunk_id, kb_id, chunk_index, title, content, old_hash, old_model, has_embedding in result.all():
+            total += 1
+            text = build_embed_text(title, content)
+            text_hash = content_hash(text)
+            if has_embedding and old_hash == text_hash and old_model == model:
+                continue
+            pending.append({"id": chunk_id, "kb_id": kb_id, "index": chunk_index, "text": text, "hash": text_hash})
+        self.progress["total"] += total
+        self.progress["skipped"] += total - len(pending)
+        self.progress["current"] += total - len(pending)
+        return pending
+    
+    async def _run(self, full: bool = True):
+        cancelled = False
+        failed = False
+        interrupted = False
+        taken: Set[int] = set()  # 正在处理的增量条目
+        try:
+            async with AsyncSessionLocal() as db:
+                embed_service = await EmbeddingService.from_db(db)
+                if full:
+                    await self._embed_pending(db, embed_service)
+                    cancelled = self._cancel_requested
+                    await self._save_state(db, {"running": False, "cancelled": cancelled, "finished_at": time.time()})
+                
+                # 处理增量队列（包括全量重建期间新加入的条目）；有等待中的全量重建时交给重建处理
+                while self._queue and not self._cancel_requested and not self._rebuild_pending:
+                    await asyncio.sleep(self.queue_delay)  # 合并短时间内的连续编辑
+                    taken = set(self._queue)
+                    self._queue.clear()
+                    failed_ids = await self._embed_pending(db, embed_service, taken)
+                    for kb_id in taken - failed_ids:
+                        self._attempts.pop(kb_id, None)
+                    taken = set()
+                    if failed_ids:
+                        self._requeue(failed_ids)
+                        failed = True
+                        break
+                cancelled = cancelled or self._cancel_requested
+                if cancelled and self._rebuild_pending:
+                    # 等待中的全量重建一并取消
+                    self._rebuild_pending = False
+                    await self._save_state(db, {"running": False, "cancelled": True, "finished_at": time.time()})
+            
+            self.progress["message"] = "已取消" if cancelled else "完成"
+            print(f"[EmbeddingWorker] {'Rebuild' if full else 'Incremental update'} {self.progress['message']}: "
+                  f"embedded={self.progress['embedded']}, skipped={self.progress['skipped']}, failed={self.progress['failed']}")
+        except asyncio.CancelledError:
+            # 进程退出：保留running状态，下次启动时继续
+            interrupted = True
+            self.progress["message"] = "已中断，重启后继续"
+            raise
+        except Exception as e:
+            import traceback
+            print(f"[EmbeddingWorker] Rebuild error: {e}")
+            print(traceback.format_exc())
+            self.progress["message"] = f"失败: {e}"
+            self._requeue(taken | self._queue)
+            failed = True
+        finally:
+            self.progress["running"] = False
+            self.progress["eta_seconds"] = None
+            if not interrupted:
+                if failed:
+                    # 出错后按失败次数指数退避再重试队列中的条目，避免持续失败时反复调用接口
+                    if self._queue or self._rebuild_pending:
+                        asyncio.get_running_loop().call_later(self._retry_delay(), self._start_pending)
+                else:
+                    self._start_pending()
+    
+    def _requeue(self, kb_ids: Set[int]):
+        """失败的条目放回队列；连续失败 max_attempts 次的条目放弃，等之后的全量重建按哈希补齐"""
+        dropped = []
+        for kb_id in kb_ids:
+            attempts = self._attempts.get(kb_id, 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(kb_id, None)
+                self._queue.discard(kb_id)
+                dropped.append(kb_id)
+            else:
+                self._attempts[kb_id] = attempts
+                self._queue.add(kb_id)
+        if dropped:
+            print(f"[EmbeddingWorker] Giving up on {len(dropped)} knowledge entries after {self.max_attempts} failed attempts")
+    
+    def _retry_delay(self) -> float:
+        """按队列中条目最少的失败次数计算退避时间"""
+        attempts = min((self._attempts.get(kb_id, 1) for kb_id in self._queue), default=1)
+        return min(self.retry_delay * 2 ** (max(attempts, 1) - 1), self.max_retry_delay)
+    
+    def _start_pending(self):
+        """任务结束后启动等待中的全量重建或剩余的增量队列（包括任务收尾期间加入的条目）"""
+        if self.running and self._task is not asyncio.current_task():
+            return
+        if self._rebuild_pending:
+            self._rebuild_pending = False
+            self._start(full=True)
+        elif self._queue and not self._cancel_requested:
+            self._start(full=False)
+    
+    async def _embed_pending(self, db: AsyncSession, embed_service: EmbeddingService, kb_ids: Optional[Set[int]] = None) -> Set[int]:
+        """对需要更新的段落分批并发生成向量，每批提交一次；返回生成向量失败的条目ID"""
+        pending = await self._collect_pending(db, embed_service.model, kb_ids)
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        self.progress["batches_total"] += len(batches)
+        
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+        write_lock = asyncio.Lock()
+        failed_ids: Set[int] = set()
+        
+        async def process(batch: List[Dict]):
+            async with semaphore:
+                if self._cancel_requested:
+                    return
+                start = time.time()
+                try:
+                    vectors = await embed_service.embed_batch([item["text"] for item in batch])
+                except Exception as e:
+                    print(f"[EmbeddingWorker] Batch failed ({len(batch)} items): {e}")
+                    self.progress["failed"] += len(batch)
+                    self.progress["current"] += len(batch)
+                    failed_ids.update(item["kb_id"] for item in batch)
+                    return
+                
+                async with write_lock:
+                    rows = [
+                        {
+                            "_id": item["id"],
+                            "embedding": pack_embedding(vector, embed_service.model),
+                            "embedding_hash": item["hash"],
+                            "embedding_model": embed_service.model
+                        }
+                        for item, vector in zip(batch, vectors)
+                    ]
+                    await db.execute(_UPDATE_CHUNK, rows)
+                    heads = [dict(row, _id=item["kb_id"]) for item, row in zip(batch, rows) if item["index"] == 0]
+                    if heads:
+                        await db.execute(_UPDATE_ENTRY, heads)
+                    await db.commit()
+                    
+                    # 只把仍然存在且启用的段落写入所属分区的索引（批次进行中条目可能被编辑、停用或改变所属bot）
+                    result = await db.execute(
+                        select(KnowledgeChunk.id, KnowledgeBase.bot_id)
+                        .join(KnowledgeBase, KnowledgeBase.id == KnowledgeChunk.kb_id)
+                        .where(KnowledgeChunk.id.in_([item["id"] for item in batch]), KnowledgeBase.is_active == True)
+                    )
+                    alive = {chunk_id: partition_of(bot_id) for chunk_id, bot_id in result.all()}
+                    by_partition: Dict[str, List] = {}
+                    for item, vector in zip(batch, vectors):
+                        if item["id"] in alive:
+                            by_partition.setdefault(alive[item["id"]], []).append((item["id"], item["kb_id"], vector))
+                    for partition, items in by_partition.items():
+                        (await KnowledgeIndex.get_instance(partition)).upsert_many(items, embed_service.model)
+                
+                self._record_batch(len(batch), time.time() - start)
+        
+        await asyncio.gather(*(process(batch) for batch in batches))
+        return failed_ids
+    
+    def _record_batch(self, size: int, elapsed: float):
+        """更新批次吞吐量和预计剩余时间"""
+        p = self.progress
+        p["embedded"] += size
+        p["current"] += size
+        p["batches_done"] += 1
+        p["last_batch_ms"] = round(elapsed * 1000, 2)
+        run_time = time.time() - p["started_at"]
+        if run_time > 0:
+            p["throughput"] = round(p["embedded"] / run_time, 2)
+        remaining = p["total"] - p["current"]
+        p["eta_seconds"] = round(remaining / p["throughput"], 1) if p["throughput"] > 0 else None
+        p["message"] = f"批次 {p['batches_done']}/{p['batches_total']}"
@@ -0,0 +1,75 @@
+from collections import deque
+from typing import Dict, Optional
+
+HEDGE_MIN_SAMPLES = 20  # 首字延迟样本不足时不对冲（分位数不可靠）
+HEDGE_WINDOW = 200  # 首字延迟样本数和对冲比例的统计窗口（最近的流式请求数）
+
+
+class HedgePolicy:
+    """慢首字对冲请求的策略和统计
+    
+    流式请求在最近首字延迟的 quantile 分位数内仍未收到首个片段时，向另一个模型发起同样的请求，
+    先产出内容的一方胜出，另一方取消。最近 HEDGE_WINDOW 个请求中发起对冲的比例不超过 max_rate；
+    被取消的请求已消耗的token（提示词及已收到的片段）计为浪费。
+    """
+    
+    def __init__(self, enabled: bool = False, quantile: float = 0.9, max_rate: float = 0.1):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.max_rate = max_rate
+        self._ttfts = deque(maxlen=HEDGE_WINDOW)  # 最近的首字延迟(毫秒)
+        self._recent = deque(maxlen=HEDGE_WINDOW)  # 最近的流式请求是否发起了对冲
+        self._recent_hedged = 0
+        self.reset_stats()
+    
+    def record_ttft(self, ttft_ms: float):
+        self._ttfts.append(ttft_ms)
+    
+    def delay_ms(self) -> Optional[float]:
+        """发起对冲前等待首字的时间；未启用或样本不足时为None"""
+        if not self.enabled or len(self._ttfts) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._ttfts)
+        return samples[min(len(samples) - 1, int(self.quantile * len(samples)))]
+    
+    def allow(self) -> bool:
+        """最近的对冲比例是否仍低于上限（上限为1时不限制）"""
+        if self.max_rate >= 1:
+            return True
+        return self.max_rate > 0 and (not self._recent or self._recent_hedged / len(self._recent) < self.max_rate)
+    
+    def record_request(self, hedged: bool):
+        if len(self._recent) == self._recent.maxlen and self._recent[0]:
+            self._recent_hedged -= 1
+        self._recent.append(hedged)
+        self._recent_hedged += hedged
+        self.requests += 1
+        self.hedged += hedged
+    
+    def record_outcome(self, backup_won: bool, wasted_tokens: int):
+        self.backup_wins += backup_won
+        self.wasted_tokens += wasted_tokens
+    
+    def reset_stats(self):
+        self._ttfts.clear()
+        self._recent.clear()
+        self._recent_hedged = 0
+        self.requests = 0  # 等待首字时可以对冲的流式请求数
+        self.hedged = 0  # 发起了对冲的请求数
+        self.backup_wins = 0  # 对冲请求先产出内容的次数
+        self.wasted_tokens = 0  # 被取消请求消耗的token（估算）
+    
+    def get_stats(self) -> Dict:
+        delay = self.delay_ms()
+        return {
+            "enabled": self.enabled,
+            "quantile": self.quantile,
+            "max_rate": self.max_rate,
+            "delay_ms": round(delay, 2) if delay is not None else None,
+            "samples": len(self._ttfts),
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.requests * 100, 1) if self.requests > 0 else 0,
+            "backup_wins": self.backup_wins,
+            "wasted_tokens": self.wasted_tokens
+        }
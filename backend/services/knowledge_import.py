@@ -0,0 +1,155 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional
+from collections import defaultdict
+from config import get_settings
+from .knowledge_service import KnowledgeService
+import codecs
+import re
+import time
+
+settings = get_settings()
+
+# 章节分隔行：=== 分隔大块，--- 分隔小块（允许行尾空白）
+SEPARATOR_RE = re.compile(r"^\s*(?:={3,}|-{3,})\s*$")
+HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*$")
+LIST_MARKER_RE = re.compile(r"^\s*(?:[-*+]\s+)")
+KEY_PART_LENGTH = 60  # 章节键中每一级标题的最大长度
+TITLE_LENGTH = 100
+
+
+def _clip(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length]
+
+
+class SectionParser:
+    """逐行解析ALL.txt格式的知识文档
+    
+    文档以 === / --- 行分隔章节；"# [分组]" 一级标题标记分组（作为分类，不计入正文），
+    "## 标题" 二级标题作为其后无标题小节的上下文；``` 代码块中的 # 行不视为标题。
+    每个章节生成稳定的章节键：来源::分组 / 二级标题 / 章节标题，同名章节按出现顺序追加 #n。
+    正文修改不影响章节键，重新导入时据此更新原条目。
+    """
+    
+    def __init__(self, source: str):
+        self.source = _clip(source, KEY_PART_LENGTH)
+        self.group = ""  # 最近的一级标题
+        self.heading = ""  # 最近的二级标题
+        self._lines: List[str] = []
+        self._seen: Dict[str, int] = defaultdict(int)
+    
+    def feed(self, line: str) -> Optional[Dict]:
+        """输入一行，遇到分隔行时返回上一个章节"""
+        if SEPARATOR_RE.match(line):
+            return self._flush()
+        self._lines.append(line.rstrip("\r\n"))
+        return None
+    
+    def close(self) -> Optional[Dict]:
+        """文档结束，返回最后一个章节"""
+        return self._flush()
+    
+    def _flush(self) -> Optional[Dict]:
+        lines, self._lines = self._lines, []
+        body = []
+        title = None
+        in_code = False
+        for line in lines:
+            if line.lstrip().startswith("```"):
+                in_code = not in_code
+            # 代码块中的 # 行是注释（如config.yaml），不作为标题
+            match = None if in_code else HEADING_RE.match(line)
+            if match and len(match.group(1)) == 1:
+                self.group = match.group(2).strip("[]【】 ")
+                self.heading = ""
+                continue
+            if match and title is None:
+                title = match.group(2).strip()
+                if len(match.group(1)) == 2:
+                    self.heading = title
+            body.append(line)
+        
+        content = "\n".join(body).strip()
+        if not content:
+            return None
+        if title is None:
+            first_line = next(line for line in body if line.strip())
+            title = LIST_MARKER_RE.sub("", first_line).strip()
+        
+        path = [part for part in (self.group, self.heading) if part]
+        if title != self.heading:
+            path.append(title)
+        key = " / ".join(_clip(part, KEY_PART_LENGTH) for part in path)
+        self._seen[key] += 1
+        if self._seen[key] > 1:
+            key = f"{key} #{self._seen[key]}"
+        
+        return {
+            "key": f"{self.source}::{key}",
+            "title": _clip(title, TITLE_LENGTH),
+            "content": content,
+            "category": self.group or None
+        }
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """把字节流（请求体/文件）增量解码为文本行"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def import_document(
+    db: AsyncSession,
+    lines: AsyncIterable[str],
+    source: str,
+    category: str = None,
+    batch_size: int = None,
+    auto_embed: bool = True,
+    bot_id: str = None
+) -> Dict:
+    """流式导入文档：边解析边按批写入，每批一个事务，按章节键新增或更新
+    
+    category不为空时覆盖文档中的分组分类；bot_id不为空时导入为该bot的专属知识。向量由后台任务按批(embed_batch)生成，未变化的段落按哈希跳过。
+    返回 新增/更新/未变化 的统计。
+    """
+    batch_size = batch_size or settings.knowledge_import_batch_size
+    service = KnowledgeService(db)
+    parser = SectionParser(source)
+    report = {"source": source, "bot_id": bot_id or None, "sections": 0, "added": 0, "updated": 0, "unchanged": 0, "batches": 0}
+    start = time.time()
+    batch: List[Dict] = []
+    
+    async def flush():
+        if category:
+            for section in batch:
+                section["category"] = category
+        counts = await service.upsert_sections(batch, auto_embed=auto_embed, bot_id=bot_id)
+        for name, count in counts.items():
+            report[name] += count
+        report["sections"] += len(batch)
+        report["batches"] += 1
+        batch.clear()
+    
+    async for line in lines:
+        section = parser.feed(line)
+        if section:
+            batch.append(section)
+            if len(batch) >= batch_size:
+                await flush()
+    section = parser.close()
+    if section:
+        batch.append(section)
+    if batch:
+        await flush()
+    
+    report["elapsed_ms"] = round((time.time() - start) * 1000, 2)
+    print(f"[KnowledgeImport] {source}: {report['sections']} sections, added={report['added']}, "
+          f"updated={report['updated']}, unchanged={report['unchanged']} ({report['elapsed_ms']}ms)")
+    return report
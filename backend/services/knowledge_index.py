@@ -0,0 +1,483 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database.models import KnowledgeBase, KnowledgeChunk
+from database.embedding_codec import unpack_embedding
+from config import get_settings
+from typing import List, Dict, Optional, Iterable, Tuple
+from collections import Counter
+import asyncio
+import copy
+import os
+import re
+import time
+import numpy as np
+from .ann_index import IVFFlatIndex, default_nlist, SAMPLE_PER_LIST, ASSIGN_BLOCK
+from .vector_store import make_store
+
+settings = get_settings()
+
+RERANK_MARGIN = 0.05  # 量化打分阶段放宽的相似度阈值（int8误差远小于该值）
+SHARED_PARTITION = ""  # 共享知识（bot_id为空）所在的分区
+
+_UNSAFE_PATH_RE = re.compile(r"[^\w.-]")
+
+
+def partition_of(bot_id: Optional[str]) -> str:
+    """条目所在的索引分区：bot专属知识按bot_id分区，其余为共享分区"""
+    return bot_id or SHARED_PARTITION
+
+
+def partition_filter(partition: str):
+    """分区对应的条目筛选条件"""
+    if partition == SHARED_PARTITION:
+        return KnowledgeBase.bot_id.is_(None)
+    return KnowledgeBase.bot_id == partition
+
+
+def partition_path(path: str, partition: str) -> str:
+    """分区的IVF索引文件：共享分区沿用配置的路径，bot分区在文件名后加bot_id"""
+    if partition == SHARED_PARTITION:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{_UNSAFE_PATH_RE.sub('_', partition)}{ext}"
+
+
+async def knowledge_partitions(db: AsyncSession) -> List[str]:
+    """数据库中已有条目的全部分区（共享分区总在第一个）"""
+    result = await db.execute(select(KnowledgeBase.bot_id).where(KnowledgeBase.bot_id.isnot(None)).distinct())
+    return [SHARED_PARTITION] + sorted(result.scalars().all())
+
+
+class KnowledgeIndex:
+    """常驻内存的知识库向量索引
+    
+    所有启用条目的段落向量保存为一个预归一化的float32矩阵 + 段落id数组（及所属条目id），
+    检索时只做一次矩阵-向量乘法和argpartition取top-k，不再读取embedding列。
+    内存紧张时可改为int8量化存储，候选结果再用数据库中的float32原向量重排。
+    知识库写入时增量更新；批量变更只需递增版本号，下次检索时自动重建。
+    
+    向量数达到 knowledge_ann_min_size 后在后台训练IVF簇中心（保存到索引文件），
+    之后只对nprobe个最近簇内的向量打分；小集合和训练完成前使用精确检索。
+    
+    每个bot的专属知识是一个独立分区（各自的矩阵、簇中心和索引文件），共享知识为默认分区；
+    bot检索时只查询自己的分区和共享分区。
+    """
+    
+    _instances: Dict[str, "KnowledgeIndex"] = {}
+    _lock = asyncio.Lock()
+    
+    def __init__(self, partition: str = SHARED_PARTITION):
+        self.partition = partition
+        self._ids = np.zeros(0, dtype=np.int64)  # 段落id
+        self._owners = np.zeros(0, dtype=np.int64)  # 段落所属的条目id
+        self._store = None  # 向量存储 (n, dim)，每行已归一化，见 vector_store
+        self._positions: Dict[int, int] = {}  # 段落id -> 矩阵行号
+        self._version = 0  # 知识库版本号，每次写入递增
+        self._built_version = -1  # 当前矩阵对应的版本号
+        self._build_lock = asyncio.Lock()
+        self.quantization = settings.knowledge_index_quantization  # none / int8
+        self.rerank_factor = settings.knowledge_rerank_factor  # 量化模式下重排的候选倍数
+        
+        # IVF近似检索
+        self.backend = settings.knowledge_ann_backend  # ivf / exact
+        self.min_ann_size = settings.knowledge_ann_min_size
+        self.nprobe = settings.knowledge_ann_nprobe
+        self.index_path = partition_path(settings.knowledge_ann_index_path, partition)
+        self._ann: Optional[IVFFlatIndex] = None
+        self.model = ""  # 索引中向量的（主流）模型，簇中心按模型区分
+        self._assign = np.zeros(0, dtype=np.int32)  # 每行所属的簇，与矩阵行对齐
+        self._lists: Optional[Tuple[np.ndarray, np.ndarray]] = None  # (按簇排序的行号, 各簇起始偏移)，修改后惰性重建
+        self._train_task: Optional[asyncio.Task] = None
+        self._restored = False  # 是否已尝试读取索引文件
+    
+    @classmethod
+    async def get_instance(cls, partition: str = SHARED_PARTITION) -> "KnowledgeIndex":
+        """获取分区的实例（每个分区一个单例）"""
+        if partition not in cls._instances:
+            async with cls._lock:
+                if partition not in cls._instances:
+                    cls._instances[partition] = cls(partition)
+        return cls._instances[partition]
+    
+    @classmethod
+    def has_instance(cls, partition: str) -> bool:
+        """分区实例是否已创建（写入过条目或已检索过的分区）"""
+        return partition in cls._instances
+    
+    @classmethod
+    def all_instances(cls) -> List["KnowledgeIndex"]:
+        """已创建的全部分区实例"""
+        return list(cls._instances.values())
+    
+    @property
+    def version(self) -> int:
+        return self._version
+    
+    @property
+    def size(self) -> int:
+        return len(self._ids)
+    
+    @property
+    def dim(self) -> int:
+        return self._store.dim if self._store is not None else 0
+    
+    @property
+    def is_current(self) -> bool:
+        return self._built_version == self._version
+    
+    @property
+    def _label(self) -> str:
+        return f" [bot {self.partition}]" if self.partition != SHARED_PARTITION else ""
+    
+    def invalidate(self):
+        """标记索引过期（批量变更后调用），下次检索时从数据库重建"""
+        self._version += 1
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (vectors / norms).astype(np.float32, copy=False)
+    
+    async def ensure_built(self, db: AsyncSession):
+        """版本号变化时从数据库重建矩阵"""
+        if self.is_current:
+            return
+        async with self._build_lock:
+            if self.is_current:
+                return
+            target_version = self._version
+            result = await db.execute(
+                select(KnowledgeChunk.id, KnowledgeChunk.kb_id, KnowledgeChunk.embedding, KnowledgeChunk.embedding_model)
+                .join(KnowledgeBase, KnowledgeBase.id == KnowledgeChunk.kb_id)
+                .where(KnowledgeBase.is_active == True)
+                .where(partition_filter(self.partition))
+                .where(KnowledgeChunk.embedding.isnot(None))
+            )
+            rows = []
+            models = Counter()
+            for chunk_id, kb_id, raw, model in result.all():
+                vector = unpack_embedding(raw)
+                if vector is not None:
+                    rows.append((chunk_id, kb_id, vector))
+                    models[model or ""] += 1
+            self._load(rows, models.most_common(1)[0][0] if models else "")
+            self._built_version = target_version
+            print(f"[KnowledgeIndex] Built index{self._label}: {self.size} vectors, dim={self.dim}, version={target_version}")
+            self._maybe_train()
+    
+    def _load(self, rows: List[Tuple[int, int, np.ndarray]], model: str = ""):
+        """载入全部向量；簇分配总是按当前向量重新计算（段落id可能被复用，向量也可能已重新生成）"""
+        self.model = model
+        self._lists = None
+        if not rows:
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._owners = np.zeros(0, dtype=np.int64)
+            self._store = None
+            self._positions = {}
+            self._assign = np.zeros(0, dtype=np.int32)
+            return
+        
+        # 只保留主流维度的向量（切换模型后旧向量维度可能不同）
+        dim = Counter(len(vec) for _, _, vec in rows).most_common(1)[0][0]
+        kept = [row for row in rows if len(row[2]) == dim]
+        if len(kept) < len(rows):
+            print(f"[KnowledgeIndex] Skipped {len(rows) - len(kept)} vectors with mismatched dimension")
+        
+        self._ids = np.array([chunk_id for chunk_id, _, _ in kept], dtype=np.int64)
+        self._owners = np.array([kb_id for _, kb_id, _ in kept], dtype=np.int64)
+        self._store = make_store(self._normalize(np.vstack([vec for _, _, vec in kept]).astype(np.float32)), self.quantization)
+        self._reindex()
+        
+        if not self._restored:
+            # 首次构建时读取上次保存的簇中心
+            self._restored = True
+            loaded = IVFFlatIndex.load(self.index_path) if self.backend == "ivf" else None
+            if loaded is not None:
+                self._ann = loaded
+                print(f"[KnowledgeIndex] Loaded IVF index{self._label}: nlist={self._ann.nlist}, trained on {self._ann.trained_size} vectors")
+        if self._ann is not None and (self._ann.dim != self.dim or self._ann.model != self.model):
+            # 切换了模型（即使维度相同）：簇中心失效，等待重新训练
+            print(f"[KnowledgeIndex] Discarded IVF index{self._label} trained for model '{self._ann.model}'")
+            self._ann = None
+        if self._ann is not None:
+            self._assign = self._assign_rows(self._ann, self._ids, self._store)
+        else:
+            self._assign = np.zeros(0, dtype=np.int32)
+    
+    @staticmethod
+    def _assign_rows(ann: IVFFlatIndex, ids: np.ndarray, store, previous: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> np.ndarray:
+        """计算每行的簇分配，已知段落直接沿用之前的分配"""
+        assign = np.full(len(ids), -1, dtype=np.int32)
+        if previous is not None and len(previous[0]):
+            prev_ids, prev_assign = previous
+            order = np.argsort(prev_ids)
+            sorted_ids = prev_ids[order]
+            idx = np.clip(np.searchsorted(sorted_ids, ids), 0, len(sorted_ids) - 1)
+            known = sorted_ids[idx] == ids
+            assign[known] = prev_assign[order[idx[known]]]
+        unknown = np.flatnonzero(assign < 0)
+        for i in range(0, len(unknown), ASSIGN_BLOCK):
+            rows = unknown[i:i + ASSIGN_BLOCK]
+            assign[rows] = ann.assign(store.vectors(rows))
+        return assign
+    
+    def _reindex(self):
+        self._positions = {int(chunk_id): i for i, chunk_id in enumerate(self._ids)}
+        self._lists = None
+    
+    @property
+    def ann_active(self) -> bool:
+        """当前是否使用IVF近似检索"""
+        return (
+            self.backend == "ivf"
+            and self._ann is not None
+            and self.size >= self.min_ann_size
+            and len(self._assign) == self.size
+        )
+    
+    def _maybe_train(self):
+        """集合足够大且尚未训练、维度变化或规模比训练时翻倍时，在后台训练簇中心"""
+        if self.backend != "ivf" or self.size < self.min_ann_size:
+            return
+        if self._train_task is not None and not self._train_task.done():
+            return
+        if self._ann is not None and self.size < 2 * self._ann.trained_size:
+            return
+        self._train_task = asyncio.create_task(self._train())
+    
+    def retrain(self) -> bool:
+        """手动触发重新训练（例如大批量导入后），已在训练时返回False"""
+        if self._store is None or (self._train_task is not None and not self._train_task.done()):
+            return False
+        self._train_task = asyncio.create_task(self._train())
+        return True
+    
+    async def _train(self):
+        # 浅拷贝存储：增删会替换内部数组，训练线程看到的是当前快照
+        store, ids, model = copy.copy(self._store), self._ids, self.model
+        n = len(ids)
+        nlist = default_nlist(n)
+        sample_rows = np.random.default_rng(0).choice(n, min(n, nlist * SAMPLE_PER_LIST), replace=False)
+        start = time.time()
+        try:
+            ann = await asyncio.to_thread(IVFFlatIndex.train, store.vectors(sample_rows), nlist, trained_size=n)
+            ann.model = model
+            assign = await asyncio.to_thread(self._assign_rows, ann, ids, store)
+        except Exception as e:
+            print(f"[KnowledgeIndex] IVF training failed{self._label}: {e}")
+            return
+        if self._store is None or self._store.dim != ann.dim or self.model != model:
+            return
+        
+        self._ann = ann
+        # 训练期间集合有增删时按段落id对齐，新增的行重新分配
+        self._assign = assign if self._ids is ids else self._assign_rows(ann, self._ids, self._store, (ids, assign))
+        self._lists = None
+        print(f"[KnowledgeIndex] Trained IVF index{self._label}: {len(ids)} vectors, nlist={ann.nlist}, {time.time() - start:.2f}s")
+        try:
+            await asyncio.to_thread(ann.save, self.index_path)
+        except Exception as e:
+            print(f"[KnowledgeIndex] Failed to save IVF index{self._label}: {e}")
+    
+    def get_stats(self) -> Dict:
+        return {
+            "partition": self.partition,
+            "size": self.size,
+            "dim": self.dim,
+            "backend": self.backend,
+            "quantization": self.quantization,
+            "memory_bytes": self._store.nbytes if self._store is not None else 0,
+            "rerank_factor": self.rerank_factor,
+            "ann_active": self.ann_active,
+            "min_ann_size": self.min_ann_size,
+            "nprobe": self.nprobe,
+            "nlist": self._ann.nlist if self._ann is not None else 0,
+            "trained_size": self._ann.trained_size if self._ann is not None else 0,
+            "training": self._train_task is not None and not self._train_task.done(),
+            "index_path": self.index_path
+        }
+    
+    def _apply(self, mutate):
+        """对已构建的索引做增量修改；索引已过期或修改失败时只递增版本号"""
+        current = self.is_current
+        self._version += 1
+        if current and mutate() is not False:
+            self._built_version = self._version
+    
+    def upsert(self, chunk_id: int, kb_id: int, embedding: Iterable[float]):
+        """新增或替换一个段落向量"""
+        self.upsert_many([(chunk_id, kb_id, embedding)])
+    
+    def upsert_many(self, items: Iterable[Tuple[int, int, Iterable[float]]], model: str = None):
+        """批量新增或替换段落向量 [(段落id, 条目id, 向量), ...]，新增行一次性追加；model为向量所属的模型（已知时）"""
+        items = list(items)
+        if not items:
+            return
+        vectors = self._normalize(np.vstack([np.asarray(vec, dtype=np.float32).reshape(1, -1) for _, _, vec in items]))
+        
+        def mutate():
+            if self._store is not None and vectors.shape[1] != self._store.dim:
+                # 维度变化说明换了模型，交给下次全量重建
+                return False
+            if model is not None and model != self.model:
+                # 维度相同的新模型：旧簇中心不再适用，改为精确检索并重新训练
+                self.model = model
+                self._ann = None
+                self._assign = np.zeros(0, dtype=np.int32)
+                self._lists = None
+            new_rows = []
+            for (chunk_id, kb_id, _), vec in zip(items, vectors):
+                pos = self._positions.get(chunk_id)
+                if pos is not None:
+                    self._store.set_row(pos, vec)
+                    self._owners[pos] = kb_id
+                    if self._ann is not None and len(self._assign) == self.size:
+                        self._assign[pos] = self._ann.assign(vec.reshape(1, -1))[0]
+                        self._lists = None
+                else:
+                    new_rows.append((chunk_id, kb_id, vec))
+            if not new_rows:
+                return
+            added = np.vstack([vec for _, _, vec in new_rows])
+            if self._ann is not None and len(self._assign) == self.size and self._ann.dim == added.shape[1]:
+                self._assign = np.append(self._assign, self._ann.assign(added))
+            if self._store is None:
+                self._store = make_store(added, self.quantization)
+            else:
+                self._store.append(added)
+            self._ids = np.append(self._ids, np.array([chunk_id for chunk_id, _, _ in new_rows], dtype=np.int64))
+            self._owners = np.append(self._owners, np.array([kb_id for _, kb_id, _ in new_rows], dtype=np.int64))
+            self._reindex()
+        
+        self._apply(mutate)
+        if self.is_current:
+            self._maybe_train()
+    
+    def _remove_where(self, drop: np.ndarray):
+        keep = ~drop
+        if len(self._assign) == len(self._ids):
+            self._assign = self._assign[keep]
+        self._ids = self._ids[keep]
+        self._owners = self._owners[keep]
+        if len(self._ids):
+            self._store.select(keep)
+        else:
+            self._store = None
+        self._reindex()
+    
+    def remove(self, chunk_ids: Iterable[int]):
+        """移除段落向量"""
+        chunk_ids = np.array(list(chunk_ids), dtype=np.int64)
+        
+        def mutate():
+            drop = np.isin(self._ids, chunk_ids)
+            if drop.any():
+                self._remove_where(drop)
+        
+        self._apply(mutate)
+    
+    def remove_entries(self, kb_ids: Iterable[int]):
+        """移除条目的全部段落向量（删除、禁用或重新分段时调用）"""
+        kb_ids = np.array(list(kb_ids), dtype=np.int64)
+        
+        def mutate():
+            drop = np.isin(self._owners, kb_ids)
+            if drop.any():
+                self._remove_where(drop)
+        
+        self._apply(mutate)
+    
+    async def query(
+        self,
+        db: AsyncSession,
+        query_embedding: List[float],
+        top_k: int = 3,
+        threshold: float = 0.0,
+        nprobe: int = None
+    ) -> List[Tuple[int, float]]:
+        """检索入口：int8量化存储时先按量化分数取 top_k×rerank_factor 个候选，再读取float32原向量精确重排"""
+        if self._store is None or not self._store.quantized:
+            return self.search(query_embedding, top_k, threshold, nprobe)
+        
+        candidates = self.search(query_embedding, top_k * self.rerank_factor, threshold - RERANK_MARGIN, nprobe)
+        if not candidates:
+            return []
+        result = await db.execute(
+            select(KnowledgeChunk.id, KnowledgeChunk.embedding)
+            .where(KnowledgeChunk.id.in_([chunk_id for chunk_id, _ in candidates]))
+        )
+        exact = {chunk_id: unpack_embedding(raw) for chunk_id, raw in result.all()}
+        return self.rerank(query_embedding, candidates, exact, top_k, threshold)
+    
+    @staticmethod
+    def rerank(
+        query_embedding: List[float],
+        candidates: List[Tuple[int, float]],
+        exact: Dict[int, Optional[np.ndarray]],
+        top_k: int,
+        threshold: float = 0.0
+    ) -> List[Tuple[int, float]]:
+        """用原始向量重新计算候选的余弦相似度；缺少原向量的候选保留量化分数"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        rescored = []
+        for chunk_id, approx in candidates:
+            vec = exact.get(chunk_id)
+            if vec is None or len(vec) != len(query):
+                score = approx
+            else:
+                score = float(vec @ query / (np.linalg.norm(vec) or 1.0))
+            if score >= threshold:
+                rescored.append((chunk_id, score))
+        rescored.sort(key=lambda item: item[1], reverse=True)
+        return rescored[:top_k]
+    
+    def search(self, query_embedding: List[float], top_k: int = 3, threshold: float = 0.0, nprobe: int = None) -> List[Tuple[int, float]]:
+        """返回 [(段落id, score), ...]，按相似度降序；nprobe为IVF检索的簇数，越大召回越高"""
+        if self._store is None or top_k <= 0:
+            return []
+        
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape[0] != self._store.dim:
+            raise ValueError(f"查询向量维度({query.shape[0]})与索引维度({self._store.dim})不一致，请重建向量")
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        
+        query = query / norm
+        rows = self._candidates(query, nprobe or self.nprobe) if self.ann_active else None
+        scores = self._store.dot(query, rows)
+        
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        positions = top if rows is None else rows[top]
+        
+        return [(int(self._ids[pos]), float(score)) for pos, score in zip(positions, scores[top]) if score >= threshold]
+    
+    def passage_vectors(self, chunk_ids: List[int]) -> np.ndarray:
+        """按顺序取段落的归一化向量矩阵 (len(chunk_ids), dim)；不在索引中的段落为0向量"""
+        matrix = np.zeros((len(chunk_ids), self.dim), dtype=np.float32)
+        if self._store is None:
+            return matrix
+        found = [(i, self._positions[chunk_id]) for i, chunk_id in enumerate(chunk_ids) if chunk_id in self._positions]
+        if found:
+            targets, rows = (np.array(column) for column in zip(*found))
+            matrix[targets] = self._store.vectors(rows)
+        return matrix
+    
+    def _candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """nprobe个最近簇内的全部行号"""
+        if self._lists is None:
+            order = np.argsort(self._assign, kind="stable")
+            offsets = np.searchsorted(self._assign[order], np.arange(self._ann.nlist + 1))
+            self._lists = (order, offsets)
+        order, offsets = self._lists
+        probes = self._ann.probe(query, nprobe)
+        return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probes])
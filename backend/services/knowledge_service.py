@@ -1,51 +1,202 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, or_
-from database.models import KnowledgeBase
-from typing import List, Optional
-import jieba
-import json
+from sqlalchemy import select, insert, update, bindparam, delete as sql_delete
+from sqlalchemy.orm import defer
+from database.models import KnowledgeBase, KnowledgeChunk
+from database.embedding_codec import unpack_embedding
+from config import get_settings
+from typing import List, Dict, Optional, Tuple, NamedTuple, Callable
+from collections import deque
+import asyncio
+import heapq
+import itertools
+import math
+import re
+import time
+import numpy as np
+from .config_service import ConfigService
 from .embedding_service import EmbeddingService
+from .knowledge_index import KnowledgeIndex, SHARED_PARTITION, partition_of, partition_filter
+from .lexical_index import LexicalIndex
+from .embedding_worker import EmbeddingWorker
+from .chunking import sync_chunks
+from .result_cache import RetrievalCache
 
-# 全局进度跟踪
-rebuild_progress = {
-    "running": False,
-    "current": 0,
-    "total": 0,
-    "message": ""
-}
+settings = get_settings()
+
+VECTOR_SCORE_THRESHOLD = 0.3  # 向量相似度阈值（较低以提高召回率）
+PASSAGES_PER_RESULT = 4  # 每个返回条目对应的候选段落数（同一条目的多个段落可能同时命中）
+MIN_BUDGET_TOKENS = 50  # token预算剩余不足该值时不再加入（截断的）知识片段
+TRUNCATED_SUFFIX = "...(已截断)"
+
+_HAN_RE = re.compile(r"[\u4e00-\u9fff]")
+
+# 批量导入时按主键更新变化的章节
+_UPDATE_SECTION = (
+    update(KnowledgeBase.__table__)
+    .where(KnowledgeBase.__table__.c.id == bindparam("_id"))
+    .values(title=bindparam("title"), content=bindparam("content"), category=bindparam("category"))
+)
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def _consume_task_result(task: asyncio.Task):
+    """读取后台任务的异常，避免超时后被放弃的向量化请求报 'exception was never retrieved'"""
+    if not task.cancelled():
+        task.exception()
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Tuple[int, float]]], k: int = 60) -> List[Tuple[int, float]]:
+    """倒数排名融合：score(d) = Σ 1 / (k + rank)，只看名次，不要求各路分数可比"""
+    scores: Dict[int, float] = {}
+    for hits in ranked_lists:
+        for rank, (kb_id, _) in enumerate(hits, start=1):
+            scores[kb_id] = scores.get(kb_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def merge_partition_hits(hit_lists: List[List[Tuple[int, float]]], top_k: int) -> List[Tuple[int, float]]:
+    """合并各分区的向量检索结果 [(段落id, 相似度), ...]，按相似度取前top_k（段落只属于一个分区，不会重复）"""
+    return heapq.nlargest(top_k, itertools.chain.from_iterable(hit_lists), key=lambda item: item[1])
+
+
+def maximal_marginal_relevance(relevance: np.ndarray, vectors: np.ndarray, limit: int, lam: float) -> List[int]:
+    """最大边际相关(MMR)：每次选 λ·相关度 - (1-λ)·与已选结果的最大相似度 最高的候选，返回选中的下标
+    
+    relevance 为归一化到[0,1]的相关度；vectors 为归一化向量矩阵（0向量的候选不参与冗余判断）。
+    """
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    selected = []
+    for _ in range(min(limit, len(relevance))):
+        scores = np.where(available, lam * relevance - (1 - lam) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：汉字计1个，其他字符约4个计1个"""
+    han = len(_HAN_RE.findall(text))
+    return han + math.ceil((len(text) - han) / 4)
+
+
+def clip_to_tokens(text: str, tokens: int) -> str:
+    """截取不超过约tokens个token的前缀"""
+    cost = 0.0
+    for i, char in enumerate(text):
+        cost += 1 if _HAN_RE.match(char) else 0.25
+        if cost > tokens:
+            return text[:i]
+    return text
+
+
+class KnowledgeHit(NamedTuple):
+    """检索结果（不可变，不持有ORM对象）
+    
+    snippet为命中的段落（过长时截断）；score为对应检索方式的分数（向量相似度/BM25/RRF）；
+    source为命中来源：vector / keyword / hybrid（混合检索中两路都命中）；passage_id为命中段落的ID。
+    """
+    id: int
+    title: str
+    snippet: str
+    score: float
+    source: str
+    passage_id: int
+
+
+class SearchStats:
+    """最近N次检索的分阶段耗时统计，用于调整混合检索时限"""
+    
+    STAGES = ("index_ms", "lexical_ms", "embed_ms", "vector_ms", "fusion_ms", "load_ms", "total_ms")
+    
+    def __init__(self, window: int = 500):
+        self._records = deque(maxlen=window)
+        self.searches = 0
+        self.vector_timeouts = 0
+        self.vector_errors = 0
+        self.modes: Dict[str, int] = {}
+    
+    def record(self, timings: Dict):
+        self._records.append(timings)
+        self.searches += 1
+        self.modes[timings.get("mode", "")] = self.modes.get(timings.get("mode", ""), 0) + 1
+        if timings.get("vector_timeout"):
+            self.vector_timeouts += 1
+        if timings.get("vector_error"):
+            self.vector_errors += 1
+    
+    def clear(self):
+        self._records.clear()
+        self.searches = 0
+        self.vector_timeouts = 0
+        self.vector_errors = 0
+        self.modes = {}
+    
+    def get_stats(self) -> Dict:
+        stages = {}
+        for stage in self.STAGES:
+            values = [r[stage] for r in self._records if stage in r]
+            if not values:
+                continue
+            stages[stage] = {
+                "count": len(values),
+                "avg": round(float(np.mean(values)), 2),
+                "p50": round(float(np.percentile(values, 50)), 2),
+                "p95": round(float(np.percentile(values, 95)), 2),
+                "max": round(float(np.max(values)), 2)
+            }
+        return {
+            "searches": self.searches,
+            "window": len(self._records),
+            "modes": dict(self.modes),
+            "vector_timeouts": self.vector_timeouts,
+            "vector_errors": self.vector_errors,
+            "stages": stages,
+            "last": self._records[-1] if self._records else None
+        }
 
 
 class KnowledgeService:
+    search_stats = SearchStats()
+    result_cache = RetrievalCache(int(settings.knowledge_result_cache_mb * 1024 * 1024))
+    
     def __init__(self, db: AsyncSession):
         self.db = db
         self._embedding_service = None
+        self.last_timings: Dict = {}
     
     async def get_embedding_service(self) -> EmbeddingService:
         if self._embedding_service is None:
             self._embedding_service = await EmbeddingService.from_db(self.db)
         return self._embedding_service
     
-    async def create(self, title: str, content: str, keywords: str = None, category: str = None, auto_embed: bool = True) -> KnowledgeBase:
+    async def create(self, title: str, content: str, keywords: str = None, category: str = None, auto_embed: bool = True, bot_id: str = None) -> KnowledgeBase:
+        """新增条目；bot_id为空时为所有bot共享的知识"""
         kb = KnowledgeBase(
             title=title,
             content=content,
             keywords=keywords,
-            category=category
+            category=category,
+            bot_id=bot_id or None
         )
         
-        # 自动生成向量
-        if auto_embed:
-            try:
-                embed_service = await self.get_embedding_service()
-                embed_text = f"{title} {content[:500]}"  # 合并标题和内容前500字
-                embedding = await embed_service.embed(embed_text)
-                kb.embedding = json.dumps(embedding)
-            except Exception as e:
-                print(f"[KnowledgeService] Embedding failed: {e}")
-        
         self.db.add(kb)
         await self.db.commit()
         await self.db.refresh(kb)
+        
+        await sync_chunks(self.db, [kb.id])
+        await self._sync_indexes([kb.id])
+        
+        # 自动生成向量（后台按段落分批生成）
+        if auto_embed:
+            worker = await EmbeddingWorker.get_instance()
+            worker.enqueue([kb.id])
         return kb
     
     async def get_by_id(self, kb_id: int) -> Optional[KnowledgeBase]:
@@ -61,155 +212,473 @@ class KnowledgeService:
         
         for key, value in kwargs.items():
             if value is not None and hasattr(kb, key):
-                setattr(kb, key, value)
+                # bot_id传空字符串表示改为共享知识
+                setattr(kb, key, (value or None) if key == "bot_id" else value)
         
         await self.db.commit()
         await self.db.refresh(kb)
+        
+        await sync_chunks(self.db, [kb.id])
+        await self._sync_indexes([kb.id])
+        
+        # 标题或内容变化后在后台重新生成向量（未变化的段落按哈希跳过）
+        if kb.is_active and any(kwargs.get(key) is not None for key in ("title", "content", "is_active")):
+            worker = await EmbeddingWorker.get_instance()
+            worker.enqueue([kb.id])
         return kb
     
+    async def upsert_sections(self, sections: List[Dict], auto_embed: bool = True, bot_id: str = None) -> Dict[str, int]:
+        """按章节键批量新增或更新条目（一个事务），返回 added/updated/unchanged 计数
+        
+        sections: [{"key", "title", "content", "category"}, ...]，见 knowledge_import.SectionParser。
+        标题、正文、分类都未变化的章节不写入；条目的启用状态和关键词保持不变。
+        章节键在bot_id的分区内查找，同一文档可以分别导入为共享知识和各bot的专属知识。
+        """
+        if not sections:
+            return {"added": 0, "updated": 0, "unchanged": 0}
+        
+        # 同一批中重复的键以最后一次为准
+        by_key = {section["key"]: section for section in sections}
+        result = await self.db.execute(
+            select(KnowledgeBase.id, KnowledgeBase.source_key, KnowledgeBase.title, KnowledgeBase.content, KnowledgeBase.category)
+            .where(KnowledgeBase.source_key.in_(list(by_key)))
+            .where(partition_filter(partition_of(bot_id)))
+        )
+        existing = {row.source_key: row for row in result.all()}
+        
+        new_rows, changed_rows = [], []
+        unchanged = 0
+        for key, section in by_key.items():
+            row = existing.get(key)
+            if row is None:
+                new_rows.append({
+                    "source_key": key,
+                    "title": section["title"],
+                    "content": section["content"],
+                    "category": section.get("category"),
+                    "bot_id": bot_id or None
+                })
+            elif (row.title, row.content, row.category) != (section["title"], section["content"], section.get("category")):
+                changed_rows.append({
+                    "_id": row.id,
+                    "title": section["title"],
+                    "content": section["content"],
+                    "category": section.get("category")
+                })
+            else:
+                unchanged += 1
+        
+        kb_ids = [row["_id"] for row in changed_rows]
+        if changed_rows:
+            await self.db.execute(_UPDATE_SECTION, changed_rows)
+        if new_rows:
+            result = await self.db.execute(insert(KnowledgeBase).returning(KnowledgeBase.id), new_rows)
+            kb_ids.extend(result.scalars().all())
+        if kb_ids:
+            # 段落与条目在同一事务中提交
+            await sync_chunks(self.db, kb_ids)
+            await self.db.commit()
+            await self._sync_indexes(kb_ids)
+            if auto_embed:
+                worker = await EmbeddingWorker.get_instance()
+                worker.enqueue(kb_ids)
+        
+        return {"added": len(new_rows), "updated": len(changed_rows), "unchanged": unchanged}
+    
     async def delete(self, kb_id: int) -> bool:
         kb = await self.get_by_id(kb_id)
         if not kb:
             return False
         
+        await self.db.execute(sql_delete(KnowledgeChunk).where(KnowledgeChunk.kb_id == kb_id))
         await self.db.delete(kb)
         await self.db.commit()
+        
+        await self._sync_indexes([kb_id])
         return True
     
-    async def search(self, query: str, limit: int = 3, max_content_length: int = 500, use_vector: bool = True) -> List[KnowledgeBase]:
-        """搜索知识库，优先使用向量检索，回退到关键词匹配"""
+    async def _sync_indexes(self, kb_ids: List[int]):
+        """写入后同步内存索引：从所有分区移除条目的旧段落（所属bot可能已改变），再把启用条目的当前段落写入所属分区"""
+        for index in KnowledgeIndex.all_instances() + LexicalIndex.all_instances():
+            index.remove_entries(kb_ids)
+        
+        result = await self.db.execute(
+            select(
+                KnowledgeChunk.id,
+                KnowledgeChunk.kb_id,
+                KnowledgeBase.bot_id,
+                KnowledgeBase.title,
+                KnowledgeBase.keywords,
+                KnowledgeChunk.content,
+                KnowledgeChunk.embedding
+            )
+            .join(KnowledgeBase, KnowledgeBase.id == KnowledgeChunk.kb_id)
+            .where(KnowledgeChunk.kb_id.in_(kb_ids))
+            .where(KnowledgeBase.is_active == True)
+        )
+        vectors: Dict[str, List] = {}
+        for chunk_id, kb_id, bot_id, title, keywords, content, raw in result.all():
+            partition = partition_of(bot_id)
+            (await LexicalIndex.get_instance(partition)).upsert(chunk_id, kb_id, title, keywords, content)
+            vector = unpack_embedding(raw)
+            if vector is not None:
+                vectors.setdefault(partition, []).append((chunk_id, kb_id, vector))
+        for partition, items in vectors.items():
+            (await KnowledgeIndex.get_instance(partition)).upsert_many(items)
+    
+    async def search(
+        self,
+        query: str,
+        limit: int = 3,
+        max_content_length: int = 500,
+        use_vector: bool = True,
+        mode: str = None,
+        bot_id: str = None
+    ) -> List[KnowledgeHit]:
+        """搜索知识库
+        
+        mode: hybrid(默认，关键词与向量并发检索后RRF融合) / vector(向量优先，回退关键词) / keyword
+        未指定时使用后台配置；use_vector=False时只做关键词检索。
+        bot_id: 只检索该bot的专属知识和共享知识；为空时只检索共享知识。
+        """
         print(f"[KnowledgeService] Searching for: {query[:50]}...")
+        config = await ConfigService(self.db).get_knowledge_search_config()
+        mode = mode or config["mode"]
+        if not use_vector:
+            mode = "keyword"
         
-        # 尝试向量检索
-        if use_vector:
-            try:
-                results = await self.vector_search(query, limit, max_content_length)
-                if results:
-                    print(f"[KnowledgeService] Vector search found {len(results)} results")
-                    return results
-                print("[KnowledgeService] Vector search returned empty, trying keyword")
-            except Exception as e:
-                print(f"[KnowledgeService] Vector search failed, fallback to keyword: {e}")
+        timings = {"mode": mode}
+        start = time.perf_counter()
+        mmr_lambda = config["mmr_lambda"]
+        # 去冗余时先取更多候选条目
+        fetch = limit * settings.knowledge_mmr_candidates if mmr_lambda < 1 else limit
+        partitions = await self._resolve_partitions(bot_id)
+        cache = KnowledgeService.result_cache
+        cache_key = (cache.normalize(query), mode, limit, config["rrf_k"], config["nprobe"], mmr_lambda, partitions)
+        version = await self._kb_version(partitions)
+        cached = cache.get(cache_key, version)
+        if cached is not None:
+            timings["cache"] = "hit"
+            sources = {passage_id: source for passage_id, _, source in cached}
+            results = await self._load_hits(
+                [(passage_id, score) for passage_id, score, _ in cached],
+                limit, max_content_length, "Cached match", "score", sources.get
+            )
+        else:
+            timings["cache"] = "miss"
+            if mode == "hybrid":
+                results = await self.hybrid_search(
+                    query, fetch, max_content_length,
+                    deadline=config["deadline_ms"] / 1000,
+                    rrf_k=config["rrf_k"],
+                    nprobe=config["nprobe"],
+                    timings=timings,
+                    partitions=partitions
+                )
+            elif mode == "vector":
+                results = await self._vector_first_search(query, fetch, max_content_length, config["nprobe"], timings, partitions)
+            else:
+                results = await self.keyword_search(query, fetch, max_content_length, partitions)
+            if len(results) > limit:
+                stage = time.perf_counter()
+                results = await self.diversify(results, limit, mmr_lambda, partitions)
+                timings["mmr_ms"] = _elapsed_ms(stage)
+            # 向量超时/出错时的降级结果不缓存
+            if not timings.get("vector_timeout") and not timings.get("vector_error"):
+                cache.put(cache_key, version, tuple((hit.passage_id, hit.score, hit.source) for hit in results))
+        if config["token_budget"] > 0:
+            results = self.fit_token_budget(results, config["token_budget"])
+        timings["total_ms"] = _elapsed_ms(start)
         
-        # 回退到关键词匹配
-        results = await self.keyword_search(query, limit, max_content_length)
-        print(f"[KnowledgeService] Keyword search found {len(results)} results")
+        self.last_timings = timings
+        KnowledgeService.search_stats.record(timings)
+        stages = ", ".join(f"{key}={value}" for key, value in timings.items() if key.endswith("_ms"))
+        print(f"[KnowledgeService] {mode} search found {len(results)} results ({stages})")
         return results
     
-    async def vector_search(self, query: str, limit: int = 3, max_content_length: int = 500) -> List[KnowledgeBase]:
-        """向量语义检索"""
-        # 获取所有有向量的知识库条目
-        result = await self.db.execute(
-            select(KnowledgeBase)
-            .where(KnowledgeBase.is_active == True)
-            .where(KnowledgeBase.embedding.isnot(None))
+    async def diversify(self, hits: List[KnowledgeHit], limit: int, mmr_lambda: float, partitions: Tuple[str, ...] = None) -> List[KnowledgeHit]:
+        """用MMR从候选条目中选出limit个：兼顾相关度和彼此之间的差异，避免近似重复的条目占满结果
+        
+        相关度为各检索方式的分数按候选集归一化到[0,1]；相似度为命中段落向量的余弦相似度（取自内存向量索引）。
+        """
+        scores = np.array([hit.score for hit in hits], dtype=np.float32)
+        spread = scores.max() - scores.min()
+        relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(len(hits), dtype=np.float32)
+        chunk_ids = [hit.passage_id for hit in hits]
+        matrices = [
+            (await KnowledgeIndex.get_instance(partition)).passage_vectors(chunk_ids)
+            for partition in partitions or (SHARED_PARTITION,)
+        ]
+        # 每个段落只在一个分区中，其余分区对应的行为0向量；维度不同的分区（切换模型中）不参与
+        dim = max(matrix.shape[1] for matrix in matrices)
+        vectors = np.sum([matrix for matrix in matrices if matrix.shape[1] == dim], axis=0)
+        return [hits[i] for i in maximal_marginal_relevance(relevance, vectors, limit, mmr_lambda)]
+    
+    @staticmethod
+    def fit_token_budget(hits: List[KnowledgeHit], budget: int) -> List[KnowledgeHit]:
+        """按顺序放入知识片段直到用完token预算（含标题），放不下的片段截断，剩余不足时舍弃后面的结果"""
+        fitted = []
+        remaining = budget
+        for hit in hits:
+            cost = estimate_tokens(hit.title) + estimate_tokens(hit.snippet)
+            if cost <= remaining:
+                fitted.append(hit)
+                remaining -= cost
+                continue
+            room = remaining - estimate_tokens(hit.title) - estimate_tokens(TRUNCATED_SUFFIX)
+            if room >= MIN_BUDGET_TOKENS:
+                snippet = hit.snippet[:-len(TRUNCATED_SUFFIX)] if hit.snippet.endswith(TRUNCATED_SUFFIX) else hit.snippet
+                fitted.append(hit._replace(snippet=clip_to_tokens(snippet, room) + TRUNCATED_SUFFIX))
+            break
+        return fitted
+    
+    @staticmethod
+    def search_partitions(bot_id: Optional[str]) -> Tuple[str, ...]:
+        """bot可检索的索引分区：自己的专属分区和共享分区"""
+        return (bot_id, SHARED_PARTITION) if bot_id else (SHARED_PARTITION,)
+    
+    async def _resolve_partitions(self, bot_id: Optional[str]) -> Tuple[str, ...]:
+        """本次检索的分区：没有专属知识的bot_id（包括请求中任意填写的值）只检索共享分区，不为其创建分区索引"""
+        if bot_id and not KnowledgeIndex.has_instance(bot_id):
+            result = await self.db.execute(select(KnowledgeBase.id).where(KnowledgeBase.bot_id == bot_id).limit(1))
+            if result.scalar() is None:
+                bot_id = None
+        return self.search_partitions(bot_id)
+    
+    @staticmethod
+    async def _kb_version(partitions: Tuple[str, ...]) -> Tuple:
+        """知识库版本：各分区内存索引的版本号，任何知识写入（增删改、启用状态、向量更新）都会使其变化
+        
+        结果缓存只保存一个版本，因此取全部分区而不只是本次检索的分区（先创建本次的分区，避免检索中途版本变化）；
+        空分区不计入，新出现的空分区不会使其他bot的缓存失效。
+        """
+        for partition in partitions:
+            await LexicalIndex.get_instance(partition)
+            await KnowledgeIndex.get_instance(partition)
+        return tuple(
+            (index.partition, index.version)
+            for index in LexicalIndex.all_instances() + KnowledgeIndex.all_instances()
+            if index.partition == SHARED_PARTITION or index.size > 0
         )
-        all_kb = result.scalars().all()
+    
+    async def _built_indexes(self, index_class, partitions: Tuple[str, ...] = None) -> List:
+        """取得各分区的索引（LexicalIndex / KnowledgeIndex）并确保已构建；共用同一个数据库会话，串行构建"""
+        indexes = [await index_class.get_instance(partition) for partition in partitions or (SHARED_PARTITION,)]
+        for index in indexes:
+            await index.ensure_built(self.db)
+        return indexes
+    
+    async def _query_vectors(self, vector_indexes: List[KnowledgeIndex], query_embedding: List[float], top_k: int, nprobe: int = None) -> List[Tuple[int, float]]:
+        """在各分区的向量索引中检索并合并"""
+        return merge_partition_hits([
+            await index.query(self.db, query_embedding, top_k=top_k, threshold=VECTOR_SCORE_THRESHOLD, nprobe=nprobe)
+            for index in vector_indexes if index.size > 0
+        ], top_k)
+    
+    async def _vector_first_search(
+        self,
+        query: str,
+        limit: int,
+        max_content_length: int,
+        nprobe: int = None,
+        timings: Dict = None,
+        partitions: Tuple[str, ...] = None
+    ) -> List[KnowledgeHit]:
+        """向量检索优先，出错、超时或无结果时回退到关键词匹配"""
+        timings = {} if timings is None else timings
+        try:
+            results = await self.vector_search(query, limit, max_content_length, nprobe, partitions)
+            if results:
+                return results
+            print("[KnowledgeService] Vector search returned empty, trying keyword")
+        except asyncio.TimeoutError:
+            timings["vector_timeout"] = True
+            print("[KnowledgeService] Vector search timed out, fallback to keyword")
+        except Exception as e:
+            timings["vector_error"] = str(e)
+            print(f"[KnowledgeService] Vector search failed, fallback to keyword: {e}")
         
-        if not all_kb:
-            print("[KnowledgeService] No knowledge entries with embeddings found")
-            return []
+        return await self.keyword_search(query, limit, max_content_length, partitions)
+    
+    async def hybrid_search(
+        self,
+        query: str,
+        limit: int = 3,
+        max_content_length: int = 500,
+        deadline: float = None,
+        rrf_k: int = None,
+        nprobe: int = None,
+        timings: Dict = None,
+        partitions: Tuple[str, ...] = None
+    ) -> List[KnowledgeHit]:
+        """混合检索：BM25与向量检索并发执行，按倒数排名融合(RRF)
         
-        print(f"[KnowledgeService] Found {len(all_kb)} entries with embeddings")
+        查询向量化（从发出请求起计时）超过deadline(秒)时只返回关键词结果，向量化请求在后台继续完成以填充查询向量缓存。
+        partitions为检索的索引分区（默认只检索共享知识），每一路先在这些分区中检索合并，再融合。
+        """
+        deadline = settings.knowledge_hybrid_deadline_ms / 1000 if deadline is None else deadline
+        rrf_k = settings.knowledge_rrf_k if rrf_k is None else rrf_k
+        timings = {} if timings is None else timings
+        candidates = max(limit * PASSAGES_PER_RESULT, 20)
+        start = time.perf_counter()
         
-        # 获取查询向量
-        embed_service = await self.get_embedding_service()
-        query_embedding = await embed_service.embed(query)
+        lexical_indexes = await self._built_indexes(LexicalIndex, partitions)
+        vector_indexes = await self._built_indexes(KnowledgeIndex, partitions)
+        timings["index_ms"] = _elapsed_ms(start)
         
-        # 计算相似度
-        embeddings = [json.loads(kb.embedding) for kb in all_kb]
-        similar_indices = EmbeddingService.find_most_similar(
-            query_embedding, 
-            embeddings, 
-            top_k=limit,
-            threshold=0.3  # 降低相似度阈值以提高召回率
-        )
+        embed_task = None
+        embed_start = time.perf_counter()
+        if any(index.size > 0 for index in vector_indexes):
+            embed_service = await self.get_embedding_service()
+            embed_task = asyncio.ensure_future(self._timed_embed_query(embed_service, query))
+            embed_task.add_done_callback(_consume_task_result)
+            await asyncio.sleep(0)  # 让向量化请求先发出，再在本协程中计算BM25
         
-        results = []
-        for idx, score in similar_indices:
-            kb = all_kb[idx]
-            # 截断过长内容
-            if len(kb.content) > max_content_length:
-                kb.content = kb.content[:max_content_length] + "...(已截断)"
-            results.append(kb)
-            print(f"[KnowledgeService] Vector match: {kb.title} (score: {score:.3f})")
+        stage = time.perf_counter()
+        lexical_hits = LexicalIndex.search_many(lexical_indexes, query, top_k=candidates)
+        timings["lexical_ms"] = _elapsed_ms(stage)
+        
+        vector_hits = []
+        if embed_task is not None:
+            remaining = max(deadline - (time.perf_counter() - embed_start), 0)
+            try:
+                # shield: 超时后请求不被取消，结果仍会写入查询向量缓存
+                query_embedding, embed_seconds = await asyncio.wait_for(asyncio.shield(embed_task), timeout=remaining)
+                timings["embed_ms"] = round(embed_seconds * 1000, 2)
+                stage = time.perf_counter()
+                vector_hits = await self._query_vectors(vector_indexes, query_embedding, candidates, nprobe)
+                timings["ann"] = any(index.ann_active for index in vector_indexes)
+                timings["vector_ms"] = _elapsed_ms(stage)
+            except asyncio.TimeoutError:
+                timings["vector_timeout"] = True
+                print(f"[KnowledgeService] Vector path missed {deadline * 1000:.0f}ms deadline, using keyword results only")
+            except Exception as e:
+                timings["vector_error"] = str(e)
+                print(f"[KnowledgeService] Vector path failed, using keyword results only: {e}")
+        
+        stage = time.perf_counter()
+        fused = reciprocal_rank_fusion([lexical_hits, vector_hits], k=rrf_k)
+        sources = {chunk_id: "keyword" for chunk_id, _ in lexical_hits}
+        for chunk_id, _ in vector_hits:
+            sources[chunk_id] = "hybrid" if chunk_id in sources else "vector"
+        timings["fusion_ms"] = _elapsed_ms(stage)
         
+        stage = time.perf_counter()
+        results = await self._load_hits(fused, limit, max_content_length, "Hybrid match", "rrf", sources.get)
+        timings["load_ms"] = _elapsed_ms(stage)
         return results
     
-    async def keyword_search(self, query: str, limit: int = 3, max_content_length: int = 500) -> List[KnowledgeBase]:
-        """关键词匹配检索"""
-        keywords = list(jieba.cut(query))
-        keywords = [k.strip() for k in keywords if len(k.strip()) > 1]
+    @staticmethod
+    async def _timed_embed_query(embed_service: EmbeddingService, query: str):
+        """获取查询向量并返回耗时；整体超时兜底，避免后台请求无限挂起"""
+        start = time.perf_counter()
+        embedding = await asyncio.wait_for(
+            embed_service.embed_query(query),
+            timeout=settings.knowledge_vector_timeout
+        )
+        return embedding, time.perf_counter() - start
+    
+    async def vector_search(
+        self,
+        query: str,
+        limit: int = 3,
+        max_content_length: int = 500,
+        nprobe: int = None,
+        partitions: Tuple[str, ...] = None
+    ) -> List[KnowledgeHit]:
+        """向量语义检索（基于常驻内存的向量索引）"""
+        indexes = await self._built_indexes(KnowledgeIndex, partitions)
         
-        if not keywords:
+        if not any(index.size > 0 for index in indexes):
+            print("[KnowledgeService] No knowledge entries with embeddings found")
             return []
         
-        conditions = []
-        for kw in keywords[:5]:
-            conditions.append(KnowledgeBase.keywords.contains(kw))
-            conditions.append(KnowledgeBase.title.contains(kw))
-        
-        result = await self.db.execute(
-            select(KnowledgeBase)
-            .where(KnowledgeBase.is_active == True)
-            .where(or_(*conditions))
-            .limit(limit)
+        # 获取查询向量（超时则由search回退到关键词检索）
+        embed_service = await self.get_embedding_service()
+        query_embedding = await asyncio.wait_for(
+            embed_service.embed_query(query),
+            timeout=settings.knowledge_vector_timeout
         )
-        results = result.scalars().all()
         
-        for kb in results:
-            if len(kb.content) > max_content_length:
-                kb.content = kb.content[:max_content_length] + "...(已截断)"
-        
-        return results
+        # 计算相似度
+        hits = await self._query_vectors(indexes, query_embedding, limit * PASSAGES_PER_RESULT, nprobe)
+        return await self._load_hits(hits, limit, max_content_length, "Vector match", "score", lambda _: "vector")
+    
+    async def keyword_search(self, query: str, limit: int = 3, max_content_length: int = 500, partitions: Tuple[str, ...] = None) -> List[KnowledgeHit]:
+        """关键词检索（基于常驻内存的BM25倒排索引，按相关度排序）"""
+        indexes = await self._built_indexes(LexicalIndex, partitions)
+        hits = LexicalIndex.search_many(indexes, query, top_k=limit * PASSAGES_PER_RESULT)
+        return await self._load_hits(hits, limit, max_content_length, "Keyword match", "bm25", lambda _: "keyword")
     
-    async def rebuild_embeddings(self) -> int:
-        """重建所有知识库条目的向量"""
-        global rebuild_progress
+    async def _load_hits(
+        self,
+        hits: List[Tuple[int, float]],
+        limit: int,
+        max_content_length: int,
+        label: str,
+        score_name: str,
+        source_of: Callable[[int], str]
+    ) -> List[KnowledgeHit]:
+        """按段落命中顺序为每个条目取得分最高的段落，构造检索结果
+        
+        只按列查询段落内容和条目标题，不加载ORM对象（不读取embedding列和全文，也不会弄脏会话）。
+        source_of(段落id)返回该段落的命中来源。
+        """
+        if not hits:
+            return []
         
         result = await self.db.execute(
-            select(KnowledgeBase).where(KnowledgeBase.is_active == True)
+            select(KnowledgeChunk.id, KnowledgeChunk.kb_id, KnowledgeChunk.content, KnowledgeBase.title)
+            .join(KnowledgeBase, KnowledgeBase.id == KnowledgeChunk.kb_id)
+            .where(KnowledgeChunk.id.in_([chunk_id for chunk_id, _ in hits]))
         )
-        all_kb = result.scalars().all()
-        
-        rebuild_progress["running"] = True
-        rebuild_progress["current"] = 0
-        rebuild_progress["total"] = len(all_kb)
-        rebuild_progress["message"] = "正在初始化..."
+        chunks = {row.id: row for row in result.all()}
         
-        embed_service = await self.get_embedding_service()
-        count = 0
-        for i, kb in enumerate(all_kb):
-            rebuild_progress["current"] = i + 1
-            rebuild_progress["message"] = f"正在处理: {kb.title[:20]}..."
-            try:
-                embed_text = f"{kb.title} {kb.content[:500]}"
-                embedding = await embed_service.embed(embed_text)
-                kb.embedding = json.dumps(embedding)
-                count += 1
-            except Exception as e:
-                print(f"[KnowledgeService] Embed failed for {kb.id}: {e}")
+        results = []
+        seen = set()
+        for chunk_id, score in hits:
+            chunk = chunks.get(chunk_id)
+            if chunk is None or chunk.kb_id in seen:
+                continue
+            seen.add(chunk.kb_id)
+            snippet = chunk.content
+            # 截断过长内容
+            if len(snippet) > max_content_length:
+                snippet = snippet[:max_content_length] + TRUNCATED_SUFFIX
+            results.append(KnowledgeHit(chunk.kb_id, chunk.title, snippet, score, source_of(chunk_id), chunk_id))
+            print(f"[KnowledgeService] {label}: {chunk.title} ({score_name}: {score:.3f})")
+            if len(results) >= limit:
+                break
         
-        await self.db.commit()
-        rebuild_progress["running"] = False
-        rebuild_progress["message"] = "完成"
-        return count
+        return results
     
-    async def get_all(self, skip: int = 0, limit: int = 100, active_only: bool = False):
+    async def rebuild_embeddings(self, force: bool = False) -> bool:
+        """在后台重建知识库向量（分批并发，跳过未变化的条目），已在运行时返回False"""
+        worker = await EmbeddingWorker.get_instance()
+        return await worker.start_rebuild(force=force)
+    
+    async def get_all(self, skip: int = 0, limit: int = 100, active_only: bool = False, load_embedding: bool = True, bot_id: str = None):
+        """bot_id为None时返回全部条目，空字符串只返回共享知识，否则只返回该bot的专属知识"""
         query = select(KnowledgeBase)
+        if not load_embedding:
+            query = query.options(defer(KnowledgeBase.embedding))
         if active_only:
             query = query.where(KnowledgeBase.is_active == True)
+        if bot_id is not None:
+            query = query.where(partition_filter(bot_id))
         query = query.offset(skip).limit(limit)
         
         result = await self.db.execute(query)
         return result.scalars().all()
     
-    async def get_total_count(self, active_only: bool = False) -> int:
-        """获取知识库条目总数"""
+    async def get_total_count(self, active_only: bool = False, bot_id: str = None) -> int:
+        """获取知识库条目总数（bot_id含义同get_all）"""
         from sqlalchemy import func
         query = select(func.count(KnowledgeBase.id))
         if active_only:
             query = query.where(KnowledgeBase.is_active == True)
+        if bot_id is not None:
+            query = query.where(partition_filter(bot_id))
         result = await self.db.execute(query)
         return result.scalar() or 0
     
@@ -224,13 +693,27 @@ class KnowledgeService:
         await self.db.commit()
         return result.rowcount
     
+    async def batch_update_bot(self, kb_ids: List[int], bot_id: str = None) -> int:
+        """批量设置条目所属的bot（为空时改为共享知识），并移动到对应的索引分区"""
+        result = await self.db.execute(
+            update(KnowledgeBase)
+            .where(KnowledgeBase.id.in_(kb_ids))
+            .values(bot_id=bot_id or None)
+        )
+        await self.db.commit()
+        
+        await self._sync_indexes(kb_ids)
+        return result.rowcount
+    
     async def batch_delete(self, kb_ids: List[int]) -> int:
         """批量删除知识库条目"""
-        from sqlalchemy import delete as sql_delete
+        await self.db.execute(sql_delete(KnowledgeChunk).where(KnowledgeChunk.kb_id.in_(kb_ids)))
         result = await self.db.execute(
             sql_delete(KnowledgeBase).where(KnowledgeBase.id.in_(kb_ids))
         )
         await self.db.commit()
+        
+        await self._sync_indexes(kb_ids)
         return result.rowcount
     
     async def batch_toggle_active(self, kb_ids: List[int], is_active: bool) -> int:
@@ -242,4 +725,10 @@ class KnowledgeService:
             .values(is_active=is_active)
         )
         await self.db.commit()
+        
+        await self._sync_indexes(kb_ids)
+        if is_active:
+            # 禁用期间可能错过了更新，交给后台按哈希/模型检查
+            worker = await EmbeddingWorker.get_instance()
+            worker.enqueue(kb_ids)
         return result.rowcount
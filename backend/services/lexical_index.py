@@ -0,0 +1,315 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database.models import KnowledgeBase, KnowledgeChunk
+from config import get_settings
+from typing import List, Dict, Iterable, Set, Tuple, Optional
+from collections import defaultdict
+import asyncio
+import heapq
+import logging
+import math
+import os
+import re
+import time
+import jieba
+from .knowledge_index import SHARED_PARTITION, partition_filter, knowledge_partitions
+
+settings = get_settings()
+jieba.setLogLevel(logging.WARNING)  # 加载耗时由预热统一输出
+
+# 字段权重：标题和关键词命中比正文更重要
+TITLE_WEIGHT = 3.0
+KEYWORDS_WEIGHT = 3.0
+CONTENT_WEIGHT = 1.0
+
+_WORD_RE = re.compile(r"\w", re.UNICODE)
+_TERM_SPLIT_RE = re.compile(r"[^\w]+", re.UNICODE)
+_KEYWORD_SPLIT_RE = re.compile(r"[,，、;；\s]+")
+MAX_TITLE_TERM_LENGTH = 8  # 标题中更长的片段多为句子，不作为词
+MAX_KEYWORD_LENGTH = 20
+
+# 提问中常见但没有区分度的词
+STOPWORDS = {
+    "怎么", "怎样", "怎么办", "如何", "什么", "为什么", "为何", "哪里", "哪个",
+    "是否", "可以", "能否", "一个", "这个", "那个", "请问", "我们", "你们",
+    "他们", "没有", "不是", "就是", "还是", "已经", "the", "and", "how", "what"
+}
+
+
+def tokenize(text: str, tokenizer: Optional[jieba.Tokenizer] = None) -> List[str]:
+    """jieba搜索模式分词，去掉空白、标点和单字符噪声；tokenizer默认为全局分词器（含领域词）"""
+    if not text:
+        return []
+    tokens = []
+    for token in (tokenizer or jieba.dt).cut_for_search(text):
+        token = token.strip().lower()
+        # 单字区分度太低，和原关键词检索一样只保留两个字符以上的词
+        if len(token) > 1 and token not in STOPWORDS and _WORD_RE.search(token):
+            tokens.append(token)
+    return tokens
+
+
+def init_jieba(cache_file: Optional[str] = None, tokenizer: Optional[jieba.Tokenizer] = None) -> float:
+    """加载jieba前缀词典（默认为全局分词器），返回耗时(秒)
+    
+    词典缓存写入cache_file（默认在系统临时目录，容器重启后会丢失），之后启动直接读取缓存。
+    """
+    tokenizer = tokenizer or jieba.dt
+    start = time.perf_counter()
+    if cache_file and not tokenizer.initialized:
+        path = os.path.abspath(cache_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tokenizer.tmp_dir = os.path.dirname(path)
+        tokenizer.cache_file = os.path.basename(path)
+    tokenizer.initialize()
+    return time.perf_counter() - start
+
+
+def domain_terms(title: str, keywords: str) -> Set[str]:
+    """从条目标题和关键词中提取领域词：关键词整体作为词，标题按标点和空白切分后取较短的片段"""
+    terms = set()
+    for keyword in _KEYWORD_SPLIT_RE.split(keywords or ""):
+        if 1 < len(keyword) <= MAX_KEYWORD_LENGTH:
+            terms.add(keyword.strip())
+    for part in _TERM_SPLIT_RE.split(title or ""):
+        if 1 < len(part) <= MAX_TITLE_TERM_LENGTH and not part.isdigit():
+            terms.add(part)
+    return {term for term in terms if term.lower() not in STOPWORDS}
+
+
+def load_user_terms(terms: Iterable[str]) -> int:
+    """将领域词加入jieba用户词典，返回新增的词数"""
+    jieba.dt.check_initialized()
+    added = 0
+    for term in terms:
+        if not jieba.dt.FREQ.get(term):
+            jieba.add_word(term)
+            added += 1
+    return added
+
+
+class LexicalIndex:
+    """常驻内存的BM25倒排索引（以段落为文档：条目标题、关键词、段落正文）
+    
+    替代 LIKE '%kw%' 全表扫描，返回带分数的排序结果；
+    与向量索引一样在知识库写入时增量更新，批量变更后按版本号重建；与向量索引同样按bot分区。
+    """
+    
+    _instances: Dict[str, "LexicalIndex"] = {}
+    _lock = asyncio.Lock()
+    
+    def __init__(self, partition: str = SHARED_PARTITION, k1: float = 1.5, b: float = 0.75):
+        self.partition = partition
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[int, float]] = defaultdict(dict)  # term -> {段落id: 加权词频}
+        self._doc_terms: Dict[int, Dict[str, float]] = {}  # 段落id -> {term: 加权词频}
+        self._doc_len: Dict[int, float] = {}
+        self._doc_owner: Dict[int, int] = {}  # 段落id -> 条目id
+        self._entry_docs: Dict[int, Set[int]] = defaultdict(set)  # 条目id -> 段落id
+        self._total_len = 0.0
+        self.user_terms = 0  # 从知识库标题和关键词加入jieba的词数
+        self.warmup_stats: Dict = {}
+        self._version = 0
+        self._built_version = -1
+        self._build_lock = asyncio.Lock()
+    
+    @classmethod
+    async def get_instance(cls, partition: str = SHARED_PARTITION) -> "LexicalIndex":
+        """获取分区的实例（每个分区一个单例）"""
+        if partition not in cls._instances:
+            async with cls._lock:
+                if partition not in cls._instances:
+                    cls._instances[partition] = cls(partition)
+        return cls._instances[partition]
+    
+    @classmethod
+    def all_instances(cls) -> List["LexicalIndex"]:
+        """已创建的全部分区实例"""
+        return list(cls._instances.values())
+    
+    @property
+    def version(self) -> int:
+        return self._version
+    
+    @property
+    def size(self) -> int:
+        return len(self._doc_terms)
+    
+    @property
+    def is_current(self) -> bool:
+        return self._built_version == self._version
+    
+    def invalidate(self):
+        """标记索引过期，下次检索时从数据库重建"""
+        self._version += 1
+    
+    async def ensure_built(self, db: AsyncSession):
+        """版本号变化时从数据库重建倒排表"""
+        if self.is_current:
+            return
+        async with self._build_lock:
+            if self.is_current:
+                return
+            target_version = self._version
+            result = await db.execute(
+                select(KnowledgeChunk.id, KnowledgeChunk.kb_id, KnowledgeBase.title, KnowledgeBase.keywords, KnowledgeChunk.content)
+                .join(KnowledgeBase, KnowledgeBase.id == KnowledgeChunk.kb_id)
+                .where(KnowledgeBase.is_active == True)
+                .where(partition_filter(self.partition))
+            )
+            rows = result.all()
+            # 先加入领域词再分词，同一次构建内分词结果一致；之后新增的词在下次重建时生效
+            terms = set()
+            for title, keywords in {(row.title, row.keywords) for row in rows}:
+                terms |= domain_terms(title, keywords)
+            self.user_terms += load_user_terms(terms)
+            self._clear()
+            for chunk_id, kb_id, title, keywords, content in rows:
+                self._add(chunk_id, kb_id, title, keywords, content)
+            self._built_version = target_version
+            label = f" [bot {self.partition}]" if self.partition != SHARED_PARTITION else ""
+            print(f"[LexicalIndex] Built index{label}: {self.size} docs, {len(self._postings)} terms, version={target_version}")
+    
+    def get_stats(self) -> Dict:
+        return {
+            "partition": self.partition,
+            "docs": self.size,
+            "terms": len(self._postings),
+            "user_terms": self.user_terms,
+            "warmup": self.warmup_stats
+        }
+    
+    async def warmup(self, db: AsyncSession) -> Dict:
+        """启动时预加载jieba词典（在线程中执行）并构建全部分区的索引，避免首个提问承担数秒的加载耗时"""
+        start = time.perf_counter()
+        jieba_seconds = await asyncio.to_thread(init_jieba, settings.jieba_cache_file)
+        stage = time.perf_counter()
+        indexes = [await LexicalIndex.get_instance(partition) for partition in await knowledge_partitions(db)]
+        for index in indexes:
+            await index.ensure_built(db)
+        user_terms = sum(index.user_terms for index in indexes)
+        docs = sum(index.size for index in indexes)
+        self.warmup_stats = {
+            "jieba_ms": round(jieba_seconds * 1000, 2),
+            "index_ms": round((time.perf_counter() - stage) * 1000, 2),
+            "total_ms": round((time.perf_counter() - start) * 1000, 2),
+            "user_terms": user_terms,
+            "docs": docs,
+            "partitions": len(indexes)
+        }
+        print(f"[LexicalIndex] Warmup finished in {self.warmup_stats['total_ms']}ms "
+              f"(jieba={self.warmup_stats['jieba_ms']}ms, index={self.warmup_stats['index_ms']}ms, "
+              f"user_terms={user_terms}, docs={docs}, partitions={len(indexes)})")
+        return self.warmup_stats
+    
+    def _clear(self):
+        self._postings = defaultdict(dict)
+        self._doc_terms = {}
+        self._doc_len = {}
+        self._doc_owner = {}
+        self._entry_docs = defaultdict(set)
+        self._total_len = 0.0
+    
+    def _add(self, chunk_id: int, kb_id: int, title: str, keywords: str, content: str):
+        terms: Dict[str, float] = defaultdict(float)
+        for token in tokenize(title):
+            terms[token] += TITLE_WEIGHT
+        for token in tokenize((keywords or "").replace(",", " ").replace("，", " ")):
+            terms[token] += KEYWORDS_WEIGHT
+        for token in tokenize(content):
+            terms[token] += CONTENT_WEIGHT
+        
+        self._doc_terms[chunk_id] = dict(terms)
+        doc_len = sum(terms.values())
+        self._doc_len[chunk_id] = doc_len
+        self._total_len += doc_len
+        self._doc_owner[chunk_id] = kb_id
+        self._entry_docs[kb_id].add(chunk_id)
+        for term, tf in terms.items():
+            self._postings[term][chunk_id] = tf
+    
+    def _discard(self, chunk_id: int):
+        terms = self._doc_terms.pop(chunk_id, None)
+        if terms is None:
+            return
+        self._total_len -= self._doc_len.pop(chunk_id, 0.0)
+        kb_id = self._doc_owner.pop(chunk_id, None)
+        docs = self._entry_docs.get(kb_id)
+        if docs is not None:
+            docs.discard(chunk_id)
+            if not docs:
+                del self._entry_docs[kb_id]
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(chunk_id, None)
+                if not posting:
+                    del self._postings[term]
+    
+    def _apply(self, mutate):
+        """对已构建的索引做增量修改；索引已过期时只递增版本号"""
+        current = self.is_current
+        self._version += 1
+        if current:
+            mutate()
+            self._built_version = self._version
+    
+    def upsert(self, chunk_id: int, kb_id: int, title: str, keywords: str, content: str):
+        """新增或替换一个段落"""
+        def mutate():
+            self._discard(chunk_id)
+            self._add(chunk_id, kb_id, title, keywords, content)
+        
+        self._apply(mutate)
+    
+    def remove(self, chunk_ids: Iterable[int]):
+        """移除段落"""
+        chunk_ids = list(chunk_ids)
+        
+        def mutate():
+            for chunk_id in chunk_ids:
+                self._discard(chunk_id)
+        
+        self._apply(mutate)
+    
+    def remove_entries(self, kb_ids: Iterable[int]):
+        """移除条目的全部段落（删除、禁用或重新分段时调用）"""
+        kb_ids = list(kb_ids)
+        
+        def mutate():
+            for kb_id in kb_ids:
+                for chunk_id in list(self._entry_docs.get(kb_id, ())):
+                    self._discard(chunk_id)
+        
+        self._apply(mutate)
+    
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[int, float]]:
+        """BM25检索，返回 [(段落id, score), ...]，按分数降序"""
+        return self.search_many([self], query, top_k)
+    
+    @staticmethod
+    def search_many(indexes: List["LexicalIndex"], query: str, top_k: int = 3) -> List[Tuple[int, float]]:
+        """在多个分区中做BM25检索，文档数、平均长度和文档频率按这些分区合计
+        
+        分数与把这些分区合成一个索引时相同；否则只有几条知识的bot分区IDF极低，专属知识会被共享知识压过。
+        """
+        n_docs = sum(len(index._doc_terms) for index in indexes)
+        if n_docs == 0 or top_k <= 0:
+            return []
+        
+        avg_len = sum(index._total_len for index in indexes) / n_docs
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = [(index, index._postings.get(term)) for index in indexes]
+            postings = [(index, posting) for index, posting in postings if posting]
+            if not postings:
+                continue
+            df = sum(len(posting) for _, posting in postings)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for index, posting in postings:
+                for chunk_id, tf in posting.items():
+                    norm = index.k1 * (1 - index.b + index.b * index._doc_len[chunk_id] / avg_len)
+                    scores[chunk_id] += idf * tf * (index.k1 + 1) / (tf + norm)
+        
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
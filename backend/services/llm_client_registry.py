@@ -0,0 +1,183 @@
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from typing import Dict, Optional, Set, Tuple
+import asyncio
+import importlib.util
+import httpx
+import time
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None  # HTTP/2需要安装h2（httpx[http2]），否则使用HTTP/1.1长连接
+SWEEP_INTERVAL = 60.0  # 空闲客户端的清理间隔(秒)
+
+ClientKey = Tuple[str, str]
+
+
+class _ClientEntry:
+    """一个 (base_url, api_key) 的共享客户端及其连接统计（统计来自httpcore的trace事件）"""
+    
+    def __init__(self, key: ClientKey, client: AsyncOpenAI):
+        self.key = key
+        self.client = client
+        self.variants: Dict[int, AsyncOpenAI] = {}  # max_retries -> 共用连接池的客户端副本
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        self.active = 0  # 进行中的请求数
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.acquisitions = 0  # 从注册表取用次数
+        self.requests = 0  # 实际发出的HTTP请求数
+        self.connections = 0  # 新建TCP连接数
+        self.tls_handshakes = 0  # TLS握手次数
+        self.connect_errors = 0  # 建立连接失败次数
+    
+    async def trace(self, name: str, info: dict):
+        if name.endswith(".send_request_headers.started"):
+            self.requests += 1
+            self.active += 1
+        elif name.endswith(".response_closed.complete"):
+            self.active = max(0, self.active - 1)
+        elif name == "connection.connect_tcp.complete":
+            self.connections += 1
+        elif name == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+        elif name == "connection.connect_tcp.failed":
+            self.connect_errors += 1
+    
+    async def on_request(self, request: httpx.Request):
+        request.extensions["trace"] = self.trace
+    
+    @property
+    def reused(self) -> int:
+        """复用已有连接的请求数"""
+        return max(0, self.requests - self.connections)
+
+
+class LLMClientRegistry:
+    """进程内共享的 AsyncOpenAI 客户端注册表，键为 (base_url, api_key)
+    
+    同一端点的所有调用共用一个httpx连接池（长连接，h2可用时启用HTTP/2），避免每次对话都重新握手；
+    空闲超过 idle_ttl 且没有进行中请求的客户端会被关闭，应用关闭时 close() 释放全部连接。
+    """
+    
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 60.0, http2: bool = True, idle_ttl: float = 900.0):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http2 = http2 and HTTP2_AVAILABLE
+        if http2 and not HTTP2_AVAILABLE:
+            print("[LLMClients] HTTP/2 requested but h2 is not installed (pip install 'httpx[http2]'), using HTTP/1.1")
+        self.idle_ttl = idle_ttl
+        self._entries: Dict[ClientKey, _ClientEntry] = {}
+        self._closing: Set[asyncio.Task] = set()
+        self._last_sweep = time.monotonic()
+        self.created = 0
+        self.evicted = 0
+    
+    @staticmethod
+    def client_key(base_url: str, api_key: str) -> ClientKey:
+        return (str(base_url or "").rstrip("/"), api_key or "")
+    
+    def get(self, base_url: str, api_key: str, max_retries: Optional[int] = None) -> AsyncOpenAI:
+        """获取端点的共享客户端；max_retries 不为None时返回共用连接池、重试次数不同的副本"""
+        self._sweep()
+        key = self.client_key(base_url, api_key)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._create(key)
+        entry.last_used = time.monotonic()
+        entry.acquisitions += 1
+        if max_retries is None:
+            return entry.client
+        variant = entry.variants.get(max_retries)
+        if variant is None:
+            variant = entry.variants[max_retries] = entry.client.with_options(max_retries=max_retries)
+        return variant
+    
+    def _create(self, key: ClientKey) -> _ClientEntry:
+        http_client = DefaultAsyncHttpxClient(limits=self.limits, http2=self.http2)
+        entry = _ClientEntry(key, AsyncOpenAI(base_url=key[0], api_key=key[1], http_client=http_client))
+        http_client.event_hooks["request"].append(entry.on_request)
+        self._entries[key] = entry
+        self.created += 1
+        return entry
+    
+    def _sweep(self):
+        """关闭空闲过久的客户端（每 SWEEP_INTERVAL 秒最多检查一次）"""
+        now = time.monotonic()
+        if self.idle_ttl <= 0 or now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        idle = [
+            key for key, entry in self._entries.items()
+            if entry.active == 0 and now - entry.last_used > self.idle_ttl
+        ]
+        for key in idle:
+            entry = self._entries.pop(key)
+            self.evicted += 1
+            try:
+                task = asyncio.get_running_loop().create_task(entry.client.close())
+            except RuntimeError:
+                continue
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        if idle:
+            print(f"[LLMClients] Evicted {len(idle)} idle clients")
+    
+    async def close(self):
+        """关闭所有客户端（应用关闭时调用）"""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            try:
+                await entry.client.close()
+            except Exception as e:
+                print(f"[LLMClients] Error closing client for {entry.key[0]}: {e}")
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+        if entries:
+            print(f"[LLMClients] Closed {len(entries)} clients")
+    
+    def reset_stats(self):
+        for entry in self._entries.values():
+            entry.reset_stats()
+        self.created = len(self._entries)
+        self.evicted = 0
+    
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        clients = []
+        for (base_url, api_key), entry in self._entries.items():
+            masked_key = api_key[:8] + "****" + api_key[-4:] if len(api_key) > 12 else "****"
+            clients.append({
+                "base_url": base_url,
+                "api_key": masked_key,
+                "acquisitions": entry.acquisitions,
+                "requests": entry.requests,
+                "active": entry.active,
+                "connections": entry.connections,
+                "tls_handshakes": entry.tls_handshakes,
+                "connect_errors": entry.connect_errors,
+                "reused": entry.reused,
+                "reuse_rate": round(entry.reused / entry.requests * 100, 1) if entry.requests > 0 else 0,
+                "idle_seconds": round(now - entry.last_used, 1)
+            })
+        requests = sum(c["requests"] for c in clients)
+        reused = sum(c["reused"] for c in clients)
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "idle_ttl": self.idle_ttl,
+            "created": self.created,
+            "evicted": self.evicted,
+            "requests": requests,
+            "connections": sum(c["connections"] for c in clients),
+            "tls_handshakes": sum(c["tls_handshakes"] for c in clients),
+            "reused": reused,
+            "reuse_rate": round(reused / requests * 100, 1) if requests > 0 else 0,
+            "clients": clients
+        }
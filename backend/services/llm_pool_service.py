@@ -2,11 +2,82 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from database.models import SystemConfig
 from openai import AsyncOpenAI
-from typing import List, Dict, Optional
+from config import get_settings
+from collections import deque
+from itertools import islice
+from typing import List, Dict, Optional, Tuple
 import json
 import asyncio
+import math
 import random
 import time
+from .llm_client_registry import LLMClientRegistry
+from .circuit_breaker import CircuitBreaker
+from .hedge_policy import HedgePolicy
+
+settings = get_settings()
+
+STRATEGIES = ("weighted", "adaptive")  # 路由策略：weighted(按权重随机) / adaptive(EWMA延迟+错误率，二选一)
+FAILURE_COST_MS = 30000.0  # adaptive策略中一次失败折算的延迟(毫秒)：代价 = 延迟 + 错误率 × 该值（快速失败的模型不会显得更快）
+STATS_SAVE_INTERVAL = 10.0  # 调用统计写回数据库的最小间隔(秒)，配置变更仍立即保存
+COUNTER_FIELDS = ("request_count", "success_count", "fail_count", "total_response_time", "avg_response_time")
+
+
+def _number_setting(name: str, value, cast):
+    """把设置值转换为数字（接受数字或数字字符串）；None表示不修改，非法值抛出ValueError"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name}必须是数字")
+    try:
+        number = cast(float(value)) if cast is int else cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name}必须是数字")
+    if not math.isfinite(number):
+        raise ValueError(f"{name}必须是有限的数字")
+    return number
+
+
+class _ModelStats:
+    """一个模型条目的运行统计：持久化的调用计数、EWMA路由统计（仅内存）和熔断器"""
+    
+    __slots__ = ("request_count", "success_count", "fail_count", "total_response_time",
+                 "latency", "ttft", "error_rate", "updated_at", "breaker")
+    
+    def __init__(self, counters: Dict = None):
+        counters = counters or {}
+        self.request_count = counters.get("request_count", 0)
+        self.success_count = counters.get("success_count", 0)
+        self.fail_count = counters.get("fail_count", 0)
+        self.total_response_time = counters.get("total_response_time", 0)  # 总响应时间(ms)
+        self.reset_routing()
+    
+    def reset_routing(self):
+        self.latency = None
+        self.ttft = None
+        self.error_rate = None
+        self.updated_at = 0.0
+        self.breaker: Optional[CircuitBreaker] = None
+    
+    def reset_counters(self):
+        self.request_count = 0
+        self.success_count = 0
+        self.fail_count = 0
+        self.total_response_time = 0
+    
+    @property
+    def avg_response_time(self) -> float:
+        total = self.success_count + self.fail_count
+        return round(self.total_response_time / total, 2) if total > 0 else 0
+    
+    def counters(self) -> Dict:
+        return {
+            "request_count": self.request_count,
+            "success_count": self.success_count,
+            "fail_count": self.fail_count,
+            "total_response_time": self.total_response_time,
+            "avg_response_time": self.avg_response_time
+        }
 
 
 class LLMPoolService:
@@ -14,17 +85,35 @@ class LLMPoolService:
     
     _instance = None
     _lock = asyncio.Lock()
+    # 进程内共享的端点客户端（连接池复用），对话、记忆总结和向量化共用
+    clients = LLMClientRegistry(
+        max_connections=settings.llm_max_connections,
+        max_keepalive_connections=settings.llm_max_keepalive_connections,
+        keepalive_expiry=settings.llm_keepalive_expiry,
+        http2=settings.llm_http2,
+        idle_ttl=settings.llm_client_idle_ttl
+    )
     
     def __init__(self):
-        self._pool: List[Dict] = []  # [{base_url, api_key, model, name, enabled, weight, group, ...}]
+        self._pool: List[Dict] = []  # [{id, base_url, api_key, model, name, enabled, weight, group}]
+        self._next_id = 1  # 模型条目的稳定id（保存在配置中，不随增删变化）
+        self._stats: Dict[int, _ModelStats] = {}  # 模型id -> 运行统计
+        self._index: Dict[Tuple[str, str, str], int] = {}  # (base_url, api_key, 模型名) -> 模型id，完全相同的条目使用第一个
+        self._external_stats: Dict[Tuple[str, str, str], _ModelStats] = {}  # 不在池中的模型（主API）的统计
+        self._needs_save = False
+        self._last_saved = 0.0
         self._current_index = 0
         self._loaded = False
         self._retry_count = 3  # 报错重试次数
         self._retry_on_error = True  # 是否启用报错重试
         self._version = 0  # 配置版本号，用于缓存刷新
-        self._call_logs: List[Dict] = []  # 调用日志
-        self._max_logs = 100  # 最多保留日志条数
+        self._max_logs = settings.llm_call_log_size  # 最多保留日志条数
+        self._call_logs = deque(maxlen=self._max_logs)  # 调用日志（环形缓冲，旧日志自动淘汰）
+        self._log_seq = 0  # 最新日志的序号（日志游标）
         self._groups: List[str] = []  # 分组列表
+        self._strategy = "weighted"  # 未指定分组时的路由策略
+        self._group_strategies: Dict[str, str] = {}  # 分组 -> 路由策略（未设置的分组使用默认策略）
+        self.hedge = HedgePolicy()  # 慢首字对冲请求（默认关闭）
     
     @classmethod
     async def get_instance(cls) -> "LLMPoolService":
@@ -47,11 +136,17 @@ class LLMPoolService:
                 data = json.loads(config.value)
                 # 支持新旧格式
                 if isinstance(data, list):
-                    self._pool = data
+                    models = data
                 else:
-                    self._pool = data.get("models", [])
+                    models = data.get("models", [])
                     self._retry_count = data.get("retry_count", 3)
                     self._retry_on_error = data.get("retry_on_error", True)
+                    self._strategy = data.get("strategy", "weighted")
+                    self._group_strategies = data.get("group_strategies", {})
+                    self.hedge.enabled = data.get("hedge_enabled", False)
+                    self.hedge.quantile = data.get("hedge_quantile", 0.9)
+                    self.hedge.max_rate = data.get("hedge_max_rate", 0.1)
+                self._load_models(models)
                 self._loaded = True
                 print(f"[LLMPool] Loaded {len(self._pool)} models, retry={self._retry_count}")
             except json.JSONDecodeError:
@@ -59,30 +154,69 @@ class LLMPoolService:
         
         return self._pool
     
+    def _load_models(self, models: List[Dict]):
+        """载入模型条目：计数字段移入运行统计，旧配置中没有id的条目分配id；已在内存中的统计保留"""
+        self._next_id = max([m["id"] for m in models if isinstance(m.get("id"), int)] + [0]) + 1
+        for m in models:
+            counters = {field: m.pop(field) for field in COUNTER_FIELDS if field in m}
+            if not isinstance(m.get("id"), int):
+                m["id"] = self._next_id
+                self._next_id += 1
+            if m["id"] not in self._stats:
+                self._stats[m["id"]] = _ModelStats(counters)
+        self._pool = models
+        self._reindex()
+    
+    def _reindex(self):
+        """重建 (base_url, api_key, 模型名) -> 模型id 的索引，并丢弃已删除条目的统计"""
+        self._index = {}
+        for m in self._pool:
+            self._index.setdefault(self._route_key(m), m["id"])
+        live = {m["id"] for m in self._pool}
+        for model_id in [i for i in self._stats if i not in live]:
+            del self._stats[model_id]
+    
+    def _pool_id(self, model: Dict) -> Optional[int]:
+        """模型对应的池中条目id：优先使用条目自带的id，否则按 (base_url, api_key, 模型名) 查找；不在池中时为None"""
+        model_id = model.get("id")
+        if model_id in self._stats:
+            return model_id
+        return self._index.get(self._route_key(model))
+    
+    def _stats_for(self, model: Dict) -> _ModelStats:
+        """查找模型条目的运行统计（O(1)）；同一端点、不同api_key的条目各自统计，不在池中的模型单独统计"""
+        model_id = self._pool_id(model)
+        if model_id is not None:
+            return self._stats[model_id]
+        key = self._route_key(model)
+        stats = self._external_stats.get(key)
+        if stats is None:
+            stats = self._external_stats[key] = _ModelStats()
+        return stats
     
     def add_model(self, base_url: str, api_key: str, model: str, name: str = None, 
                    weight: int = 1, group: str = ""):
         """添加模型到池"""
         self._pool.append({
+            "id": self._next_id,
             "base_url": base_url,
             "api_key": api_key,
             "model": model,
             "name": name or model,
             "enabled": True,
             "weight": max(1, weight),  # 权重最小为1
-            "group": group,
-            "request_count": 0,
-            "success_count": 0,
-            "fail_count": 0,
-            "total_response_time": 0,  # 总响应时间(ms)
-            "avg_response_time": 0  # 平均响应时间(ms)
+            "group": group
         })
+        self._stats[self._next_id] = _ModelStats()
+        self._next_id += 1
+        self._reindex()
         self._version += 1
     
     def remove_model(self, index: int) -> bool:
         """移除模型"""
         if 0 <= index < len(self._pool):
             self._pool.pop(index)
+            self._reindex()
             if self._current_index >= len(self._pool):
                 self._current_index = 0
             return True
@@ -93,6 +227,8 @@ class LLMPoolService:
                       group: str = None) -> bool:
         """更新模型配置"""
         if 0 <= index < len(self._pool):
+            # 配置变更后旧的路由统计和熔断状态不再适用
+            self._stats[self._pool[index]["id"]].reset_routing()
             if base_url is not None:
                 self._pool[index]["base_url"] = base_url
             if api_key is not None:
@@ -105,6 +241,7 @@ class LLMPoolService:
                 self._pool[index]["weight"] = max(1, weight)
             if group is not None:
                 self._pool[index]["group"] = group
+            self._reindex()
             self._version += 1
             return True
         return False
@@ -142,14 +279,13 @@ class LLMPoolService:
         self._current_index = (self._current_index + 1) % len(enabled)
         
         # 增加请求计数
-        if "request_count" not in model:
-            model["request_count"] = 0
-        model["request_count"] += 1
+        self._stats[model["id"]].request_count += 1
+        self._needs_save = True
         
         return model
     
-    def get_next_from_list(self, models: List[Dict], group: str = None) -> Dict:
-        """从指定列表中按权重选择下一个模型"""
+    def get_next_from_list(self, models: List[Dict], group: str = None, fallback: bool = True) -> Dict:
+        """从指定列表中按分组的路由策略选择下一个模型；fallback为False时全部熔断则报错"""
         if not models:
             raise ValueError("模型列表为空")
         
@@ -159,14 +295,44 @@ class LLMPoolService:
             if not models:
                 raise ValueError(f"分组 {group} 没有可用模型")
         
-        # 按权重选择模型
-        model = self._weighted_choice(models)
+        # 跳过熔断中的模型；全部熔断时选择最早结束冷却的一个（提前探测）
+        now = time.monotonic()
+        available = [m for m in models if self.breaker(m).available(now)]
+        forced = not available
+        if forced:
+            if not fallback:
+                raise ValueError("没有可用的模型（均已熔断）")
+            available = [min(models, key=lambda m: self.breaker(m).open_until)]
+        
+        # 按模型所在分组的路由策略选择模型
+        if group:
+            strategy = self.strategy_for(group)
+        else:
+            strategy, available = self._split_by_strategy(available)
+        if strategy == "adaptive":
+            model = self._adaptive_choice(available)
+        else:
+            model = self._weighted_choice(available)
+        # 返回副本并带上请求开始时间，熔断器据此识别探测请求的结果
+        model = dict(model, acquired_at=self.breaker(model).acquire(now, force=forced))
         
         # 更新请求计数（如果是池中的模型）
         self._increment_request_count(model)
         
         return model
     
+    def _split_by_strategy(self, models: List[Dict]) -> Tuple[str, List[Dict]]:
+        """候选模型来自多个路由策略不同的分组时，按权重随机决定由哪种策略的模型承接本次请求
+        
+        先按权重抽取一个模型，取其分组策略下的全部候选：各部分被选中的概率等于其总权重占比，
+        因此weighted分组内模型的整体选中概率不变，adaptive分组的模型之间再按代价二选一。
+        """
+        strategy = self.strategy_for(models[0].get("group"))
+        if all(self.strategy_for(m.get("group")) == strategy for m in models):
+            return strategy, models
+        strategy = self.strategy_for(self._weighted_choice(models).get("group"))
+        return strategy, [m for m in models if self.strategy_for(m.get("group")) == strategy]
+    
     def _weighted_choice(self, models: List[Dict]) -> Dict:
         """按权重随机选择模型"""
         total_weight = sum(m.get("weight", 1) for m in models)
@@ -178,50 +344,126 @@ class LLMPoolService:
                 return model
         return models[-1]  # fallback
     
-    def _increment_request_count(self, model: Dict):
-        """增加模型的请求计数（通过匹配base_url和model来找到池中对应的模型）"""
-        model_base_url = str(model.get("base_url", "")).rstrip("/")
-        model_name = model.get("model", "")
+    def _adaptive_choice(self, models: List[Dict]) -> Dict:
+        """二选一（power of two choices）：按权重随机抽取两个不同的候选，取代价较低者
         
-        for m in self._pool:
-            pool_base_url = str(m.get("base_url", "")).rstrip("/")
-            if pool_base_url == model_base_url and m.get("model") == model_name:
-                if "request_count" not in m:
-                    m["request_count"] = 0
-                m["request_count"] += 1
-                self._needs_save = True
-                break
+        静态权重作为先验决定候选被抽中的概率，实际表现（EWMA延迟和错误率）决定两者中选谁；
+        变慢或出错的模型只在与同样差的模型比较时才会被选中。
+        """
+        if len(models) == 1:
+            return models[0]
+        first = self._weighted_choice(models)
+        second = self._weighted_choice([m for m in models if m is not first])
+        now = time.monotonic()
+        return min((first, second), key=lambda m: self._route_cost(m, now))
+    
+    @staticmethod
+    def _route_key(model: Dict) -> Tuple[str, str, str]:
+        return (str(model.get("base_url", "")).rstrip("/"), model.get("api_key", ""), model.get("model", ""))
+    
+    def _route_cost(self, model: Dict, now: float) -> float:
+        """模型的路由代价：EWMA首字延迟（无则用总耗时）+ 错误率折算的延迟；没有记录的模型代价为0，优先试探
+        
+        代价随距上次调用的时间指数衰减，长时间未被选中的模型会逐渐重新获得机会，以便发现其已恢复。
+        """
+        stats = self._stats_for(model)
+        if stats.error_rate is None and stats.latency is None:
+            return 0.0
+        latency = stats.ttft if stats.ttft is not None else (stats.latency or 0.0)
+        cost = latency + FAILURE_COST_MS * (stats.error_rate or 0.0)
+        decay = settings.llm_routing_decay
+        if decay > 0:
+            cost *= math.exp(-(now - stats.updated_at) / decay)
+        return cost
+    
+    def _update_route_stats(self, model: Dict, success: bool, response_time_ms: float, ttft_ms: float = None,
+                            count_result: bool = True):
+        """更新EWMA统计；失败只会拉高延迟（立即返回的错误不应让模型显得更快），count_result为False时不更新错误率"""
+        alpha = settings.llm_routing_ewma_alpha
+        
+        def ewma(current, value):
+            return value if current is None else current + alpha * (value - current)
+        
+        stats = self._stats_for(model)
+        if success:
+            stats.latency = ewma(stats.latency, response_time_ms)
+            if ttft_ms is not None:
+                stats.ttft = ewma(stats.ttft, ttft_ms)
+        else:
+            stats.latency = ewma(stats.latency, max(response_time_ms, stats.latency or 0.0))
+            if stats.ttft is not None:
+                stats.ttft = ewma(stats.ttft, max(response_time_ms, stats.ttft))
+        if count_result:
+            stats.error_rate = ewma(stats.error_rate, 0.0 if success else 1.0)
+        stats.updated_at = time.monotonic()
+    
+    def get_route_stats(self, model: Dict) -> Dict:
+        """模型的EWMA路由统计（用于展示）"""
+        stats = self._stats_for(model)
+        return {
+            "ewma_latency": round(stats.latency, 2) if stats.latency is not None else None,
+            "ewma_ttft": round(stats.ttft, 2) if stats.ttft is not None else None,
+            "ewma_error_rate": round(stats.error_rate, 4) if stats.error_rate is not None else None
+        }
+    
+    def breaker(self, model: Dict) -> CircuitBreaker:
+        """模型条目的熔断器（每个条目一个，失效的api_key不会影响同一端点的其他条目）"""
+        stats = self._stats_for(model)
+        if stats.breaker is None:
+            stats.breaker = CircuitBreaker(
+                failure_threshold=settings.llm_breaker_failure_threshold,
+                error_rate=settings.llm_breaker_error_rate,
+                window=settings.llm_breaker_window,
+                min_calls=settings.llm_breaker_min_calls,
+                cooldown=settings.llm_breaker_cooldown,
+                max_cooldown=settings.llm_breaker_max_cooldown
+            )
+        return stats.breaker
+    
+    def get_breaker_stats(self, model: Dict) -> Dict:
+        """模型的熔断状态（用于展示）"""
+        return self.breaker(model).get_stats()
     
-    def record_call_result(self, model: Dict, success: bool, response_time_ms: float, error: str = None):
-        """记录调用结果（成功率、响应时间）"""
-        # 规范化URL比较（去掉尾部斜杠）
-        model_base_url = str(model.get("base_url", "")).rstrip("/")
-        model_name = model.get("model", "")
+    def _increment_request_count(self, model: Dict):
+        """增加模型的请求计数（不在池中的只计入内存统计）"""
+        self._stats_for(model).request_count += 1
+        if self._pool_id(model) is not None:
+            self._needs_save = True
+    
+    def record_call_result(self, model: Dict, success: bool, response_time_ms: float, error: str = None,
+                           ttft_ms: float = None):
+        """记录调用结果（成功率、响应时间、首字延迟）"""
+        self._update_route_stats(model, success, response_time_ms, ttft_ms)
+        if success and ttft_ms is not None:
+            self.hedge.record_ttft(ttft_ms)
+        transition = self.breaker(model).record(success, model.get("acquired_at"))
+        if transition:
+            print(f"[LLMPool] Circuit {transition}: {model.get('name', model.get('model'))} ({model.get('base_url')})")
         
-        for m in self._pool:
-            pool_base_url = str(m.get("base_url", "")).rstrip("/")
-            if pool_base_url == model_base_url and m.get("model") == model_name:
-                # 更新成功/失败计数
-                if success:
-                    m["success_count"] = m.get("success_count", 0) + 1
-                else:
-                    m["fail_count"] = m.get("fail_count", 0) + 1
-                
-                # 更新响应时间统计
-                m["total_response_time"] = m.get("total_response_time", 0) + response_time_ms
-                total_calls = m.get("success_count", 0) + m.get("fail_count", 0)
-                if total_calls > 0:
-                    m["avg_response_time"] = round(m["total_response_time"] / total_calls, 2)
-                
-                self._needs_save = True
-                break
+        # 更新成功/失败计数和响应时间统计
+        stats = self._stats_for(model)
+        if success:
+            stats.success_count += 1
+        else:
+            stats.fail_count += 1
+        stats.total_response_time += response_time_ms
+        if self._pool_id(model) is not None:
+            self._needs_save = True
         
         # 添加调用日志
         self._add_call_log(model, success, response_time_ms, error)
     
+    def record_hedge_loss(self, model: Dict, elapsed_ms: float):
+        """对冲中被取消的请求：以已等待的时间作为首字延迟的下限更新路由统计（不计入成功/失败）"""
+        self._update_route_stats(model, True, elapsed_ms, elapsed_ms, count_result=False)
+        self.breaker(model).release(model.get("acquired_at"))
+    
     def _add_call_log(self, model: Dict, success: bool, response_time_ms: float, error: str = None):
-        """添加调用日志"""
-        log = {
+        """添加调用日志（环形缓冲，超出容量时淘汰最旧的日志）"""
+        self._log_seq += 1
+        self._call_logs.append({
+            "seq": self._log_seq,
+            "model_id": self._pool_id(model),
             "timestamp": time.time(),
             "model_name": model.get("name", model.get("model", "unknown")),
             "model": model.get("model", ""),
@@ -229,15 +471,27 @@ class LLMPoolService:
             "success": success,
             "response_time_ms": round(response_time_ms, 2),
             "error": error
-        }
-        self._call_logs.insert(0, log)
-        # 保持日志数量限制
-        if len(self._call_logs) > self._max_logs:
-            self._call_logs = self._call_logs[:self._max_logs]
+        })
     
-    def get_call_logs(self, limit: int = 50) -> List[Dict]:
-        """获取调用日志"""
-        return self._call_logs[:limit]
+    def get_call_logs(self, limit: int = 50, cursor: int = None, since: int = None) -> Dict:
+        """获取调用日志（从新到旧）
+        
+        cursor: 只返回序号小于cursor的日志（用上次返回的next_cursor向前翻页）
+        since: 只返回序号大于since的日志（用上次返回的latest轮询新日志）
+        """
+        skip = 0 if cursor is None else max(0, self._log_seq - cursor + 1)
+        logs = []
+        for log in islice(reversed(self._call_logs), skip, None):
+            if len(logs) >= limit or (since is not None and log["seq"] <= since):
+                break
+            logs.append(log)
+        oldest = self._log_seq - len(self._call_logs) + 1
+        has_more = bool(logs) and logs[-1]["seq"] > oldest and (since is None or logs[-1]["seq"] > since + 1)
+        return {
+            "logs": logs,
+            "next_cursor": logs[-1]["seq"] if has_more else None,
+            "latest": self._log_seq
+        }
     
     def get_groups(self) -> List[str]:
         """获取所有分组"""
@@ -256,14 +510,17 @@ class LLMPoolService:
         """获取模型统计信息"""
         if 0 <= index < len(self._pool):
             m = self._pool[index]
-            total = m.get("success_count", 0) + m.get("fail_count", 0)
-            success_rate = round(m.get("success_count", 0) / total * 100, 1) if total > 0 else 0
+            stats = self._stats_for(m)
+            total = stats.success_count + stats.fail_count
+            success_rate = round(stats.success_count / total * 100, 1) if total > 0 else 0
             return {
-                "request_count": m.get("request_count", 0),
-                "success_count": m.get("success_count", 0),
-                "fail_count": m.get("fail_count", 0),
+                "request_count": stats.request_count,
+                "success_count": stats.success_count,
+                "fail_count": stats.fail_count,
                 "success_rate": success_rate,
-                "avg_response_time": m.get("avg_response_time", 0)
+                "avg_response_time": stats.avg_response_time,
+                **self.get_route_stats(m),
+                "breaker": self.get_breaker_stats(m)
             }
         return None
     
@@ -272,13 +529,16 @@ class LLMPoolService:
         """获取配置版本号"""
         return self._version
     
-    def needs_save(self) -> bool:
-        """检查是否需要保存"""
-        return getattr(self, '_needs_save', False)
+    def needs_save(self, force: bool = False) -> bool:
+        """检查是否需要保存（统计有变化，且距上次保存超过 STATS_SAVE_INTERVAL 秒，避免每次请求都写入整个模型池）
+        force为True时不受间隔限制（服务退出前写回）
+        """
+        return self._needs_save and (force or time.monotonic() - self._last_saved >= STATS_SAVE_INTERVAL)
     
     def mark_saved(self):
         """标记已保存"""
         self._needs_save = False
+        self._last_saved = time.monotonic()
     
     def get_client_and_model(self, config: Dict = None) -> tuple[AsyncOpenAI, str]:
         """获取客户端和模型名，如果config为空则轮流选择"""
@@ -288,11 +548,12 @@ class LLMPoolService:
         if config is None:
             raise ValueError("No available model in pool")
         
-        client = AsyncOpenAI(
-            base_url=config["base_url"],
-            api_key=config["api_key"]
-        )
-        return client, config["model"]
+        return self.get_client(config["base_url"], config["api_key"]), config["model"]
+    
+    @classmethod
+    def get_client(cls, base_url: str, api_key: str, max_retries: int = None) -> AsyncOpenAI:
+        """获取端点的共享客户端（同一base_url+api_key复用连接池）"""
+        return cls.clients.get(base_url, api_key, max_retries)
     
     def is_pool_enabled(self) -> bool:
         """检查是否启用了模型池（至少有一个模型）"""
@@ -318,34 +579,70 @@ class LLMPoolService:
     def retry_on_error(self, value: bool):
         self._retry_on_error = value
     
+    def strategy_for(self, group: str = None) -> str:
+        """分组的路由策略，未单独设置的分组（及不指定分组时）使用默认策略"""
+        return self._group_strategies.get(group or "") or self._strategy
+    
     def get_settings(self) -> Dict:
         """获取模型池设置"""
         return {
             "retry_count": self._retry_count,
-            "retry_on_error": self._retry_on_error
+            "retry_on_error": self._retry_on_error,
+            "strategy": self._strategy,
+            "group_strategies": self._group_strategies,
+            "hedge_enabled": self.hedge.enabled,
+            "hedge_quantile": self.hedge.quantile,
+            "hedge_max_rate": self.hedge.max_rate
         }
     
-    def update_settings(self, retry_count: int = None, retry_on_error: bool = None):
-        """更新模型池设置"""
+    def update_settings(self, retry_count: int = None, retry_on_error: bool = None,
+                        strategy: str = None, group_strategies: Dict[str, str] = None,
+                        hedge_enabled: bool = None, hedge_quantile: float = None, hedge_max_rate: float = None):
+        """更新模型池设置；group_strategies 中策略为空的分组恢复为默认策略
+        
+        先校验并转换全部参数，任一参数非法时抛出ValueError且不修改任何设置。
+        """
+        retry_count = _number_setting("retry_count", retry_count, int)
+        hedge_quantile = _number_setting("hedge_quantile", hedge_quantile, float)
+        hedge_max_rate = _number_setting("hedge_max_rate", hedge_max_rate, float)
+        for name, value in (("retry_on_error", retry_on_error), ("hedge_enabled", hedge_enabled)):
+            if value is not None and not isinstance(value, bool):
+                raise ValueError(f"{name}必须是布尔值")
+        if group_strategies is not None and not isinstance(group_strategies, dict):
+            raise ValueError("group_strategies必须是 分组→策略 的对象")
+        for value in [strategy] + list((group_strategies or {}).values()):
+            if value and value not in STRATEGIES:
+                raise ValueError(f"未知的路由策略: {value}")
+        
         if retry_count is not None:
             self.retry_count = retry_count
         if retry_on_error is not None:
             self.retry_on_error = retry_on_error
+        if strategy:
+            self._strategy = strategy
+        if group_strategies is not None:
+            self._group_strategies = {g: v for g, v in group_strategies.items() if g and v}
+        if hedge_enabled is not None:
+            self.hedge.enabled = hedge_enabled
+        if hedge_quantile is not None:
+            self.hedge.quantile = max(0.5, min(0.99, hedge_quantile))  # 限制P50-P99
+        if hedge_max_rate is not None:
+            self.hedge.max_rate = max(0.0, min(1.0, hedge_max_rate))
     
     def reset_request_counts(self):
         """重置所有模型的请求计数"""
-        for model in self._pool:
-            model["request_count"] = 0
+        for stats in self._stats.values():
+            stats.request_count = 0
     
     def reset_all_stats(self):
         """重置所有统计数据"""
-        for model in self._pool:
-            model["request_count"] = 0
-            model["success_count"] = 0
-            model["fail_count"] = 0
-            model["total_response_time"] = 0
-            model["avg_response_time"] = 0
-        self._call_logs = []
+        for stats in self._stats.values():
+            stats.reset_counters()
+            stats.reset_routing()
+        self._external_stats.clear()
+        self.hedge.reset_stats()
+        self._call_logs.clear()
+        self.clients.reset_stats()
         self._needs_save = True
     
     async def check_and_reload(self, db: AsyncSession) -> bool:
@@ -373,11 +670,16 @@ class LLMPoolService:
         )
         config = result.scalar_one_or_none()
         
-        # 使用新格式保存，包含重试配置
+        # 使用新格式保存，包含重试配置；调用计数随模型条目一起保存
         data = {
-            "models": self._pool,
+            "models": [{**m, **self._stats[m["id"]].counters()} for m in self._pool],
             "retry_count": self._retry_count,
             "retry_on_error": self._retry_on_error,
+            "strategy": self._strategy,
+            "group_strategies": self._group_strategies,
+            "hedge_enabled": self.hedge.enabled,
+            "hedge_quantile": self.hedge.quantile,
+            "hedge_max_rate": self.hedge.max_rate,
             "version": self._version
         }
         
@@ -407,3 +709,4 @@ class LLMPoolService:
             db.add(version_config)
         
         await db.commit()
+        self.mark_saved()
@@ -4,6 +4,7 @@ from database.models import Memory, User, Conversation, SystemConfig
 from typing import Optional, List
 from openai import AsyncOpenAI
 from config import get_settings
+from .llm_pool_service import LLMPoolService
 
 settings = get_settings()
 
@@ -39,7 +40,7 @@ class MemoryService:
         except:
             pass
         
-        self._client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        self._client = LLMPoolService.get_client(base_url, api_key)
         return self._client
     
     async def get_model(self) -> str:
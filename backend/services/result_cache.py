@@ -0,0 +1,96 @@
+from typing import Dict, Hashable, Optional, Tuple
+from collections import OrderedDict
+import re
+import sys
+import unicodedata
+
+# 每条缓存的固定开销和每个命中的估算字节数（键元组、OrderedDict节点、(段落id, 分数, 来源)元组）
+ENTRY_OVERHEAD_BYTES = 240
+HIT_BYTES = 120
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！。.~～…,，、 "
+
+CachedHits = Tuple[Tuple[int, float, str], ...]
+
+
+class RetrievalCache:
+    """知识检索结果缓存：(规范化查询, 检索参数) -> 最终排序的段落列表 [(段落id, 分数, 来源), ...]
+    
+    每条缓存对应一个知识库版本，版本变化（任何知识写入）时整体失效；按估算内存占用做LRU淘汰。
+    只缓存段落id，命中后仍按id读取当前标题和段落内容。
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Tuple[CachedHits, int]]" = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    @staticmethod
+    def normalize(query: str) -> str:
+        """全角转半角、小写、合并空白、去掉句末标点，使同一问题的不同写法共用缓存"""
+        query = unicodedata.normalize("NFKC", query or "").lower()
+        return _SPACE_RE.sub(" ", query).strip().rstrip(_TRAILING_PUNCT)
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    def _check_version(self, version: Hashable):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+    
+    def get(self, key: Hashable, version: Hashable) -> Optional[CachedHits]:
+        if not self.enabled:
+            return None
+        self._check_version(version)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    
+    def put(self, key: Hashable, version: Hashable, hits: CachedHits):
+        """写入缓存；检索期间知识库已变化（version过期）时丢弃"""
+        if not self.enabled or version != self._version:
+            return
+        size = ENTRY_OVERHEAD_BYTES + sys.getsizeof(key[0] if isinstance(key, tuple) else key) + HIT_BYTES * len(hits)
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (hits, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+            self.evictions += 1
+    
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "memory_bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,114 @@
+from typing import Iterator, Optional
+import numpy as np
+
+SCORE_BLOCK = 4096  # int8打分时每批反量化的行数，限制临时float32矩阵的内存
+
+
+class Float32Store:
+    """归一化向量的float32存储（默认）"""
+    
+    quantized = False
+    
+    def __init__(self, vectors: np.ndarray):
+        self.data = np.ascontiguousarray(vectors, dtype=np.float32)
+    
+    def __len__(self) -> int:
+        return self.data.shape[0]
+    
+    @property
+    def dim(self) -> int:
+        return self.data.shape[1]
+    
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+    
+    def dot(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """与查询向量的内积（向量已归一化，即余弦相似度）"""
+        return (self.data if rows is None else self.data[rows]) @ query
+    
+    def vectors(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        return self.data if rows is None else self.data[rows]
+    
+    def blocks(self, size: int) -> Iterator[np.ndarray]:
+        for i in range(0, len(self), size):
+            yield self.data[i:i + size]
+    
+    def set_row(self, pos: int, vector: np.ndarray):
+        self.data[pos] = vector
+    
+    def append(self, vectors: np.ndarray):
+        self.data = np.vstack([self.data, vectors.astype(np.float32, copy=False)])
+    
+    def select(self, keep: np.ndarray):
+        self.data = self.data[keep]
+
+
+class Int8Store:
+    """归一化向量的int8标量量化存储：每行一个缩放系数，内存约为float32的1/4
+    
+    打分时分块反量化，精度损失由调用方对候选结果用原始float32向量重排补偿。
+    """
+    
+    quantized = True
+    
+    def __init__(self, vectors: np.ndarray):
+        self.codes, self.scales = self.quantize(vectors)
+    
+    @staticmethod
+    def quantize(vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+    
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1]
+    
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+    
+    def dot(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), SCORE_BLOCK):
+            block = codes[i:i + SCORE_BLOCK].astype(np.float32)
+            scores[i:i + SCORE_BLOCK] = (block @ query) * scales[i:i + SCORE_BLOCK]
+        return scores
+    
+    def vectors(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        return codes.astype(np.float32) * scales[:, None]
+    
+    def blocks(self, size: int) -> Iterator[np.ndarray]:
+        for i in range(0, len(self), size):
+            yield self.codes[i:i + size].astype(np.float32) * self.scales[i:i + size, None]
+    
+    def set_row(self, pos: int, vector: np.ndarray):
+        codes, scales = self.quantize(vector.reshape(1, -1))
+        self.codes[pos] = codes[0]
+        self.scales[pos] = scales[0]
+    
+    def append(self, vectors: np.ndarray):
+        codes, scales = self.quantize(vectors)
+        self.codes = np.vstack([self.codes, codes])
+        self.scales = np.concatenate([self.scales, scales])
+    
+    def select(self, keep: np.ndarray):
+        self.codes = self.codes[keep]
+        self.scales = self.scales[keep]
+
+
+def make_store(vectors: np.ndarray, quantization: str = "none"):
+    """按量化模式创建存储：none(float32) / int8"""
+    if quantization == "int8":
+        return Int8Store(vectors)
+    return Float32Store(vectors)
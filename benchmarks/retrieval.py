@@ -0,0 +1,289 @@
+"""知识检索基准：各检索方式的延迟(p50/p95)、索引内存，以及标注查询集上的 recall@k 和 MRR
+
+使用本地哈希向量化(embedding_provider=local)，在临时数据库中离线运行，不调用任何API；
+结果以JSON输出，可保存后在不同提交之间对比。
+
+用法:
+    python benchmarks/retrieval.py                           # ALL.txt + benchmarks/queries_all.jsonl
+    python benchmarks/retrieval.py --synthetic --n 5000      # 合成知识库，查询由条目的特征词生成
+    python benchmarks/retrieval.py --synthetic --bots 4      # 条目轮流分给4个bot，查询只检索目标条目所在bot的分区和共享分区
+    python benchmarks/retrieval.py --output before.json      # 同时写入文件
+
+redundancy 为每次结果中两两段落的最大向量相似度（均值），tokens 为结果的估算token数（均值）。
+
+标注查询集为JSONL，每行 {"query": "...", "relevant": ["条目标题", ...]}，标题按前缀匹配。
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+READ_SIZE = 64 * 1024
+METHODS = ("vector_search", "keyword_search", "search:vector", "search:keyword", "search:hybrid")
+
+
+def configure(workdir: str, args):
+    """在导入服务模块之前设置环境变量：临时数据库/索引文件、本地向量化、关闭缓存"""
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["KNOWLEDGE_ANN_INDEX_PATH"] = os.path.join(workdir, "knowledge_ivf.npz")
+    os.environ["JIEBA_CACHE_FILE"] = os.path.join(workdir, "jieba.cache")
+    os.environ["EMBEDDING_PROVIDER"] = "local"
+    os.environ["LOCAL_EMBEDDING_DIM"] = str(args.dim)
+    if not args.cache:
+        os.environ["KNOWLEDGE_RESULT_CACHE_MB"] = "0"
+        os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+
+
+def synthetic_corpus(n: int, topics: int, length: int, queries: int, seed: int, bots: int = 0):
+    """从jieba词典取词生成合成知识库：每个条目 = 主题词 + 常用词 + 条目独有的特征词；
+    查询由条目的两个特征词和一个主题词组成，标注为该条目。bots>0时条目按序号轮流分给各bot"""
+    import jieba
+    jieba.dt.check_initialized()
+    rng = random.Random(seed)
+    words = sorted(
+        (w for w, f in jieba.dt.FREQ.items() if f > 0 and 2 <= len(w) <= 4 and all("一" <= c <= "鿿" for c in w)),
+        key=lambda w: -jieba.dt.FREQ[w]
+    )
+    common, rest = words[:2000], words[2000:]
+    rng.shuffle(rest)
+    topic_words = [rest[i * 30:(i + 1) * 30] for i in range(topics)]
+    distinct = rest[topics * 30:]
+    if len(distinct) < n * 3:
+        raise SystemExit(f"词典词数不足以生成 {n} 个条目")
+    
+    sections, labeled = [], []
+    for i in range(n):
+        topic = topic_words[i % topics]
+        own = distinct[i * 3:(i + 1) * 3]
+        title = "".join(rng.sample(topic, 2)) + own[0]
+        body = []
+        while sum(len(w) for w in body) < length:
+            roll = rng.random()
+            body.append(rng.choice(topic) if roll < 0.4 else rng.choice(own) if roll < 0.55 else rng.choice(common))
+            if rng.random() < 0.1:
+                body.append("，" if rng.random() < 0.7 else "。")
+        bot_id = f"bot{i % bots}" if bots else None
+        sections.append({"key": f"synthetic::{i}", "title": title, "content": "".join(body), "category": f"主题{i % topics}", "bot_id": bot_id})
+        labeled.append({"query": f"{own[1]}和{own[2]}的{rng.choice(topic)}", "relevant": [title], "bot_id": bot_id})
+    rng.shuffle(labeled)
+    return sections, labeled[:queries]
+
+
+def load_queries(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def read_chunks(path: str):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def score(ranked, relevant, k):
+    """返回 (recall@k, 倒数排名)"""
+    top = ranked[:k]
+    recall = len(relevant & set(top)) / len(relevant)
+    rank = next((i + 1 for i, kb_id in enumerate(top) if kb_id in relevant), None)
+    return recall, 1 / rank if rank else 0.0
+
+
+def max_pairwise_similarity(indexes, hits) -> float:
+    """结果中两两段落向量的最大余弦相似度，衡量结果的冗余程度（段落只在一个分区中，其余分区为0向量）"""
+    if len(hits) < 2:
+        return 0.0
+    vectors = sum(index.passage_vectors([hit.passage_id for hit in hits]) for index in indexes if index.dim)
+    similarity = vectors @ vectors.T
+    return float(similarity[np.triu_indices(len(hits), 1)].max())
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    from sqlalchemy import select
+    from database import init_db, AsyncSessionLocal
+    from database.models import KnowledgeBase
+    from backend.services import EmbeddingWorker, KnowledgeService, KnowledgeIndex, LexicalIndex
+    from backend.services.knowledge_import import import_document, iter_lines
+    from backend.services.lexical_index import init_jieba
+    from backend.services.knowledge_index import knowledge_partitions
+    from backend.services.knowledge_service import estimate_tokens
+    from backend.services.embedding_providers import LocalEmbeddingProvider
+    from config import get_settings
+    
+    settings = get_settings()
+    quiet = contextlib.redirect_stdout(io.StringIO())  # 服务的逐条日志不计入输出
+    report = {"commit": git_commit(), "k": args.k}
+    
+    await init_db()
+    worker = await EmbeddingWorker.get_instance()
+    await worker.ensure_chunks()
+    # 先加载jieba词典，避免其耗时计入导入和向量化
+    with quiet:
+        await asyncio.to_thread(init_jieba, settings.jieba_cache_file)
+    
+    # 构建知识库并生成向量
+    start = time.perf_counter()
+    with quiet:
+        if args.synthetic:
+            sections, labeled = synthetic_corpus(args.n, args.topics, args.length, args.queries, args.seed, args.bots)
+            by_bot = {}
+            for section in sections:
+                by_bot.setdefault(section["bot_id"], []).append(section)
+            async with AsyncSessionLocal() as db:
+                service = KnowledgeService(db)
+                for bot_id, items in by_bot.items():
+                    for i in range(0, len(items), settings.knowledge_import_batch_size):
+                        await service.upsert_sections(items[i:i + settings.knowledge_import_batch_size], bot_id=bot_id)
+            dataset = {"source": "synthetic", "entries": args.n, "topics": args.topics, "length": args.length, "seed": args.seed, "bots": args.bots}
+        else:
+            async with AsyncSessionLocal() as db:
+                imported = await import_document(db, iter_lines(read_chunks(args.file)), os.path.basename(args.file))
+            labeled = load_queries(args.queries_file)
+            dataset = {"source": os.path.basename(args.file), "entries": imported["sections"], "queries_file": os.path.relpath(args.queries_file, ROOT)}
+        import_seconds = time.perf_counter() - start
+        await worker.join()
+    embed_seconds = time.perf_counter() - start - import_seconds
+    
+    # 标注按标题前缀解析为条目id
+    async with AsyncSessionLocal() as db:
+        titles = (await db.execute(select(KnowledgeBase.id, KnowledgeBase.title))).all()
+    queries = []
+    for item in labeled:
+        relevant = {kb_id for kb_id, title in titles for label in item["relevant"] if title.startswith(label)}
+        if not relevant:
+            raise SystemExit(f"标注未匹配到任何条目: {item['relevant']}")
+        queries.append((item["query"], relevant, item.get("bot_id")))
+    
+    dataset.update({"queries": len(queries), "passages": worker.progress["total"], "embedding_model": LocalEmbeddingProvider(args.dim).model})
+    report["dataset"] = dataset
+    report["build"] = {
+        "import_ms": round(import_seconds * 1000, 2),
+        "embed_ms": round(embed_seconds * 1000, 2),
+        "embedded": worker.progress["embedded"]
+    }
+    
+    # 索引内存：重新构建各分区的两个索引，用tracemalloc统计新增内存（不含已加载的jieba词典）
+    with quiet:
+        async with AsyncSessionLocal() as db:
+            partitions = await knowledge_partitions(db)
+            lexicals = [await LexicalIndex.get_instance(partition) for partition in partitions]
+            vectors = [await KnowledgeIndex.get_instance(partition) for partition in partitions]
+            for index in lexicals + vectors:
+                index.invalidate()
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for index in lexicals:
+                await index.ensure_built(db)
+            lexical_bytes = tracemalloc.get_traced_memory()[0] - before
+            before = tracemalloc.get_traced_memory()[0]
+            for index in vectors:
+                await index.ensure_built(db)
+            vector_traced = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+    report["memory"] = {
+        "lexical_index_bytes": lexical_bytes,
+        "vector_store_bytes": sum(index.get_stats()["memory_bytes"] for index in vectors),
+        "vector_index_traced_bytes": vector_traced,
+        "lexical_terms": sum(index.get_stats()["terms"] for index in lexicals),
+        "partitions": len(partitions),
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+    
+    # 各检索方式：先预热一次，再逐条计时
+    report["methods"] = {}
+    for method in METHODS:
+        async with AsyncSessionLocal() as db:
+            service = KnowledgeService(db)
+            if method.startswith("search:"):
+                mode = method.split(":")[1]
+                call = lambda q, bot_id: service.search(q, limit=args.k, mode=mode, bot_id=bot_id)
+            else:
+                call = lambda q, bot_id: getattr(service, method)(q, limit=args.k, partitions=service.search_partitions(bot_id))
+            with quiet:
+                await call(queries[0][0], queries[0][2])
+                timings, recalls, reciprocal, redundancy, tokens = [], [], [], [], []
+                for query, relevant, bot_id in queries:
+                    start = time.perf_counter()
+                    hits = await call(query, bot_id)
+                    timings.append(time.perf_counter() - start)
+                    recall, rr = score([hit.id for hit in hits], relevant, args.k)
+                    recalls.append(recall)
+                    reciprocal.append(rr)
+                    redundancy.append(max_pairwise_similarity(vectors, hits))
+                    tokens.append(sum(estimate_tokens(hit.title) + estimate_tokens(hit.snippet) for hit in hits))
+        report["methods"][method] = {
+            "p50_ms": percentile_ms(timings, 50),
+            "p95_ms": percentile_ms(timings, 95),
+            f"recall@{args.k}": round(float(np.mean(recalls)), 4),
+            "mrr": round(float(np.mean(reciprocal)), 4),
+            "redundancy": round(float(np.mean(redundancy)), 4),
+            "tokens": round(float(np.mean(tokens)), 1)
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知识检索基准（离线，本地哈希向量）")
+    parser.add_argument("--file", type=str, default=os.path.join(ROOT, "ALL.txt"), help="导入的知识文档")
+    parser.add_argument("--queries-file", type=str, default=os.path.join(ROOT, "benchmarks", "queries_all.jsonl"), help="标注查询集(JSONL)")
+    parser.add_argument("--synthetic", action="store_true", help="使用合成知识库和自动生成的查询")
+    parser.add_argument("--n", type=int, default=1000, help="合成条目数")
+    parser.add_argument("--topics", type=int, default=50, help="合成数据的主题数")
+    parser.add_argument("--length", type=int, default=300, help="合成条目的正文字数")
+    parser.add_argument("--queries", type=int, default=200, help="合成查询数")
+    parser.add_argument("--bots", type=int, default=0, help="合成条目轮流分给的bot数（0为全部共享）")
+    parser.add_argument("--k", type=int, default=5, help="recall@k的k（也是每次检索的条数）")
+    parser.add_argument("--dim", type=int, default=512, help="本地哈希向量维度")
+    parser.add_argument("--cache", action="store_true", help="保留查询向量缓存和检索结果缓存（默认关闭以测量实际检索）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="同时把JSON结果写入文件")
+    parser.add_argument("--keep", action="store_true", help="保留临时数据库目录")
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix="catiebot-bench-")
+    configure(workdir, args)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
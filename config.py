@@ -16,11 +16,52 @@ class Settings(BaseSettings):
     llm_base_url: str = "https://api.openai.com/v1"
     llm_api_key: str = ""
     llm_model: str = "gpt-4o-mini"
+    llm_max_connections: int = 100  # 每个LLM端点(base_url+api_key)共享连接池的最大连接数
+    llm_max_keepalive_connections: int = 20  # 每个端点保持的空闲长连接数
+    llm_keepalive_expiry: float = 60.0  # 空闲长连接的保持时间(秒)
+    llm_http2: bool = True  # 使用HTTP/2（依赖httpx[http2]中的h2，未安装时回退到HTTP/1.1长连接并在启动时提示）
+    llm_client_idle_ttl: float = 900.0  # 端点客户端空闲超过该秒数后关闭，0为不关闭
+    llm_routing_ewma_alpha: float = 0.3  # adaptive路由中延迟/错误率EWMA的平滑系数，越大越看重最近的调用
+    llm_routing_decay: float = 60.0  # adaptive路由中历史代价的衰减时间常数(秒)，长时间未选中的模型会重新被试探，0为不衰减
+    llm_breaker_failure_threshold: int = 5  # 模型熔断：连续失败次数达到该值时熔断
+    llm_breaker_error_rate: float = 0.5  # 模型熔断：滑动窗口内错误率达到该值时熔断
+    llm_breaker_window: float = 60.0  # 模型熔断：错误率统计的滑动窗口(秒)
+    llm_breaker_min_calls: int = 10  # 模型熔断：窗口内调用数不少于该值才按错误率判断
+    llm_breaker_cooldown: float = 10.0  # 模型熔断的初始冷却秒数，探测失败后翻倍
+    llm_breaker_max_cooldown: float = 300.0  # 模型熔断冷却秒数上限
+    llm_call_log_size: int = 500  # 模型池调用日志保留条数（环形缓冲）
     
     # Embedding (向量化模型，留空则使用LLM的配置)
     embedding_base_url: str = ""
     embedding_api_key: str = ""
     embedding_model: str = "BAAI/bge-m3"
+    embedding_provider: str = "openai"  # 向量化后端: openai(OpenAI兼容API) / local(本地离线哈希向量，无网络调用)
+    local_embedding_dim: int = 512  # 本地哈希向量的维度
+    embedding_cache_size: int = 1024  # 查询向量缓存条数
+    embedding_cache_ttl: int = 3600  # 查询向量缓存有效期(秒)
+    embedding_coalesce_window_ms: float = 5.0  # 并发查询向量请求的合批等待时间(毫秒)，0为不合批
+    embedding_coalesce_max_batch: int = 32  # 合批的最大条数，凑满立即发送
+    embedding_pool_cooldown: float = 10.0  # 向量化服务池端点失败后的冷却秒数（连续失败时翻倍，最多8倍）
+    embedding_batch_size: int = 16  # 重建向量时每批文本数
+    embedding_concurrency: int = 4  # 重建向量时并发批次数
+    knowledge_vector_timeout: float = 3.0  # 检索时查询向量化的超时(秒)，超时回退关键词检索
+    knowledge_search_mode: str = "hybrid"  # 检索模式: hybrid / vector / keyword
+    knowledge_hybrid_deadline_ms: int = 800  # 混合检索等待向量结果的时限(毫秒)，超时只返回关键词结果
+    knowledge_rrf_k: int = 60  # 倒数排名融合(RRF)的平滑常数
+    knowledge_mmr_lambda: float = 0.8  # MMR去冗余中相关度的权重λ，1为只按相关度排序（关闭去冗余）
+    knowledge_mmr_candidates: int = 3  # MMR的候选条目数（返回条数的倍数）
+    knowledge_token_budget: int = 0  # 注入提示词的知识片段总token预算（估算），0为不限制
+    knowledge_chunk_size: int = 500  # 长条目分段长度(字符)，段落是检索和向量化的单位
+    knowledge_chunk_overlap: int = 100  # 相邻段落的重叠长度(字符)
+    knowledge_ann_backend: str = "ivf"  # 向量检索后端: ivf(段落数达到阈值后使用IVF近似检索) / exact
+    knowledge_ann_min_size: int = 5000  # 段落向量少于该数量时始终精确检索
+    knowledge_ann_nprobe: int = 8  # IVF检索的簇数，越大召回越高、越慢
+    knowledge_ann_index_path: str = "data/knowledge_ivf.npz"  # IVF簇中心文件
+    knowledge_index_quantization: str = "none"  # 向量索引存储: none(float32) / int8(内存约1/4，候选用原向量重排)
+    knowledge_rerank_factor: int = 4  # int8模式下重排的候选倍数(top_k×N)
+    knowledge_import_batch_size: int = 200  # 批量导入时每个事务写入的章节数
+    knowledge_result_cache_mb: float = 8.0  # 检索结果缓存的内存上限(MB)，0为关闭
+    jieba_cache_file: str = "data/jieba.cache"  # jieba前缀词典缓存文件，启动时预加载
     
     # Context (Bot独立配置，可在Web后台修改)
     context_limit: int = 10
@@ -1,8 +1,8 @@
-from .models import Base, User, Memory, KnowledgeBase, Blacklist, ChannelWhitelist, Conversation, BotConfig, SystemConfig, SensitiveWord, PublicAPIConfig, PublicAPIUser, Lottery, LotteryParticipant, RedPacket, RedPacketClaim, RedeemCode
+from .models import Base, User, Memory, KnowledgeBase, KnowledgeChunk, Blacklist, ChannelWhitelist, Conversation, BotConfig, SystemConfig, SensitiveWord, PublicAPIConfig, PublicAPIUser, Lottery, LotteryParticipant, RedPacket, RedPacketClaim, RedeemCode
 from .database import get_db, init_db, AsyncSessionLocal
 
 __all__ = [
-    "Base", "User", "Memory", "KnowledgeBase", "Blacklist", 
+    "Base", "User", "Memory", "KnowledgeBase", "KnowledgeChunk", "Blacklist", 
     "ChannelWhitelist", "Conversation", "BotConfig", "SystemConfig",
     "SensitiveWord", "PublicAPIConfig", "PublicAPIUser",
     "Lottery", "LotteryParticipant", "RedPacket", "RedPacketClaim", "RedeemCode",
@@ -1,7 +1,10 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.pool import StaticPool
+from sqlalchemy import text
 from .models import Base
+from .embedding_codec import pack_embedding
 from config import get_settings
+import json
 
 settings = get_settings()
 
@@ -43,7 +46,7 @@ async def init_db():
         try:
             await conn.execute(
                 __import__('sqlalchemy').text(
-                    "ALTER TABLE knowledge_base ADD COLUMN embedding TEXT"
+                    "ALTER TABLE knowledge_base ADD COLUMN embedding BLOB"
                 )
             )
         except:
@@ -56,6 +59,58 @@ async def init_db():
             )
         except:
             pass
+        for column in ("embedding_hash VARCHAR(64)", "embedding_model VARCHAR(100)", "source_key VARCHAR(255)", "bot_id VARCHAR(50)"):
+            try:
+                await conn.execute(
+                    text(f"ALTER TABLE knowledge_base ADD COLUMN {column}")
+                )
+            except:
+                pass
+        await conn.execute(
+            text("CREATE INDEX IF NOT EXISTS idx_kb_source_key ON knowledge_base (source_key)")
+        )
+        await conn.execute(
+            text("CREATE INDEX IF NOT EXISTS idx_kb_bot ON knowledge_base (bot_id)")
+        )
+        
+        await _migrate_json_embeddings(conn)
+
+
+async def _migrate_json_embeddings(conn, batch_size: int = 500):
+    """将旧的JSON文本向量批量转换为float32二进制"""
+    result = await conn.execute(
+        text("SELECT value FROM system_config WHERE key = 'embedding_model'")
+    )
+    model = result.scalar() or settings.embedding_model
+    
+    converted = 0
+    while True:
+        result = await conn.execute(
+            text(
+                "SELECT id, embedding FROM knowledge_base "
+                "WHERE typeof(embedding) = 'text' LIMIT :limit"
+            ),
+            {"limit": batch_size}
+        )
+        rows = result.all()
+        if not rows:
+            break
+        
+        params = []
+        for kb_id, raw in rows:
+            try:
+                blob = pack_embedding(json.loads(raw), model)
+            except (TypeError, ValueError):
+                blob = None  # 无法解析的旧数据直接清空，重建向量时会重新生成
+            params.append({"id": kb_id, "embedding": blob})
+        await conn.execute(
+            text("UPDATE knowledge_base SET embedding = :embedding WHERE id = :id"),
+            params
+        )
+        converted += len(params)
+    
+    if converted:
+        print(f"[Database] Converted {converted} JSON embeddings to binary float32")
 
 
 async def get_db():
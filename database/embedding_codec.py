@@ -0,0 +1,35 @@
+import json
+import struct
+from typing import Iterable, Optional, Union
+import numpy as np
+
+# 二进制向量格式: magic(4) | model名长度(uint16) | 维度(uint32) | model名(utf-8) | float32小端数据
+MAGIC = b"EMB1"
+_HEADER = struct.Struct("<4sHI")
+_DTYPE = np.dtype("<f4")
+
+
+def pack_embedding(vector: Iterable[float], model: str = "") -> bytes:
+    """将向量编码为带头部的float32二进制"""
+    data = np.asarray(vector, dtype=_DTYPE).ravel()
+    model_bytes = (model or "").encode("utf-8")[:0xFFFF]
+    return _HEADER.pack(MAGIC, len(model_bytes), data.shape[0]) + model_bytes + data.tobytes()
+
+
+def unpack_embedding(raw: Union[bytes, str, None]) -> Optional[np.ndarray]:
+    """解码向量，兼容旧的JSON文本格式；无法解析时返回None"""
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        try:
+            return np.asarray(json.loads(raw), dtype=np.float32)
+        except (TypeError, ValueError):
+            return None
+    raw = bytes(raw)
+    if raw[:4] != MAGIC:
+        return None
+    _, model_len, dim = _HEADER.unpack_from(raw)
+    offset = _HEADER.size + model_len
+    if len(raw) - offset != dim * _DTYPE.itemsize:
+        return None
+    return np.frombuffer(raw, dtype=_DTYPE, count=dim, offset=offset).astype(np.float32)
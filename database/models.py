@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Index
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 
@@ -58,13 +58,37 @@ class KnowledgeBase(Base):
     content = Column(Text, nullable=False)
     keywords = Column(String(500))
     category = Column(String(100))
-    embedding = Column(Text, nullable=True)  # JSON格式存储向量
+    embedding = Column(LargeBinary, nullable=True)  # float32二进制向量（带模型/维度头部）
+    embedding_hash = Column(String(64), nullable=True)  # 向量化文本的哈希
+    embedding_model = Column(String(100), nullable=True)  # 生成向量所用的模型
+    source_key = Column(String(255), nullable=True)  # 批量导入时的章节键（来源::标题路径），重新导入按此更新
+    bot_id = Column(String(50), nullable=True)  # 所属bot，为空时所有bot共享
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     __table_args__ = (
         Index("idx_kb_keywords", "keywords"),
+        Index("idx_kb_source_key", "source_key"),
+        Index("idx_kb_bot", "bot_id"),
+    )
+
+
+class KnowledgeChunk(Base):
+    """知识库条目的段落（带重叠的分段），检索和向量化的基本单位"""
+    __tablename__ = "knowledge_chunks"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kb_id = Column(Integer, ForeignKey("knowledge_base.id", ondelete="CASCADE"), nullable=False, index=True)
+    chunk_index = Column(Integer, nullable=False)  # 段落在条目中的序号
+    content = Column(Text, nullable=False)
+    embedding = Column(LargeBinary, nullable=True)  # float32二进制向量（带模型/维度头部）
+    embedding_hash = Column(String(64), nullable=True)  # 向量化文本的哈希
+    embedding_model = Column(String(100), nullable=True)  # 生成向量所用的模型
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("idx_chunk_kb_index", "kb_id", "chunk_index"),
     )
 
 
@@ -0,0 +1,59 @@
+import asyncio
+import sys
+import os
+import argparse
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database import init_db, AsyncSessionLocal
+from backend.services import EmbeddingWorker
+from backend.services.knowledge_import import import_document, iter_lines
+
+READ_SIZE = 64 * 1024
+
+
+async def read_chunks(path: str):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def main(args):
+    await init_db()
+    worker = await EmbeddingWorker.get_instance()
+    await worker.ensure_chunks()
+    
+    source = args.source or os.path.basename(args.file)
+    async with AsyncSessionLocal() as db:
+        report = await import_document(
+            db,
+            iter_lines(read_chunks(args.file)),
+            source,
+            category=args.category,
+            batch_size=args.batch_size,
+            auto_embed=not args.no_embed,
+            bot_id=args.bot_id
+        )
+    
+    if not args.no_embed:
+        print("[Import] Waiting for embeddings...", flush=True)
+    await worker.join()
+    report["embedding"] = {key: worker.progress[key] for key in ("embedded", "skipped", "failed")}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导入ALL.txt格式的知识文档（按章节新增或更新）")
+    parser.add_argument("file", help="文档路径")
+    parser.add_argument("--source", type=str, default=None, help="来源名称，章节键的前缀（默认为文件名）")
+    parser.add_argument("--category", type=str, default=None, help="覆盖文档中的分组分类")
+    parser.add_argument("--bot-id", type=str, default=None, help="导入为该bot的专属知识（默认为所有bot共享）")
+    parser.add_argument("--batch-size", type=int, default=None, help="每个事务写入的章节数")
+    parser.add_argument("--no-embed", action="store_true", help="只导入不生成向量（之后可在后台“重建向量”补齐）")
+    args = parser.parse_args()
+    
+    asyncio.run(main(args))
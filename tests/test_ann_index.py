@@ -0,0 +1,70 @@
+import numpy as np
+from backend.services.ann_index import IVFFlatIndex
+from backend.services.knowledge_index import KnowledgeIndex
+
+
+def _vectors(n: int = 200, dim: int = 16, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _rows(vectors: np.ndarray):
+    return [(i + 1, i + 1, vec) for i, vec in enumerate(vectors)]
+
+
+def _index(path) -> KnowledgeIndex:
+    index = KnowledgeIndex("test")
+    index.backend = "ivf"
+    index.quantization = "none"
+    index.index_path = str(path)
+    return index
+
+
+def test_save_load_round_trip(tmp_path):
+    path = tmp_path / "ivf.npz"
+    ann = IVFFlatIndex.train(_vectors(), nlist=8)
+    ann.model = "model-a"
+    ann.save(str(path))
+    loaded = IVFFlatIndex.load(str(path))
+    np.testing.assert_array_equal(loaded.centroids, ann.centroids)
+    assert loaded.trained_size == 200 and loaded.model == "model-a"
+
+
+def test_missing_or_corrupt_file_loads_as_none(tmp_path):
+    assert IVFFlatIndex.load(str(tmp_path / "missing.npz")) is None
+    corrupt = tmp_path / "corrupt.npz"
+    corrupt.write_bytes(b"not an npz file")
+    assert IVFFlatIndex.load(str(corrupt)) is None
+
+
+def test_load_recomputes_assignments_from_current_vectors(tmp_path):
+    path = tmp_path / "ivf.npz"
+    ann = IVFFlatIndex.train(_vectors(), nlist=8)
+    ann.model = "model-a"
+    ann.save(str(path))
+    # 同样的段落id，向量已经重新生成
+    vectors = _vectors(seed=1)
+    index = _index(path)
+    index._load(_rows(vectors), model="model-a")
+    assert index._ann is not None
+    np.testing.assert_array_equal(index._assign, ann.assign(vectors))
+
+
+def test_centroids_for_another_model_are_discarded(tmp_path):
+    path = tmp_path / "ivf.npz"
+    ann = IVFFlatIndex.train(_vectors(), nlist=8)
+    ann.model = "model-a"
+    ann.save(str(path))
+    index = _index(path)
+    index._load(_rows(_vectors()), model="model-b")
+    assert index._ann is None and len(index._assign) == 0
+
+
+def test_centroids_with_another_dimension_are_discarded(tmp_path):
+    path = tmp_path / "ivf.npz"
+    ann = IVFFlatIndex.train(_vectors(dim=16), nlist=8)
+    ann.model = "model-a"
+    ann.save(str(path))
+    index = _index(path)
+    index._load(_rows(_vectors(dim=32)), model="model-a")
+    assert index._ann is None and not index.ann_active
@@ -0,0 +1,39 @@
+from backend.services.chunking import split_passages
+
+
+def _sentences(n: int) -> str:
+    return "".join(f"第{i:02d}句内容。" for i in range(n))
+
+
+def test_short_content_is_one_passage():
+    assert split_passages("很短的条目。", size=100, overlap=20) == ["很短的条目。"]
+    assert split_passages("", size=100, overlap=20) == [""]
+
+
+def test_passages_respect_size_and_cover_content():
+    content = _sentences(40)
+    passages = split_passages(content, size=50, overlap=0)
+    assert len(passages) > 1
+    assert all(len(p) <= 50 for p in passages)
+    assert "".join(passages) == content  # 无重叠时按句子边界首尾相接
+
+
+def test_adjacent_passages_share_trailing_sentences():
+    content = _sentences(40)
+    passages = split_passages(content, size=50, overlap=20)
+    assert all(len(p) <= 50 for p in passages)
+    for prev, nxt in zip(passages, passages[1:]):
+        shared = max(k for k in range(len(prev) + 1) if nxt.startswith(prev[len(prev) - k:]))
+        assert 0 < shared <= 20
+        assert prev[len(prev) - shared - 1] == "。"  # 重叠部分是完整的句子
+
+
+def test_overlap_is_capped_at_half_the_size():
+    content = _sentences(40)
+    capped = split_passages(content, size=50, overlap=500)
+    assert capped == split_passages(content, size=50, overlap=25)
+
+
+def test_overlong_sentence_is_hard_split():
+    passages = split_passages("长" * 130, size=50, overlap=10)
+    assert [len(p) for p in passages] == [50, 50, 30]
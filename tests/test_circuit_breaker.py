@@ -0,0 +1,78 @@
+from backend.services.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+def _breaker(**kwargs) -> CircuitBreaker:
+    options = dict(failure_threshold=3, error_rate=0.5, window=60, min_calls=10, cooldown=10, max_cooldown=40, probe_timeout=30)
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def _fail(breaker: CircuitBreaker, times: int, now: float):
+    for _ in range(times):
+        breaker.record(False, breaker.acquire(now=now), now=now)
+
+
+def test_consecutive_failures_trip_the_breaker():
+    breaker = _breaker()
+    _fail(breaker, 2, now=0)
+    assert breaker.state == CLOSED
+    assert breaker.record(False, breaker.acquire(now=1), now=1) == OPEN
+    assert not breaker.available(now=5)
+    assert breaker.available(now=11)
+
+
+def test_window_error_rate_trips_the_breaker():
+    breaker = _breaker(failure_threshold=100)
+    for i in range(10):
+        breaker.record(i % 2 == 0, breaker.acquire(now=i), now=i)
+    assert breaker.state == OPEN
+
+
+def test_half_open_allows_one_probe_and_closes_on_success():
+    breaker = _breaker()
+    _fail(breaker, 3, now=0)
+    probe = breaker.acquire(now=10)
+    assert breaker.state == HALF_OPEN
+    assert not breaker.available(now=11)  # 探测进行中
+    assert breaker.record(True, None, now=12) is None  # 探测之外的结果不计入
+    assert breaker.state == HALF_OPEN
+    assert breaker.record(True, probe, now=14) == CLOSED
+    assert breaker.available(now=14) and breaker.consecutive_failures == 0
+
+
+def test_failed_probe_reopens_with_doubled_cooldown():
+    breaker = _breaker()
+    _fail(breaker, 3, now=0)
+    assert breaker.open_until == 10
+    assert breaker.record(False, breaker.acquire(now=10), now=10) == OPEN
+    assert breaker.open_until == 30
+    breaker.record(False, breaker.acquire(now=30), now=30)
+    assert breaker.open_until == 30 + 40  # 不超过max_cooldown
+
+
+def test_late_results_are_ignored():
+    breaker = _breaker()
+    started = breaker.acquire(now=0)
+    _fail(breaker, 3, now=1)
+    assert breaker.record(False, started, now=2) is None  # 熔断期间
+    probe = breaker.acquire(now=11)
+    breaker.record(True, probe, now=12)
+    assert breaker.record(False, started, now=13) is None  # 恢复之前开始的请求
+    assert breaker.consecutive_failures == 0
+
+
+def test_released_probe_allows_a_new_probe():
+    breaker = _breaker()
+    _fail(breaker, 3, now=0)
+    probe = breaker.acquire(now=10)
+    assert not breaker.available(now=11)
+    breaker.release(probe)
+    assert breaker.available(now=11)
+
+
+def test_stuck_probe_times_out():
+    breaker = _breaker()
+    _fail(breaker, 3, now=0)
+    breaker.acquire(now=10)
+    assert not breaker.available(now=39)
+    assert breaker.available(now=41)
@@ -0,0 +1,31 @@
+import json
+import numpy as np
+from database.embedding_codec import MAGIC, pack_embedding, unpack_embedding
+
+
+def test_round_trip_keeps_float32_values():
+    vector = [0.1, -2.5, 3.0, 1e-6]
+    raw = pack_embedding(vector, "text-embedding-3-small")
+    assert raw[:4] == MAGIC
+    decoded = unpack_embedding(raw)
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, np.asarray(vector, dtype=np.float32))
+
+
+def test_round_trip_with_non_ascii_model_and_memoryview():
+    vector = np.arange(8, dtype=np.float64)
+    decoded = unpack_embedding(memoryview(pack_embedding(vector, "本地模型")))
+    np.testing.assert_array_equal(decoded, vector.astype(np.float32))
+
+
+def test_legacy_json_text_is_decoded():
+    decoded = unpack_embedding(json.dumps([1.0, 2.0, 3.0]))
+    np.testing.assert_array_equal(decoded, np.array([1.0, 2.0, 3.0], dtype=np.float32))
+
+
+def test_invalid_input_returns_none():
+    raw = pack_embedding([1.0, 2.0, 3.0], "m")
+    assert unpack_embedding(None) is None
+    assert unpack_embedding("not json") is None
+    assert unpack_embedding(b"XXXX" + raw[4:]) is None
+    assert unpack_embedding(raw[:-1]) is None  # 截断的数据